@@ -0,0 +1,68 @@
+from datetime import date, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Query, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from service import auth_service, analytics_service, history_writer, quota_service
+from db.database import get_async_db
+
+router = APIRouter(prefix="/analytics", tags=["Analytics"])
+security = HTTPBearer()
+
+# Período padrão do /analytics/usage e o máximo aceito, em dias
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 366
+
+async def get_current_user_data(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = auth_service.validar_token(credentials.credentials)
+    if not payload:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token inválido ou expirado",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return {
+        "username": payload.get("sub"),
+        "tenant_id": payload.get("tenant_id"),
+        "role": payload.get("role")
+    }
+
+@router.get("/usage")
+async def get_usage(
+    date_from: Optional[date] = Query(default=None, description="Data inicial (padrão: 30 dias atrás)"),
+    date_to: Optional[date] = Query(default=None, description="Data final (padrão: hoje, em UTC)"),
+    usuario: Optional[str] = Query(default=None, description="Filtra por usuário (apenas administradores)"),
+    user_data: dict = Depends(get_current_user_data),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Uso do Prompt Hub ("prompt") e do RAG ("rag") no período, já agregado: por dia, por hora
+    (UTC), por feedback e totais. Administradores veem a organização inteira (com a quebra
+    por usuário em `users`) ou filtram por usuário; membros veem só o próprio uso.
+    Lido do rollup `activity_rollup`, sem percorrer o histórico.
+    """
+    date_to = date_to or quota_service.today()
+    date_from = date_from or date_to - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from deve ser anterior a date_to.")
+    if (date_to - date_from).days >= ANALYTICS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Período máximo de {ANALYTICS_MAX_DAYS} dias.")
+
+    is_admin = user_data["role"] == "admin"
+    if not is_admin:
+        usuario = user_data["username"]
+
+    # Inclui as interações ainda na fila de gravação
+    await history_writer.flush()
+    data = await analytics_service.usage(
+        db, user_data["tenant_id"], date_from, date_to, usuario=usuario, by_user=is_admin and not usuario
+    )
+    return {
+        "tenant_id": user_data["tenant_id"],
+        "usuario": usuario,
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        **data
+    }
@@ -2,6 +2,8 @@ from fastapi import APIRouter, HTTPException, Depends, Header, status
 from service import auth_service
 from typing import Optional
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.orm import Session
+from db.database import get_db
 
 router = APIRouter(prefix="/auth", tags=["Auth"])
 security = HTTPBearer()
@@ -24,7 +26,8 @@ def register(
     usuario: str, 
     senha: str, 
     tenant_name: Optional[str] = None, 
-    user_data: Optional[dict] = Depends(auth_service.validar_token_optional)
+    user_data: Optional[dict] = Depends(auth_service.validar_token_optional),
+    db: Session = Depends(get_db)
 ):
     """
     Cadastra um novo usuário. 
@@ -32,7 +35,7 @@ def register(
     """
     tenant_id = user_data.get("tenant_id") if user_data else None
     
-    sucesso = auth_service.cadastrar_usuario(usuario, senha, tenant_name=tenant_name, tenant_id=tenant_id)
+    sucesso = auth_service.cadastrar_usuario(db, usuario, senha, tenant_name=tenant_name, tenant_id=tenant_id)
     if not sucesso:
         raise HTTPException(
             status_code=400, 
@@ -42,15 +45,15 @@ def register(
     return {"status": "sucesso", "mensagem": "Usuário cadastrado com sucesso"}
 
 @router.post("/login")
-def login(usuario: str, senha: str):
+def login(usuario: str, senha: str, db: Session = Depends(get_db)):
     """
     Realiza o login e retorna um token JWT válido e metadados do usuário.
     """
-    user = auth_service.verificar_login(usuario, senha)
+    user = auth_service.verificar_login(db, usuario, senha)
     if not user:
         raise HTTPException(status_code=401, detail="Usuário ou senha inválidos")
         
-    token = auth_service.criar_token(usuario, senha)
+    token = auth_service.criar_token(db, usuario, senha)
     if not token:
         raise HTTPException(status_code=401, detail="Erro ao gerar acesso")
     
@@ -69,7 +72,8 @@ def login(usuario: str, senha: str):
 def change_password(
     nova_senha: str, 
     usuario_alvo: Optional[str] = None, 
-    user_data: dict = Depends(get_current_user_data)
+    user_data: dict = Depends(get_current_user_data),
+    db: Session = Depends(get_db)
 ):
     """
     Altera a senha de um usuário. 
@@ -85,19 +89,19 @@ def change_password(
     else:
         target = requester
 
-    sucesso = auth_service.alterar_senha(target, nova_senha)
+    sucesso = auth_service.alterar_senha(db, target, nova_senha)
     
     if not sucesso:
         raise HTTPException(status_code=400, detail="Erro ao alterar senha ou usuário não encontrado")
         
     return {"status": "sucesso", "mensagem": f"Senha do usuário {target} alterada com sucesso"}
 @router.get("/me/tenant")
-def get_my_tenant(user_data: dict = Depends(get_current_user_data)):
+def get_my_tenant(user_data: dict = Depends(get_current_user_data), db: Session = Depends(get_db)):
     """
     Retorna informações detalhadas (limites e uso) da organização do usuário logado.
     """
     tenant_id = user_data.get("tenant_id")
-    info = auth_service.obter_info_tenant(tenant_id)
+    info = auth_service.obter_info_tenant(db, tenant_id)
     if not info:
         raise HTTPException(status_code=404, detail="Organização não encontrada")
     return info
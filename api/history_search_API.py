@@ -0,0 +1,58 @@
+from typing import Literal, Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Query, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from service import auth_service, history_search_service, history_writer
+from db.database import get_async_db
+
+router = APIRouter(prefix="/historico", tags=["Histórico"])
+security = HTTPBearer()
+
+# Tamanho máximo do texto buscado
+SEARCH_MAX_QUERY_CHARS = 200
+
+async def get_current_user_data(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = auth_service.validar_token(credentials.credentials)
+    if not payload:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token inválido ou expirado",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return {
+        "username": payload.get("sub"),
+        "tenant_id": payload.get("tenant_id"),
+        "role": payload.get("role")
+    }
+
+@router.get("/search")
+async def search_history(
+    q: str = Query(..., min_length=1, max_length=SEARCH_MAX_QUERY_CHARS, description="Texto a buscar"),
+    kind: Optional[Literal["prompt", "rag"]] = Query(default=None, description="Só prompts ou só conversas do RAG (padrão: ambos)"),
+    usuario: Optional[str] = Query(default=None, description="Filtra por usuário (apenas administradores)"),
+    page_size: int = Query(default=20, ge=1, le=history_search_service.SEARCH_MAX_PAGE_SIZE, description="Itens por página"),
+    cursor: Optional[str] = Query(default=None, description="Cursor retornado pela página anterior"),
+    user_data: dict = Depends(get_current_user_data),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Busca textual em prompts (tema e resposta) e conversas do RAG (pergunta e resposta), do
+    resultado mais relevante ao menos relevante, com o trecho em que os termos aparecem
+    (marcados com **). Membros buscam só no próprio histórico; administradores, em toda a
+    organização ou no de um usuário. O conteúdo completo vem de /prompt/historico/{id} ou
+    /rag/historico/{id}.
+    """
+    if user_data["role"] != "admin":
+        usuario = user_data["username"]
+    # Inclui as interações ainda na fila de gravação
+    await history_writer.flush()
+    try:
+        items, next_cursor = await history_search_service.search(
+            db, user_data["tenant_id"], q, usuario=usuario, kinds=[kind] if kind else None,
+            cursor=cursor, page_size=page_size
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": items, "next_cursor": next_cursor}
@@ -0,0 +1,54 @@
+import os
+import hmac
+from datetime import date
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from service import auth_service, usage_service
+from core import metrics
+
+router = APIRouter(prefix="/ops", tags=["Operações"])
+security = HTTPBearer(auto_error=False)
+
+# Chave da equipe de operações: acesso aos dados de todos os inquilinos (header X-Ops-Key)
+OPS_API_KEY = os.getenv("OPS_API_KEY", "")
+
+async def get_ops_access(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
+    x_ops_key: Optional[str] = Header(default=None)
+) -> dict:
+    """
+    Libera as rotas de operação para a chave OPS_API_KEY (visão global)
+    ou para administradores autenticados (visão restrita ao próprio inquilino).
+    """
+    if OPS_API_KEY and x_ops_key and hmac.compare_digest(x_ops_key, OPS_API_KEY):
+        return {"tenant_id": None, "global": True}
+
+    payload = auth_service.validar_token(credentials.credentials) if credentials else None
+    if not payload:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token inválido ou expirado",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if payload.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Apenas administradores podem acessar dados de operação.")
+    return {"tenant_id": payload.get("tenant_id"), "global": False}
+
+@router.get("/metrics")
+async def get_metrics(access: dict = Depends(get_ops_access)):
+    """Contadores do processo (ex.: chamadas ao LLM economizadas por coalescência)."""
+    return metrics.snapshot()
+
+@router.get("/usage")
+async def get_usage(
+    tenant_id: Optional[int] = Query(default=None, description="Filtra um inquilino (apenas com X-Ops-Key)"),
+    day_from: Optional[date] = Query(default=None),
+    day_to: Optional[date] = Query(default=None),
+    access: dict = Depends(get_ops_access)
+):
+    """Consumo de LLM (chamadas, tokens e latência média) agregado por inquilino, dia e modelo."""
+    if not access["global"]:
+        tenant_id = access["tenant_id"]
+    return await usage_service.usage_report(tenant_id=tenant_id, day_from=day_from, day_to=day_to)
@@ -1,14 +1,34 @@
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import APIRouter, HTTPException, Depends, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from service import auth_service, llm_service, prompt_template_service
-from db.database import SessionLocal
-from db.models import Tenant, Prompt
+from service.llm_gateway import provider_of
+from service import model_router, usage_service, rate_limit_service, quota_service, history_service, history_writer, tenant_cache, analytics_service
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import AsyncSessionLocal, get_db, get_async_db
+from db.models import Prompt
 from datetime import datetime, date
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
+from sqlalchemy import select
+from core.utils import sse_event, SSE_HEADERS, normalize_text
+from core.singleflight import SingleFlight
+from core import metrics
+from cachetools import TTLCache
+import os
+import math
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Geração em lote: gerações simultâneas por inquilino e tamanho máximo do lote
+GENERATION_BATCH_CONCURRENCY = int(os.getenv("GENERATION_BATCH_CONCURRENCY", "8"))
+GENERATION_BATCH_MAX_ITEMS = int(os.getenv("GENERATION_BATCH_MAX_ITEMS", "50"))
+# Semáforos de lote de inquilinos sem lote recente são descartados após este tempo (s)
+GENERATION_BATCH_SEMAPHORE_TTL = int(os.getenv("GENERATION_BATCH_SEMAPHORE_TTL", "3600"))
+
 def parse_date(val):
     if not val:
         return datetime.utcnow()
@@ -28,7 +48,15 @@ def parse_date(val):
 router = APIRouter(prefix="/prompt", tags=["Prompt Hub"])
 security = HTTPBearer()
 
-def get_current_user_data(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# Coalescência de gerações idênticas em andamento no mesmo inquilino
+_generation_flight = SingleFlight("prompt_generation")
+_generation_stream_flight = SingleFlight("prompt_generation_stream")
+
+# Limite de gerações simultâneas por inquilino nos lotes (compartilhado entre requisições);
+# limitado em tamanho e renovado a cada uso, para não crescer com cada inquilino já visto
+_batch_semaphores = TTLCache(maxsize=int(os.getenv("GENERATION_BATCH_SEMAPHORES", "4096")), ttl=GENERATION_BATCH_SEMAPHORE_TTL)
+
+async def get_current_user_data(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = auth_service.validar_token(token)
     if not payload:
@@ -47,12 +75,84 @@ class FeedbackRequest(BaseModel):
     prompt_id: int
     value: int = Field(..., ge=-1, le=1)
 
+class LoteRequest(BaseModel):
+    temas: List[str] = Field(..., min_length=1, max_length=GENERATION_BATCH_MAX_ITEMS, description="Temas a gerar no lote")
+    stream: bool = Field(default=False, description="Envia cada resultado por SSE assim que fica pronto")
+
 @router.get("/")
 async def raiz():
     return "Gerador de conteúdo via LLM API rodando!"
 
+async def _verificar_quota(db, tenant_id: int, quantidade: int = 1) -> tenant_cache.TenantInfo:
+    """
+    Valida a organização e o limite diário de prompts para `quantidade` novas gerações.
+    Levanta HTTPException se excedido.
+    """
+    tenant = await tenant_cache.aget(db, tenant_id)
+    if not tenant:
+        raise HTTPException(status_code=404, detail="Organização não encontrada.")
+
+    # Taxa de chamadas ao LLM do plano (token bucket por inquilino); um lote custa uma chamada por item
+    max_lote = rate_limit_service.max_batch(tenant.subscription_tier)
+    if max_lote is not None and quantidade > max_lote:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"O lote excede o máximo do plano: até {max_lote} temas por requisição."
+        )
+    retry_after = rate_limit_service.check(tenant.id, tenant.subscription_tier, cost=quantidade)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Muitas requisições ao LLM para esta organização. Tente novamente em instantes.",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+    # Verificar limites diários (contador do dia no ledger de quota, sem COUNT na tabela de prompts)
+    try:
+        count_hoje = await quota_service.used_today(db, tenant_id, quota_service.PROMPTS)
+    except Exception as query_error:
+        logger.error(f"Erro ao ler o contador diário de prompts: {query_error}")
+        raise HTTPException(status_code=500, detail=f"Erro interno no banco (quota): {query_error}")
+    
+    if count_hoje >= tenant.max_prompts_per_day:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Limite diário de prompts atingido ({tenant.max_prompts_per_day}). Faça upgrade para continuar."
+        )
+    if count_hoje + quantidade > tenant.max_prompts_per_day:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"O lote excede o limite diário de prompts: restam {tenant.max_prompts_per_day - count_hoje} de {tenant.max_prompts_per_day}."
+        )
+
+    # Quota de tokens do plano (em memória; ver usage_service)
+    remaining = await usage_service.remaining_tokens(tenant.id, tenant.subscription_tier)
+    if remaining is not None and remaining <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Limite diário de tokens atingido ({usage_service.token_limit(tenant.subscription_tier)}). Faça upgrade para continuar."
+        )
+    return tenant
+
+
+async def _generation_events(mensagens, model: str, tenant_id: int):
+    """Trechos gerados seguidos do provedor que respondeu, como itens ("token"|"provider", valor)."""
+    meta = {}
+    async for text in llm_service.agerar_resposta_stream(mensagens, meta=meta, model=model, tenant_id=tenant_id):
+        yield "token", text
+    yield "provider", meta.get("provider")
+
+
+def _coalescing_key(tenant_id: int, username: str, tema: str) -> tuple:
+    """
+    Chave de coalescência: (inquilino, usuário, tema normalizado, versão do template).
+    O usuário entra porque o template o cita: o texto gerado para um não serve para outro.
+    """
+    return (tenant_id, username, normalize_text(tema), prompt_template_service.TEMPLATE_VERSION)
+
+
 @router.post("/gerar_conteudo")
-def gerar_prompt(tema: str, user_data: dict = Depends(get_current_user_data)):
+async def gerar_prompt(tema: str, user_data: dict = Depends(get_current_user_data)):
     """
     Gera um conteúdo profissional via LLM.
     Requer token JWT válido no header 'Authorization'.
@@ -60,101 +160,326 @@ def gerar_prompt(tema: str, user_data: dict = Depends(get_current_user_data)):
     username = user_data["username"]
     tenant_id = user_data["tenant_id"]
     
-    db = SessionLocal()
-    try:
-        tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
-        if not tenant:
-            raise HTTPException(status_code=404, detail="Organização não encontrada.")
-            
-        # Verificar limites diários
-        hoje = date.today()
-        hoje_start = datetime.combine(hoje, datetime.min.time())
-        
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.info(f"Verificando limites para tenant {tenant_id}, hoje: {hoje_start}")
-        
+    async with AsyncSessionLocal() as db:
         try:
-            count_hoje = db.query(Prompt).filter(
-                Prompt.tenant_id == tenant_id,
-                Prompt.created_at >= hoje_start
-            ).count()
-        except Exception as query_error:
-            logger.error(f"Erro na query de contagem de prompts: {query_error}")
-            import traceback
-            logger.error(traceback.format_exc())
-            raise HTTPException(status_code=500, detail=f"Erro interno no banco (datas): {query_error}")
+            tenant = await _verificar_quota(db, tenant_id)
+            route = model_router.route("generation", tema, tenant_id=tenant_id, subscription_tier=tenant.subscription_tier)
+            # Devolve a conexão ao pool durante a chamada ao LLM
+            await db.close()
+
+            # Formata o prompt com o template
+            mensagens = prompt_template_service.format_prompt(tema=tema, usuario=username)
         
-        if count_hoje >= tenant.max_prompts_per_day:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail=f"Limite diário de prompts atingido ({tenant.max_prompts_per_day}). Faça upgrade para continuar."
+            # O llm_service processa o template e retorna a resposta
+            # Seguidores aguardam a geração do líder, mas cada um grava seu próprio Prompt
+            resposta_bruta, shared = await _generation_flight.do(
+                _coalescing_key(tenant_id, username, tema), lambda: llm_service.agerar_resposta(mensagens, model=route.model, tenant_id=tenant_id)
             )
+            if shared:
+                metrics.incr("llm.calls_saved")
+            resposta_texto = resposta_bruta.content if hasattr(resposta_bruta, 'content') else str(resposta_bruta)
 
-        # Formata o prompt com o template
-        mensagens = prompt_template_service.format_prompt(tema=tema, usuario=username)
+            # Salvar no histórico (gravação em lote; o id já é definitivo)
+            prompt_id = await history_writer.add(
+                _novo_prompt(username, tenant_id, tema, mensagens, resposta_texto), quota_service.PROMPTS
+            )
         
-        # O llm_service processa o template e retorna a resposta
-        resposta_bruta = llm_service.gerar_resposta(mensagens)
-        resposta_texto = resposta_bruta.content if hasattr(resposta_bruta, 'content') else str(resposta_bruta)
-
-        # Salvar no histórico
-        novo_prompt = Prompt(
-            usuario=username,
-            tenant_id=tenant_id,
-            tema=tema,
-            prompt=str(mensagens), # Simplificado
-            resposta=resposta_texto
+            return {
+                "status": "sucesso",
+                "prompt_id": prompt_id,
+                "usuario": username,
+                "tenant_id": tenant_id,
+                "tema": tema,
+                "conteudo_gerado": resposta_texto,
+                "provider": provider_of(resposta_bruta),
+                "model": route.model
+            }
+        except HTTPException:
+            raise
+        except Exception as e:
+            await db.rollback()
+            raise HTTPException(status_code=500, detail=f"Erro ao processar prompt: {e}")
+
+
+@router.post("/gerar_conteudo/stream")
+async def gerar_prompt_stream(tema: str, user_data: dict = Depends(get_current_user_data)):
+    """
+    Versão em Server-Sent Events do /gerar_conteudo.
+    Eventos: `token` (cada trecho do conteúdo), `done` (prompt_id final e provedor) ou `error`.
+    """
+    username = user_data["username"]
+    tenant_id = user_data["tenant_id"]
+
+    # A quota é verificada antes de abrir o stream para responder 403/404 normalmente
+    async with AsyncSessionLocal() as db:
+        tenant = await _verificar_quota(db, tenant_id)
+    route = model_router.route("generation", tema, tenant_id=tenant_id, subscription_tier=tenant.subscription_tier)
+
+    mensagens = prompt_template_service.format_prompt(tema=tema, usuario=username)
+
+    async def event_stream():
+        chunks, shared = _generation_stream_flight.stream(
+            _coalescing_key(tenant_id, username, tema), lambda: _generation_events(mensagens, route.model, tenant_id)
         )
-        db.add(novo_prompt)
-        db.commit()
-        
+        if shared:
+            metrics.incr("llm.calls_saved")
+
+        parts = []
+        provider = None
+        try:
+            async for kind, value in chunks:
+                if kind == "provider":
+                    provider = value
+                    continue
+                parts.append(value)
+                yield sse_event("token", {"text": value})
+        except Exception as e:
+            logger.exception(f"Erro no stream de /gerar_conteudo: {e}")
+            yield sse_event("error", {"detail": f"Erro ao processar prompt: {e}"})
+            return
+
+        try:
+            prompt_id = await history_writer.add(
+                _novo_prompt(username, tenant_id, tema, mensagens, "".join(parts)), quota_service.PROMPTS
+            )
+        except Exception as e:
+            logger.error(f"Erro ao salvar prompt em stream: {e}")
+            prompt_id = -1
+        yield sse_event("done", {"prompt_id": prompt_id, "tema": tema, "provider": provider, "model": route.model})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def _batch_semaphore(tenant_id: int) -> asyncio.Semaphore:
+    semaphore = _batch_semaphores.get(tenant_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(GENERATION_BATCH_CONCURRENCY)
+    # Reinsere para renovar o TTL: um semáforo em uso não expira no meio do lote
+    _batch_semaphores[tenant_id] = semaphore
+    return semaphore
+
+
+async def _gerar_item_lote(indice: int, tema: str, username: str, tenant_id: int, model: str, reserva: quota_service.Reservation):
+    """
+    Gera um item do lote sob o limite de concorrência do inquilino e o grava (e conta na quota)
+    assim que termina: um cliente que desconecta no meio do lote não descarta o que já foi gerado.
+    A vaga do item em `reserva` é liberada ao final, gravado ou não.
+    Retorna o resultado do item, com `prompt_id`; em caso de falha o erro vai no resultado.
+    """
+    try:
+        return await _gerar_e_gravar_item(indice, tema, username, tenant_id, model)
+    finally:
+        # Gravado, o item já conta no pendente do history_writer; falho ou cancelado, não conta
+        reserva.release()
+
+
+async def _gerar_e_gravar_item(indice: int, tema: str, username: str, tenant_id: int, model: str):
+    mensagens = prompt_template_service.format_prompt(tema=tema, usuario=username)
+
+    async def gerar():
+        async with _batch_semaphore(tenant_id):
+            return await llm_service.agerar_resposta(mensagens, model=model, tenant_id=tenant_id)
+
+    try:
+        # Temas repetidos no lote (ou já em andamento) compartilham a mesma chamada sem ocupar vaga
+        resposta_bruta, shared = await _generation_flight.do(_coalescing_key(tenant_id, username, tema), gerar)
+    except Exception as e:
+        logger.error(f"Erro ao gerar item {indice} do lote: {e}")
+        metrics.incr("prompt.batch.errors")
+        return {"indice": indice, "tema": tema, "status": "erro", "detail": f"Erro ao processar prompt: {e}"}
+
+    if shared:
+        metrics.incr("llm.calls_saved")
+    resposta_texto = resposta_bruta.content if hasattr(resposta_bruta, 'content') else str(resposta_bruta)
+    # shield: o cancelamento da requisição não interrompe a gravação de um item já gerado
+    prompt_id = await asyncio.shield(history_writer.add(
+        _novo_prompt(username, tenant_id, tema, mensagens, resposta_texto), quota_service.PROMPTS
+    ))
+    return {
+        "indice": indice,
+        "tema": tema,
+        "status": "sucesso",
+        "conteudo_gerado": resposta_texto,
+        "provider": provider_of(resposta_bruta),
+        "model": model,
+        "prompt_id": prompt_id
+    }
+
+
+@router.post("/gerar_lote")
+async def gerar_lote(payload: LoteRequest, user_data: dict = Depends(get_current_user_data)):
+    """
+    Gera conteúdo para vários temas de uma vez.
+    A quota é verificada uma vez para o lote inteiro; as gerações rodam em paralelo limitadas
+    por GENERATION_BATCH_CONCURRENCY por inquilino e cada Prompt é gravado assim que fica pronto.
+    Com `stream=true`, responde em SSE: `result` a cada item concluído (em ordem de término) e
+    `done` com os prompt_ids por índice; caso contrário devolve os resultados na ordem dos temas.
+    """
+    username = user_data["username"]
+    tenant_id = user_data["tenant_id"]
+    temas = payload.temas
+
+    async with AsyncSessionLocal() as db:
+        tenant = await _verificar_quota(db, tenant_id, quantidade=len(temas))
+        # Reserva o lote inteiro na quota antes de gerar: lotes simultâneos não passam juntos do limite diário
+        reserva = await quota_service.reserve(db, tenant_id, quota_service.PROMPTS, len(temas), tenant.max_prompts_per_day)
+    if reserva is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"O lote excede o limite diário de prompts ({tenant.max_prompts_per_day}) somado às gerações em andamento."
+        )
+    # Um único roteamento para o lote: todos os itens são tarefas de geração
+    route = model_router.route("generation", temas[0], tenant_id=tenant_id, subscription_tier=tenant.subscription_tier)
+    metrics.observe("prompt.batch.size", len(temas))
+
+    tarefas = [
+        asyncio.ensure_future(_gerar_item_lote(i, tema, username, tenant_id, route.model, reserva))
+        for i, tema in enumerate(temas)
+    ]
+
+    if not payload.stream:
+        try:
+            resultados = await asyncio.gather(*tarefas)
+        except BaseException as e:
+            for tarefa in tarefas:
+                tarefa.cancel()
+            if not isinstance(e, Exception):
+                raise
+            logger.error(f"Erro ao processar lote: {e}")
+            raise HTTPException(status_code=500, detail=f"Erro ao processar lote: {e}")
+        finally:
+            # Itens cancelados antes de começar não liberam a própria vaga
+            reserva.release_all()
         return {
             "status": "sucesso",
-            "prompt_id": novo_prompt.id,
             "usuario": username,
             "tenant_id": tenant_id,
-            "tema": tema,
-            "conteudo_gerado": resposta_texto
+            "model": route.model,
+            "total": len(temas),
+            "falhas": sum(1 for r in resultados if r["status"] != "sucesso"),
+            "resultados": resultados
         }
-    except HTTPException:
-        raise
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Erro ao processar prompt: {e}")
-    finally:
-        db.close()
+
+    async def event_stream():
+        prompt_ids = {}
+        try:
+            for proxima in asyncio.as_completed(tarefas):
+                resultado = await proxima
+                if resultado["status"] == "sucesso":
+                    prompt_ids[resultado["indice"]] = resultado["prompt_id"]
+                yield sse_event("result", resultado)
+        finally:
+            # Cliente desconectou no meio do lote: não deixa gerações órfãs rodando
+            # (os itens já concluídos foram gravados por _gerar_item_lote)
+            for tarefa in tarefas:
+                tarefa.cancel()
+            # Itens cancelados antes de começar não liberam a própria vaga
+            reserva.release_all()
+
+        yield sse_event("done", {
+            "total": len(temas),
+            "falhas": len(temas) - len(prompt_ids),
+            "prompt_ids": prompt_ids,
+            "model": route.model
+        })
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 @router.get("/historico")
-def get_historico(user_data: dict = Depends(get_current_user_data)):
-    """Retorna o histórico de prompts gerados pelo usuário atual dentro de seu inquilino."""
-    db = SessionLocal()
+async def get_historico(
+    page_size: int = Query(default=20, ge=1, le=history_service.HISTORY_MAX_PAGE_SIZE, description="Itens por página"),
+    cursor: Optional[str] = Query(default=None, description="Cursor retornado pela página anterior"),
+    date_from: Optional[date] = Query(default=None, description="Data inicial (inclusive)"),
+    date_to: Optional[date] = Query(default=None, description="Data final (inclusive)"),
+    feedback: Optional[int] = Query(default=None, ge=-1, le=1, description="Filtra pelo feedback (-1, 0, 1)"),
+    usuario: Optional[str] = Query(default=None, description="Filtra por usuário (apenas administradores)"),
+    view: Literal["full", "summary"] = Query(default="full", description="summary: só id, tema, feedback e data"),
+    user_data: dict = Depends(get_current_user_data),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Histórico de prompts do inquilino, paginado por cursor (mais recentes primeiro).
+    Membros veem só os próprios prompts; administradores veem todos e podem filtrar por usuário.
+    Com `view=summary` o conteúdo não é carregado (ver /historico/{prompt_id}).
+    """
+    if user_data["role"] != "admin":
+        usuario = user_data["username"]
+    # Inclui os prompts ainda na fila de gravação
+    await history_writer.flush()
+
+    if view == "summary":
+        columns = [Prompt.id, Prompt.usuario, Prompt.tema, Prompt.feedback, Prompt.created_at]
+    else:
+        columns = [Prompt]
     try:
-        tenant_id = user_data["tenant_id"]
-        username = user_data["username"]
-        role = user_data["role"]
-        
-        query = db.query(Prompt).filter(Prompt.tenant_id == tenant_id)
-        if role != "admin":
-            query = query.filter(Prompt.usuario == username)
-            
-        prompts = query.order_by(Prompt.created_at.desc()).limit(100).all()
-        return [
+        query = history_service.build_query(
+            Prompt, columns, user_data["tenant_id"], usuario=usuario, date_from=date_from, date_to=date_to,
+            feedback=feedback, cursor=cursor, page_size=page_size
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if view == "summary":
+        rows, next_cursor = history_service.split_page((await db.execute(query)).all(), page_size)
+        items = [
             {
                 "id": p.id,
                 "usuario": p.usuario,
                 "tema": p.tema,
-                "conteudo": p.resposta,
                 "feedback": p.feedback,
                 "created_at": parse_date(p.created_at).isoformat()
             }
-            for p in prompts
+            for p in rows
         ]
-    finally:
-        db.close()
+    else:
+        rows, next_cursor = history_service.split_page((await db.scalars(query)).all(), page_size)
+        items = [_prompt_to_dict(p) for p in rows]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@router.get("/historico/{prompt_id}")
+async def get_prompt_detail(prompt_id: int, user_data: dict = Depends(get_current_user_data), db: AsyncSession = Depends(get_async_db)):
+    """Conteúdo completo de um prompt do histórico, com o prompt enviado ao LLM refeito a partir do template."""
+    await history_writer.flush()
+    query = select(Prompt).where(Prompt.id == prompt_id, Prompt.tenant_id == user_data["tenant_id"])
+    if user_data["role"] != "admin":
+        query = query.where(Prompt.usuario == user_data["username"])
+    p = await db.scalar(query)
+    if not p:
+        raise HTTPException(status_code=404, detail="Prompt não encontrado.")
+    return {**_prompt_to_dict(p), "prompt": await prompt_template_service.rebuild_prompt(db, p)}
+
+
+def _novo_prompt(username: str, tenant_id: int, tema: str, mensagens, resposta: str) -> Prompt:
+    """Prompt a gravar: referencia a versão do template (tema e usuário bastam para refazer o texto)."""
+    template_id = prompt_template_service.current_template_id()
+    return Prompt(
+        usuario=username,
+        tenant_id=tenant_id,
+        tema=tema,
+        template_id=template_id,
+        # Sem template registrado (ex.: startup não executado), grava o texto como antes
+        prompt=None if template_id else str(mensagens),
+        resposta=resposta
+    )
+
+
+def _prompt_to_dict(p: Prompt) -> dict:
+    return {
+        "id": p.id,
+        "usuario": p.usuario,
+        "tema": p.tema,
+        "conteudo": p.resposta,
+        "feedback": p.feedback,
+        "created_at": parse_date(p.created_at).isoformat()
+    }
 
 @router.post("/feedback")
-def save_feedback(payload: FeedbackRequest, user_data: dict = Depends(get_current_user_data)):
-    db = SessionLocal()
+def save_feedback(payload: FeedbackRequest, user_data: dict = Depends(get_current_user_data), db: Session = Depends(get_db)):
+    # Prompt ainda na fila de gravação: o feedback vai junto com a linha
+    if history_writer.apply_feedback(Prompt, payload.prompt_id, user_data["tenant_id"], payload.value):
+        return {"status": "sucesso", "mensagem": "Feedback salvo."}
     try:
         p = db.query(Prompt).filter(
             Prompt.id == payload.prompt_id,
@@ -162,14 +487,20 @@ def save_feedback(payload: FeedbackRequest, user_data: dict = Depends(get_curren
         ).first()
         
         if not p:
+            # Pode estar na fila de gravação de outro worker: guarda o feedback para quando chegar ao banco
+            if history_writer.defer_feedback(db, Prompt, payload.prompt_id, user_data["tenant_id"], payload.value):
+                return {"status": "sucesso", "mensagem": "Feedback salvo."}
             raise HTTPException(status_code=404, detail="Prompt não encontrado.")
             
-        p.feedback = payload.value
+        # UPDATE condicional: dois feedbacks simultâneos não movem o rollup a partir do mesmo valor
+        if not analytics_service.change_feedback(db, quota_service.PROMPTS, p, payload.value):
+            db.rollback()
+            raise HTTPException(status_code=409, detail="Feedback alterado ao mesmo tempo por outra requisição. Tente novamente.")
         db.commit()
         return {"status": "sucesso", "mensagem": "Feedback salvo."}
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         logger.error(f"Erro ao salvar feedback Prompt: {e}")
         raise HTTPException(status_code=500, detail="Erro interno ao salvar feedback.")
-    finally:
-        db.close()
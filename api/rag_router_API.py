@@ -1,22 +1,32 @@
-from fastapi import APIRouter, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, HTTPException, status, UploadFile, File, Query
 import json
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Literal, Optional
 import logging
 import os
 import shutil
+import math
 
-from service.search_service import similarity_search, init_search
-from service.rag_chain_service import ask_rag
+from service.search_service import similarity_search, init_search, paginated_search, run_in_retrieval_pool, store_versions
+from service.rag_chain_service import aask_rag, astream_rag
+from service.llm_gateway import provider_of
+from service import model_router, usage_service, rate_limit_service, quota_service, history_service, history_writer, tenant_cache, analytics_service
+from service.context_service import build_context
 from service.auth_service import validar_token
 from fastapi import Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from db.database import SessionLocal
+from sqlalchemy import select, func, update
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import AsyncSessionLocal, get_db, get_async_db
 from db.models import Tenant, ChatMessage
-from core.utils import slugify, get_tenant_path
+from core.utils import slugify, get_tenant_path, sse_event, SSE_HEADERS, normalize_text
+from core.singleflight import SingleFlight
+from core import metrics
 import glob
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
@@ -40,7 +50,12 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/rag", tags=["RAG Hub"])
 security = HTTPBearer()
 
-def get_current_user_data(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# Coalescência de perguntas idênticas em andamento (ex.: comunicados para a empresa toda)
+_retrieval_flight = SingleFlight("rag_retrieval")
+_answer_flight = SingleFlight("rag_answer")
+_answer_stream_flight = SingleFlight("rag_answer_stream")
+
+async def get_current_user_data(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = validar_token(token)
     if not payload:
@@ -59,9 +74,43 @@ def get_current_user_data(credentials: HTTPAuthorizationCredentials = Depends(se
 # MODELS
 # =========================
 
+SearchScope = Literal["user", "tenant", "global"]
+
+class SearchFilters(BaseModel):
+    sources: Optional[List[str]] = Field(default=None, description="Nomes dos arquivos PDF a considerar")
+    page_from: Optional[int] = Field(default=None, ge=1, description="Página inicial (inclusive)")
+    page_to: Optional[int] = Field(default=None, ge=1, description="Página final (inclusive)")
+    uploaded_from: Optional[date] = Field(default=None, description="Data de upload inicial (inclusive)")
+    uploaded_to: Optional[date] = Field(default=None, description="Data de upload final (inclusive)")
+
+    def to_service(self) -> dict:
+        """Converte para o formato do search_service (datas viram intervalo [início, fim))."""
+        return {
+            "sources": self.sources,
+            "page_from": self.page_from,
+            "page_to": self.page_to,
+            "uploaded_from": datetime.combine(self.uploaded_from, datetime.min.time()) if self.uploaded_from else None,
+            "uploaded_to": datetime.combine(self.uploaded_to + timedelta(days=1), datetime.min.time()) if self.uploaded_to else None,
+        }
+
+def get_search_filters(
+    sources: Optional[List[str]] = Query(default=None),
+    page_from: Optional[int] = Query(default=None, ge=1),
+    page_to: Optional[int] = Query(default=None, ge=1),
+    uploaded_from: Optional[date] = Query(default=None),
+    uploaded_to: Optional[date] = Query(default=None),
+) -> SearchFilters:
+    """Filtros de metadados via query string (GET /search)."""
+    return SearchFilters(
+        sources=sources, page_from=page_from, page_to=page_to,
+        uploaded_from=uploaded_from, uploaded_to=uploaded_to
+    )
+
 class SearchRequest(BaseModel):
     question: str = Field(..., min_length=1, description="Pergunta a ser buscada na base")
     k: int = Field(default=4, ge=1, le=10, description="Número de documentos a retornar")
+    scopes: List[SearchScope] = Field(default=["user"], min_length=1, description="Bases consultadas em paralelo (user, tenant, global)")
+    filters: Optional[SearchFilters] = Field(default=None, description="Filtros de arquivo, página e data aplicados dentro do índice")
 
 class AskRequest(SearchRequest):
     score_threshold: float = Field(
@@ -79,6 +128,7 @@ class SearchResult(BaseModel):
     score: float
     source: str = Field(default="desconhecido", description="Nome do arquivo de origem")
     page: int = Field(default=0, description="Número da página original")
+    scope: str = Field(default="user", description="Base de origem do fragmento (user, tenant, global)")
 
 def extrair_titulo_contextual(texto: str) -> str:
     """Extrai um título curto do início do fragmento."""
@@ -91,12 +141,15 @@ def extrair_titulo_contextual(texto: str) -> str:
 class SearchResponse(BaseModel):
     query: str
     results: List[SearchResult]
+    next_cursor: Optional[str] = Field(default=None, description="Cursor opaco para a próxima página (None = fim)")
 
 class AskResponse(BaseModel):
     message_id: int
     question: str
     answer: str
     sources: List[SearchResult]
+    provider: Optional[str] = Field(default=None, description="Provedor LLM que respondeu (groq, ollama)")
+    model: Optional[str] = Field(default=None, description="Modelo escolhido pelo roteamento por complexidade")
 
 
 # Removed local get_tenant_dir in favor of core.utils.get_tenant_path
@@ -109,10 +162,13 @@ class AskResponse(BaseModel):
 def health_custom():
     return {"status": "I AM LIVE AND RELOADED"}
 
+# Endpoint síncrono de propósito: cópia do arquivo, sessão do banco e reindexação (embeddings/OCR)
+# são bloqueantes e rodam no pool de threads, sem travar as perguntas e streams no event loop
 @router.post("/upload")
-async def upload_document(
+def upload_document(
     file: UploadFile = File(...),
-    user_data: dict = Depends(get_current_user_data)
+    user_data: dict = Depends(get_current_user_data),
+    db: Session = Depends(get_db)
 ):
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Apenas arquivos PDF são permitidos.")
@@ -123,13 +179,12 @@ async def upload_document(
     if not tenant_id or not username:
         raise HTTPException(status_code=401, detail="Usuário ou Organização não identificados no token.")
 
-    db = SessionLocal()
     try:
-        tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
+        tenant = tenant_cache.get(db, tenant_id)
         if not tenant:
             raise HTTPException(status_code=404, detail="Organização não encontrada.")
             
-        # Verificar limites
+        # Verificar limites (rejeição rápida pelo cache; o limite é garantido no UPDATE abaixo)
         if tenant.current_document_count >= tenant.max_documents:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN, 
@@ -139,7 +194,7 @@ async def upload_document(
         # Pasta privada do usuário dentro do inquilino
         tid_str = str(tenant_id)
         usr_str = str(username)
-        tenant_upload_dir = os.path.join(get_tenant_path(tenant_id, tenant.name), usr_str)
+        tenant_upload_dir = os.path.join(tenant.storage_path, usr_str)
         
         logger.info(f"--- UPLOAD DEBUG ---")
         logger.info(f"User Data: {user_data}")
@@ -153,8 +208,20 @@ async def upload_document(
         with open(upload_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
         
-        # Atualizar contagem no banco
-        tenant.current_document_count += 1
+        # Atualizar contagem no banco: incremento atômico, só se ainda houver espaço no plano
+        incrementado = db.execute(
+            update(Tenant)
+            .where(Tenant.id == tenant_id, Tenant.current_document_count < Tenant.max_documents)
+            .values(current_document_count=Tenant.current_document_count + 1)
+        ).rowcount
+        if not incrementado:
+            db.rollback()
+            os.remove(upload_path)
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Limite de documentos atingido ({tenant.max_documents}). Faça upgrade do seu plano."
+            )
+        tenant_cache.invalidate(db, tenant_id)
         db.commit()
         
         # Força o recarregamento da base de busca privada do usuário
@@ -167,27 +234,38 @@ async def upload_document(
         db.rollback()
         logger.error(f"Erro no upload: {e}")
         raise HTTPException(status_code=500, detail=f"Erro ao processar arquivo: {e}")
-    finally:
-        db.close()
 
 @router.get("/search", response_model=SearchResponse)
-def search(msg: str, k: int, user_data: dict = Depends(get_current_user_data)):
+async def search(
+    msg: str,
+    k: int = Query(default=4, ge=1, le=10, description="Tamanho da página"),
+    cursor: Optional[str] = Query(default=None, description="Cursor retornado pela página anterior"),
+    scopes: List[SearchScope] = Query(default=["user"]),
+    filters: SearchFilters = Depends(get_search_filters),
+    user_data: dict = Depends(get_current_user_data)
+):
     try:
         tenant_id = user_data["tenant_id"]
         username = user_data["username"]
-        # include_global defaults to False, ensuring strict isolation
-        results_raw = similarity_search(query=msg, tenant_id=tenant_id, username=username, k=k, include_global=False)
+        # Padrão apenas "user", garantindo isolamento estrito; escopos extras são opt-in
+        results_raw, next_cursor = await run_in_retrieval_pool(
+            paginated_search, query=msg, tenant_id=tenant_id, username=username, page_size=k,
+            cursor=cursor, scopes=scopes, filters=filters.to_service()
+        )
         results = [
             SearchResult(
                 title=extrair_titulo_contextual(d["content"]),
                 content=d["content"].replace('\n', ' ').strip(), 
                 score=d["score"],
                 source=os.path.basename(d.get("source", "desconhecido")).replace("_ocr.pdf", ".pdf"),
-                page=int(d.get("page", 0)) + 1
+                page=int(d.get("page", 0)) + 1,
+                scope=d.get("scope", "user")
             ) 
             for d in results_raw
         ]
-        return SearchResponse(query=msg, results=results)
+        return SearchResponse(query=msg, results=results, next_cursor=next_cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.exception(f"Erro em /search: {e}")
         raise HTTPException(
@@ -196,97 +274,177 @@ def search(msg: str, k: int, user_data: dict = Depends(get_current_user_data)):
         )
 
 
-@router.post("/ask_prompt", response_model=AskResponse)
-def ask(payload: AskRequest, user_data: dict = Depends(get_current_user_data)):
-    try:
-        tenant_id = user_data["tenant_id"]
-        username = user_data["username"]
-        
-        # Busca isolada por usuário (include_global=False por padrão)
-        docs_raw = similarity_search(query=payload.question, tenant_id=tenant_id, username=username, k=payload.k, include_global=False)
+def _retrieve_for_question(payload: AskRequest, user_data: dict, tenant: tenant_cache.TenantInfo):
+    """
+    Busca + filtragem + escolha do modelo + montagem de contexto compartilhadas pelo /ask_prompt
+    e sua versão em stream. Retorna (docs, context, fallback_answer, route); fallback_answer != None
+    (e route None) quando não há o que perguntar ao LLM.
+    """
+    tenant_id = user_data["tenant_id"]
+    username = user_data["username"]
+
+    # Busca isolada por usuário por padrão; tenant/global apenas se solicitados
+    filters = payload.filters.to_service() if payload.filters else None
+    docs_raw = similarity_search(query=payload.question, tenant_id=tenant_id, username=username, k=payload.k, scopes=payload.scopes, filters=filters)
+
+    if not docs_raw:
+        return [], "", "Base de conhecimento não inicializada ou sem documentos relevantes.", None
+
+    # Filtragem: FAISS retorna DISTÂNCIA → menor é melhor
+    filtered_docs_raw = [d for d in docs_raw if d["score"] <= payload.score_threshold]
+
+    if not filtered_docs_raw:
+        return [], "", "Não encontrei essa informação nos documentos permitidos.", None
+
+    # Monta o contexto no orçamento de tokens do modelo que vai responder: une chunks
+    # sobrepostos, remove quase-duplicados e empacota blocos inteiros por score.
+    # O roteador também pesa o tamanho do contexto: monta no orçamento do modelo indicado
+    # pela pergunta e, se o contexto levar ao modelo grande, remonta no orçamento dele.
+    route = _route_answer(payload, user_data, "", tenant)
+    context, used_docs = build_context(filtered_docs_raw, model=route.model)
+    final_route = _route_answer(payload, user_data, context, tenant)
+    if final_route.model != route.model:
+        context, used_docs = build_context(filtered_docs_raw, model=final_route.model)
+    return used_docs, context, None, final_route
+
+
+def _coalescing_key(payload: AskRequest, user_data: dict) -> str:
+    """
+    Chave de coalescência: inquilino, versão das stores consultadas, pergunta normalizada e k.
+    Escopos, filtros e threshold também entram, pois mudam o resultado.
+    O store "user" é privado, então nesse escopo só coalescem perguntas do mesmo usuário.
+    """
+    return json.dumps([
+        user_data["tenant_id"],
+        store_versions(payload.scopes, tenant_id=user_data["tenant_id"], username=user_data["username"]),
+        normalize_text(payload.question),
+        payload.k,
+        sorted(set(payload.scopes)),
+        payload.filters.to_service() if payload.filters else None,
+        payload.score_threshold,
+    ], sort_keys=True, default=str)
+
+
+async def _coalesced_retrieval(payload: AskRequest, user_data: dict, key: str, tenant: tenant_cache.TenantInfo):
+    """Busca + contexto compartilhados entre requisições idênticas em andamento."""
+    # Busca e montagem de contexto são CPU: rodam no pool de recuperação
+    result, _ = await _retrieval_flight.do(
+        key, lambda: run_in_retrieval_pool(_retrieve_for_question, payload, user_data, tenant)
+    )
+    return result
 
-        if not docs_raw:
-            return AskResponse(
-                message_id=-1,
-                question=payload.question,
-                answer="Base de conhecimento não inicializada ou sem documentos relevantes.",
-                sources=[]
+
+async def _verificar_quota_tokens(user_data: dict) -> tenant_cache.TenantInfo:
+    """Checagens baratas (em memória ou uma linha do ledger) de taxa, perguntas e tokens do dia, antes de qualquer trabalho."""
+    async with AsyncSessionLocal() as db:
+        tenant = await tenant_cache.aget(db, user_data["tenant_id"])
+        if not tenant:
+            raise HTTPException(status_code=404, detail="Organização não encontrada.")
+        # Perguntas por dia, quando o plano limita (contador do ledger de quota)
+        limite = quota_service.daily_limit(tenant, quota_service.RAG_QUESTIONS)
+        if limite is not None and await quota_service.used_today(db, tenant.id, quota_service.RAG_QUESTIONS) >= limite:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Limite diário de perguntas atingido ({limite}). Faça upgrade para continuar."
             )
+    retry_after = rate_limit_service.check(tenant.id, tenant.subscription_tier)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Muitas requisições ao LLM para esta organização. Tente novamente em instantes.",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    remaining = await usage_service.remaining_tokens(tenant.id, tenant.subscription_tier)
+    if remaining is not None and remaining <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Limite diário de tokens atingido ({usage_service.token_limit(tenant.subscription_tier)}). Faça upgrade para continuar."
+        )
+    return tenant
+
+
+def _route_answer(payload: AskRequest, user_data: dict, context: str, tenant: tenant_cache.TenantInfo) -> model_router.Route:
+    """Escolhe o tier de modelo para a resposta (pergunta, contexto, inquilino e plano)."""
+    return model_router.route(
+        "rag", payload.question, context,
+        tenant_id=user_data["tenant_id"],
+        subscription_tier=tenant.subscription_tier if tenant else None
+    )
+
+
+async def _answer_events(context: str, question: str, model: str, tenant_id: int):
+    """Trechos da resposta seguidos do provedor que respondeu, como itens ("token"|"provider", valor)."""
+    meta = {}
+    async for text in astream_rag(context=context, question=question, meta=meta, model=model, tenant_id=tenant_id):
+        yield "token", text
+    yield "provider", meta.get("provider")
+
+
+def _to_sources(docs: list) -> List[SearchResult]:
+    return [
+        SearchResult(
+            title=extrair_titulo_contextual(d["content"]),
+            content=d["content"], 
+            score=d["score"],
+            source=os.path.basename(d.get("source", "desconhecido")).replace("_ocr.pdf", ".pdf"),
+            page=int(d.get("page", 0)) + 1,
+            scope=d.get("scope", "user")
+        ) 
+        for d in docs
+    ]
 
-        # Filtragem: FAISS retorna DISTÂNCIA → menor é melhor
-        filtered_docs_raw = [d for d in docs_raw if d["score"] <= payload.score_threshold]
 
-        if not filtered_docs_raw:
+async def _save_chat_message(user_data: dict, question: str, answer: str, docs: list) -> int:
+    """Enfileira a interação no histórico de chat (gravação em lote). Retorna o id ou -1 em caso de falha."""
+    try:
+        new_chat = ChatMessage(
+            usuario=user_data["username"],
+            tenant_id=user_data["tenant_id"],
+            pergunta=question,
+            resposta=answer
+        )
+        return await history_writer.add(new_chat, quota_service.RAG_QUESTIONS, docs=docs)
+    except Exception as e:
+        logger.error(f"Erro ao salvar histórico de chat: {e}")
+        return -1
+
+
+@router.post("/ask_prompt", response_model=AskResponse)
+async def ask(payload: AskRequest, user_data: dict = Depends(get_current_user_data)):
+    try:
+        tenant = await _verificar_quota_tokens(user_data)
+        key = _coalescing_key(payload, user_data)
+        filtered_docs_raw, context, fallback, route = await _coalesced_retrieval(payload, user_data, key, tenant)
+        if fallback:
             return AskResponse(
                 message_id=-1,
                 question=payload.question,
-                answer="Não encontrei essa informação nos documentos permitidos.",
+                answer=fallback,
                 sources=[]
             )
 
-        # Limite máximo para contexto
-        MAX_DOCS = 5
-        filtered_docs_raw = filtered_docs_raw[:MAX_DOCS]
-
-        formatted_docs = []
-        for d in filtered_docs_raw:
-            source_name = os.path.basename(d.get("source", "desconhecido")).replace("_ocr.pdf", ".pdf")
-            page_num = int(d.get("page", 0)) + 1
-            # Sanitize content to remove hard line breaks that might confuse the LLM
-            clean_content = d['content'].replace('\n', ' ').strip()
-            formatted_docs.append(f"[[FONTE: {source_name}, PÁGINA: {page_num}]]\n{clean_content}")
-
-        context = "\n\n---\n\n".join(formatted_docs)
-        
-        MAX_CONTEXT_CHARS = 4000
-        if len(context) > MAX_CONTEXT_CHARS:
-            context = context[:MAX_CONTEXT_CHARS]
-
-        response = ask_rag(context=context, question=payload.question)
+        # Seguidores aguardam a resposta do líder, mas cada um grava sua própria mensagem
+        response, shared = await _answer_flight.do(key, lambda: aask_rag(
+            context=context, question=payload.question, model=route.model, tenant_id=tenant.id
+        ))
+        if shared:
+            metrics.incr("llm.calls_saved")
+        answer = response if isinstance(response, str) else (response.content if hasattr(response, 'content') else str(response))
 
         # Salva no histórico de chat
-        db = SessionLocal()
-        try:
-            new_chat = ChatMessage(
-                usuario=user_data["username"],
-                tenant_id=tenant_id,
-                pergunta=payload.question,
-                resposta=response.content if hasattr(response, 'content') else str(response),
-                sources=json.dumps([{
-                    "content": d["content"],
-                    "source": os.path.basename(d.get("source", "desconhecido")),
-                    "page": int(d.get("page", 0)) + 1
-                } for d in filtered_docs_raw])
-            )
-            db.add(new_chat)
-            db.commit()
-            db.refresh(new_chat)
-            msg_id = new_chat.id
-        except Exception as e:
-            logger.error(f"Erro ao salvar histórico de chat: {e}")
-            db.rollback()
-            msg_id = -1
-        finally:
-            db.close()
-
-        sources = [
-            SearchResult(
-                title=extrair_titulo_contextual(d["content"]),
-                content=d["content"], 
-                score=d["score"],
-                source=os.path.basename(d.get("source", "desconhecido")).replace("_ocr.pdf", ".pdf"),
-                page=int(d.get("page", 0)) + 1
-            ) 
-            for d in filtered_docs_raw
-        ]
+        msg_id = await _save_chat_message(user_data, payload.question, answer, filtered_docs_raw)
 
         return AskResponse(
             message_id=msg_id,
             question=payload.question,
-            answer=response if isinstance(response, str) else (response.content if hasattr(response, 'content') else str(response)),
-            sources=sources
+            answer=answer,
+            sources=_to_sources(filtered_docs_raw),
+            provider=provider_of(response),
+            model=route.model
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Erro em /ask_prompt: {e}")
         raise HTTPException(
@@ -294,6 +452,57 @@ def ask(payload: AskRequest, user_data: dict = Depends(get_current_user_data)):
             detail="Erro interno ao processar a pergunta."
         )
 
+
+@router.post("/ask_prompt/stream")
+async def ask_stream(payload: AskRequest, user_data: dict = Depends(get_current_user_data)):
+    """
+    Versão em Server-Sent Events do /ask_prompt.
+    Eventos: `sources` (antes da geração), `token` (cada trecho da resposta),
+    `done` (message_id final e provedor) ou `error`.
+    """
+    try:
+        tenant = await _verificar_quota_tokens(user_data)
+        key = _coalescing_key(payload, user_data)
+        filtered_docs_raw, context, fallback, route = await _coalesced_retrieval(payload, user_data, key, tenant)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Erro em /ask_prompt/stream: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Erro interno ao processar a pergunta."
+        )
+
+    async def event_stream():
+        yield sse_event("sources", [s.model_dump() for s in _to_sources(filtered_docs_raw)])
+        if fallback:
+            yield sse_event("token", {"text": fallback})
+            yield sse_event("done", {"message_id": -1})
+            return
+
+        chunks, shared = _answer_stream_flight.stream(key, lambda: _answer_events(context, payload.question, route.model, tenant.id))
+        if shared:
+            metrics.incr("llm.calls_saved")
+
+        parts = []
+        provider = None
+        try:
+            async for kind, value in chunks:
+                if kind == "provider":
+                    provider = value
+                    continue
+                parts.append(value)
+                yield sse_event("token", {"text": value})
+        except Exception as e:
+            logger.exception(f"Erro no stream de /ask_prompt: {e}")
+            yield sse_event("error", {"detail": "Erro interno ao processar a pergunta."})
+            return
+
+        msg_id = await _save_chat_message(user_data, payload.question, "".join(parts), filtered_docs_raw)
+        yield sse_event("done", {"message_id": msg_id, "provider": provider, "model": route.model})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @router.get("/list_files")
 def list_files(user_data: dict = Depends(get_current_user_data)):
     """Lista os arquivos PDF na pasta privada do usuário."""
@@ -318,7 +527,7 @@ def list_files(user_data: dict = Depends(get_current_user_data)):
     return files
 
 @router.delete("/delete_file")
-def delete_file(filename: str, user_data: dict = Depends(get_current_user_data)):
+def delete_file(filename: str, user_data: dict = Depends(get_current_user_data), db: Session = Depends(get_db)):
     """Remove um documento físico e atualiza os contadores e índice."""
     tenant_id = user_data.get("tenant_id")
     username = user_data.get("username")
@@ -333,7 +542,6 @@ def delete_file(filename: str, user_data: dict = Depends(get_current_user_data))
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Arquivo não encontrado.")
 
-    db = SessionLocal()
     try:
         # Remover arquivos físicos
         os.remove(file_path)
@@ -341,10 +549,13 @@ def delete_file(filename: str, user_data: dict = Depends(get_current_user_data))
             os.remove(ocr_path)
 
         # Atualizar banco de dados
-        tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
-        if tenant:
-            tenant.current_document_count = max(0, tenant.current_document_count - 1)
-            db.commit()
+        db.execute(
+            update(Tenant)
+            .where(Tenant.id == tenant_id, Tenant.current_document_count > 0)
+            .values(current_document_count=Tenant.current_document_count - 1)
+        )
+        tenant_cache.invalidate(db, tenant_id)
+        db.commit()
 
         # Recarregar índice FAISS
         init_search(tenant_id=tenant_id, username=username, force_reload=True)
@@ -354,41 +565,95 @@ def delete_file(filename: str, user_data: dict = Depends(get_current_user_data))
         db.rollback()
         logger.error(f"Erro ao deletar arquivo: {e}")
         raise HTTPException(status_code=500, detail=f"Erro interno ao remover arquivo: {e}")
-    finally:
-        db.close()
 
 @router.get("/historico")
-def get_historico(user_data: dict = Depends(get_current_user_data)):
-    """Retorna o histórico de chat do inquilino atual."""
-    db = SessionLocal()
+async def get_historico(
+    page_size: int = Query(default=20, ge=1, le=history_service.HISTORY_MAX_PAGE_SIZE, description="Itens por página"),
+    cursor: Optional[str] = Query(default=None, description="Cursor retornado pela página anterior"),
+    date_from: Optional[date] = Query(default=None, description="Data inicial (inclusive)"),
+    date_to: Optional[date] = Query(default=None, description="Data final (inclusive)"),
+    feedback: Optional[int] = Query(default=None, ge=-1, le=1, description="Filtra pelo feedback (-1, 0, 1)"),
+    usuario: Optional[str] = Query(default=None, description="Filtra por usuário (apenas administradores)"),
+    view: Literal["full", "summary"] = Query(default="full", description="summary: só id, início da pergunta, feedback e data"),
+    user_data: dict = Depends(get_current_user_data),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Histórico de chat do inquilino, paginado por cursor (mais recentes primeiro).
+    Membros veem só as próprias conversas; administradores veem todas e podem filtrar por usuário.
+    Com `view=summary` resposta e fontes não são carregadas; na visão completa as fontes vêm sem
+    o texto dos trechos (ver /historico/{message_id}).
+    """
+    if user_data["role"] != "admin":
+        usuario = user_data["username"]
+    # Inclui as mensagens ainda na fila de gravação
+    await history_writer.flush()
+
+    if view == "summary":
+        columns = [
+            ChatMessage.id, ChatMessage.usuario,
+            func.substr(ChatMessage.pergunta, 1, history_service.SUMMARY_TITLE_CHARS).label("pergunta"),
+            ChatMessage.feedback, ChatMessage.created_at
+        ]
+    else:
+        columns = [ChatMessage]
     try:
-        tenant_id = user_data["tenant_id"]
-        username = user_data["username"]
-        role = user_data["role"]
-        
-        query = db.query(ChatMessage).filter(ChatMessage.tenant_id == tenant_id)
-        if role != "admin":
-            query = query.filter(ChatMessage.usuario == username)
-            
-        messages = query.order_by(ChatMessage.created_at.desc()).limit(100).all()
-        return [
+        query = history_service.build_query(
+            ChatMessage, columns, user_data["tenant_id"], usuario=usuario, date_from=date_from, date_to=date_to,
+            feedback=feedback, cursor=cursor, page_size=page_size
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if view == "summary":
+        rows, next_cursor = history_service.split_page((await db.execute(query)).all(), page_size)
+        items = [
             {
                 "id": m.id,
                 "usuario": m.usuario,
                 "pergunta": m.pergunta,
-                "resposta": m.resposta,
-                "sources": json.loads(m.sources) if m.sources else [],
                 "feedback": m.feedback,
                 "created_at": parse_date(m.created_at).isoformat()
             }
-            for m in messages
+            for m in rows
         ]
-    finally:
-        db.close()
+    else:
+        rows, next_cursor = history_service.split_page((await db.scalars(query)).all(), page_size)
+        sources = await history_service.load_sources(db, [m.id for m in rows])
+        items = [_message_to_dict(m, sources.get(m.id, [])) for m in rows]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@router.get("/historico/{message_id}")
+async def get_message_detail(message_id: int, user_data: dict = Depends(get_current_user_data), db: AsyncSession = Depends(get_async_db)):
+    """Pergunta, resposta e fontes (com o texto dos trechos) de uma mensagem do histórico."""
+    await history_writer.flush()
+    query = select(ChatMessage).where(ChatMessage.id == message_id, ChatMessage.tenant_id == user_data["tenant_id"])
+    if user_data["role"] != "admin":
+        query = query.where(ChatMessage.usuario == user_data["username"])
+    m = await db.scalar(query)
+    if not m:
+        raise HTTPException(status_code=404, detail="Mensagem não encontrada.")
+    sources = await history_service.load_sources(db, [m.id], with_content=True)
+    return _message_to_dict(m, sources.get(m.id, []))
+
+
+def _message_to_dict(m: ChatMessage, sources: List[dict]) -> dict:
+    return {
+        "id": m.id,
+        "usuario": m.usuario,
+        "pergunta": m.pergunta,
+        "resposta": m.resposta,
+        "sources": sources,
+        "feedback": m.feedback,
+        "created_at": parse_date(m.created_at).isoformat()
+    }
 
 @router.post("/feedback")
-def save_feedback(payload: FeedbackRequest, user_data: dict = Depends(get_current_user_data)):
-    db = SessionLocal()
+def save_feedback(payload: FeedbackRequest, user_data: dict = Depends(get_current_user_data), db: Session = Depends(get_db)):
+    # Mensagem ainda na fila de gravação: o feedback vai junto com a linha
+    if history_writer.apply_feedback(ChatMessage, payload.message_id, user_data["tenant_id"], payload.value):
+        return {"status": "sucesso", "mensagem": "Feedback salvo."}
     try:
         msg = db.query(ChatMessage).filter(
             ChatMessage.id == payload.message_id,
@@ -396,14 +661,20 @@ def save_feedback(payload: FeedbackRequest, user_data: dict = Depends(get_curren
         ).first()
         
         if not msg:
+            # Pode estar na fila de gravação de outro worker: guarda o feedback para quando chegar ao banco
+            if history_writer.defer_feedback(db, ChatMessage, payload.message_id, user_data["tenant_id"], payload.value):
+                return {"status": "sucesso", "mensagem": "Feedback salvo."}
             raise HTTPException(status_code=404, detail="Mensagem não encontrada.")
             
-        msg.feedback = payload.value
+        # UPDATE condicional: dois feedbacks simultâneos não movem o rollup a partir do mesmo valor
+        if not analytics_service.change_feedback(db, quota_service.RAG_QUESTIONS, msg, payload.value):
+            db.rollback()
+            raise HTTPException(status_code=409, detail="Feedback alterado ao mesmo tempo por outra requisição. Tente novamente.")
         db.commit()
         return {"status": "sucesso", "mensagem": "Feedback salvo."}
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
         logger.error(f"Erro ao salvar feedback RAG: {e}")
         raise HTTPException(status_code=500, detail="Erro interno ao salvar feedback.")
-    finally:
-        db.close()
@@ -103,12 +103,9 @@ def render_dashboard(service, logout_fn):
 
     st.markdown("<div style='margin-bottom: 3rem;'></div>", unsafe_allow_html=True)
     
-    # Buscar histórico para os gráficos
-    prompt_res = service.get_prompt_history()
-    rag_res = service.get_rag_history()
-    
-    prompt_history = prompt_res.json() if prompt_res and prompt_res.status_code == 200 else []
-    rag_history = rag_res.json() if rag_res and rag_res.status_code == 200 else []
+    # Contagens agregadas para os gráficos (últimos 30 dias)
+    usage_res = service.get_usage_analytics()
+    analytics = usage_res.json() if usage_res and usage_res.status_code == 200 else {}
     
     # Gráficos de Uso
-    render_usage_charts(prompt_history, rag_history)
+    render_usage_charts(analytics)
@@ -40,6 +40,155 @@ def to_pdf(df, title):
         
     return pdf.output(dest='S').encode('latin-1')
 
+FEEDBACK_FILTERS = {"Todos": None, "Positivo": 1, "Neutro": 0, "Negativo": -1}
+
+
+def _history_filters(prefix):
+    """Filtros do histórico (período, feedback e, para administradores, usuário)."""
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        periodo = st.date_input("Período", value=(), key=f"{prefix}_periodo")
+    with c2:
+        feedback = st.selectbox("Feedback", list(FEEDBACK_FILTERS), key=f"{prefix}_feedback")
+    with c3:
+        usuario = st.text_input("Usuário", key=f"{prefix}_usuario") if st.session_state.get("role") == "admin" else None
+
+    periodo = list(periodo) if isinstance(periodo, (list, tuple)) else [periodo]
+    return {
+        "date_from": periodo[0].isoformat() if len(periodo) > 0 else None,
+        "date_to": periodo[-1].isoformat() if len(periodo) > 0 else None,
+        "feedback": FEEDBACK_FILTERS[feedback],
+        "usuario": usuario or None,
+    }
+
+
+def _load_history(prefix, fetch, filters):
+    """
+    Lista resumida acumulada em session_state. "Carregar mais" busca a próxima página pelo cursor;
+    mudar os filtros recomeça do início.
+    """
+    state_key = f"{prefix}_history"
+    state = st.session_state.get(state_key)
+    if state is None or state["filters"] != filters:
+        state = {"filters": filters, "items": [], "next_cursor": None, "loaded": False}
+        st.session_state[state_key] = state
+
+    if not state["loaded"] or st.session_state.pop(f"{prefix}_load_more", False):
+        res = fetch(view="summary", cursor=state["next_cursor"], **filters)
+        if not res or res.status_code != 200:
+            return None
+        page = res.json()
+        state["items"].extend(page["items"])
+        state["next_cursor"] = page["next_cursor"]
+        state["loaded"] = True
+    return state
+
+
+def _load_more_button(prefix, state):
+    if state["next_cursor"]:
+        if st.button("Carregar mais", key=f"{prefix}_more", use_container_width=True):
+            st.session_state[f"{prefix}_load_more"] = True
+            st.rerun()
+
+
+def _fetch_all(fetch, filters):
+    """Todas as páginas completas para exportação (só quando o usuário pede)."""
+    items, cursor = [], None
+    while True:
+        res = fetch(view="full", page_size=100, cursor=cursor, **filters)
+        if not res or res.status_code != 200:
+            break
+        page = res.json()
+        items.extend(page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    return items
+
+
+def _export_buttons(prefix, fetch, filters, columns, rename, title, file_stem):
+    export_key = f"{prefix}_export"
+    if st.button("📦 Preparar exportação", key=f"{prefix}_prepare_export", use_container_width=True):
+        with st.spinner("Carregando histórico completo..."):
+            df = pd.DataFrame(_fetch_all(fetch, filters))
+        if df.empty:
+            st.session_state[export_key] = None
+        else:
+            df['Sentimento'] = df['feedback'].map({1: 'Positivo', 0: 'Neutro', -1: 'Negativo'})
+            export_df = df.rename(columns=rename)[columns]
+            st.session_state[export_key] = (export_df.to_csv(index=False).encode('utf-8'), to_pdf(export_df, title))
+
+    exported = st.session_state.get(export_key)
+    if exported:
+        csv, pdf_data = exported
+        cex1, cex2 = st.columns(2)
+        with cex1:
+            st.download_button(
+                label="📥 Exportar CSV",
+                data=csv,
+                file_name=f'{file_stem}.csv',
+                mime='text/csv',
+                use_container_width=True
+            )
+        with cex2:
+            st.download_button(
+                label="📄 Exportar PDF",
+                data=pdf_data,
+                file_name=f'{file_stem}.pdf',
+                mime='application/pdf',
+                use_container_width=True
+            )
+
+
+def _detail(prefix, item_id, fetch_detail):
+    """Conteúdo completo de um item, buscado sob demanda e guardado em session_state."""
+    cache = st.session_state.setdefault(f"{prefix}_details", {})
+    if item_id not in cache:
+        if not st.button("Ver conteúdo completo", key=f"{prefix}_detail_{item_id}"):
+            return None
+        res = fetch_detail(item_id)
+        if not res or res.status_code != 200:
+            st.error("Falha ao carregar o conteúdo.")
+            return None
+        cache[item_id] = res.json()
+    return cache[item_id]
+
+
+SEARCH_KINDS = {"Tudo": None, "Prompt Hub": "prompt", "RAG Hub": "rag"}
+
+
+def _render_search(service, query):
+    """Resultados da busca textual, do mais relevante ao menos relevante, com o trecho encontrado."""
+    c1, c2 = st.columns([1, 2])
+    with c1:
+        kind = SEARCH_KINDS[st.selectbox("Buscar em", list(SEARCH_KINDS), key="hist_search_kind")]
+    with c2:
+        usuario = st.text_input("Usuário", key="hist_search_usuario") if st.session_state.get("role") == "admin" else None
+
+    filters = {"q": query, "kind": kind, "usuario": usuario or None}
+    state = _load_history("hist_search", lambda view, cursor, **f: service.search_history(cursor=cursor, **f), filters)
+    if state is None:
+        st.error("Falha na busca.")
+        return
+    if not state["items"]:
+        st.info("Nenhum resultado para a busca.")
+        return
+
+    for item in state["items"]:
+        icon, fetch_detail = ("📌", service.get_prompt_detail) if item["kind"] == "prompt" else ("💬", service.get_rag_detail)
+        with st.expander(f"{icon} {item['titulo'][:80]} ({item['created_at'][:16].replace('T', ' ')})"):
+            st.markdown(item["snippet"])
+            detail = _detail(f"hist_search_{item['kind']}", item['id'], fetch_detail)
+            if detail:
+                if item["kind"] == "prompt":
+                    saas_card(detail['tema'], detail['conteudo'], adaptive_height=True)
+                else:
+                    saas_card(detail['pergunta'], detail['resposta'], adaptive_height=True)
+                    for s in detail['sources'] or []:
+                        st.caption(f"- {s['source']} (Pág {s['page']})")
+    _load_more_button("hist_search", state)
+
+
 def render_history(service):
     st.markdown("""
     <div class="stHeader">
@@ -48,120 +197,79 @@ def render_history(service):
     </div>
     """, unsafe_allow_html=True)
     
+    query = st.text_input("🔎 Buscar no histórico", placeholder="Ex.: política de férias", key="hist_search_q").strip()
+    if query:
+        try:
+            _render_search(service, query)
+        except Exception as e:
+            st.error(f"Erro de conexão: {e}")
+        return
+    
     tab_prompts, tab_rag = st.tabs(["🚀 Prompt Hub", "📚 RAG Hub"])
     
     with tab_prompts:
         try:
-            res = service.get_prompt_history()
-            if res and res.status_code == 200:
-                data = res.json()
-                if not data:
-                    st.info("Nenhum prompt gerado ainda.")
-                else:
-                    # Export Button
-                    df = pd.DataFrame(data)
-                    if 'feedback' in df.columns:
-                        df['Sentimento'] = df['feedback'].map({1: 'Positivo', 0: 'Neutro', -1: 'Negativo'})
-                        # Remover ou renomear colunas técnicas
-                        df = df.rename(columns={'tema': 'Tema', 'conteudo': 'Conteudo', 'created_at': 'Data Criação'})
-                        export_df = df[['Data Criação', 'Tema', 'Conteudo', 'Sentimento']]
-                    else:
-                        export_df = df
-
-                    csv = export_df.to_csv(index=False).encode('utf-8')
-                    pdf_data = to_pdf(export_df, "Historico de Prompts")
-                    
-                    cex1, cex2 = st.columns(2)
-                    with cex1:
-                        st.download_button(
-                            label="📥 Exportar CSV",
-                            data=csv,
-                            file_name='historico_prompts.csv',
-                            mime='text/csv',
-                            use_container_width=True
-                        )
-                    with cex2:
-                        st.download_button(
-                            label="📄 Exportar PDF",
-                            data=pdf_data,
-                            file_name='historico_prompts.pdf',
-                            mime='application/pdf',
-                            use_container_width=True
-                        )
-                    st.divider()
-                for item in data:
-                    fb_icon = " ✨" if item.get('feedback') == 1 else (" 🔧" if item.get('feedback') == -1 else "")
-                    with st.expander(f"📌 {item['tema']}{fb_icon} ({item['created_at'][:16].replace('T', ' ')})"):
-                        content_html = item['conteudo'].replace('\n', '<br>')
-                        saas_card(
-                            item['tema'],
-                            item['conteudo'],
-                            adaptive_height=True
-                        )
-                        st.download_button(f"Baixar conteúdo", item['conteudo'], file_name=f"prompt_{item['id']}.txt", key=f"dl_{item['id']}")
-            elif res:
+            filters = _history_filters("hist_prompts")
+            state = _load_history("hist_prompts", service.get_prompt_history, filters)
+            if state is None:
                 st.error("Falha ao carregar histórico de prompts.")
+            elif not state["items"]:
+                st.info("Nenhum prompt encontrado.")
             else:
-                st.error(f"Erro de conexão: Não foi possível conectar ao serviço.")
+                _export_buttons(
+                    "hist_prompts", service.get_prompt_history, filters,
+                    columns=['Data Criação', 'Tema', 'Conteudo', 'Sentimento'],
+                    rename={'tema': 'Tema', 'conteudo': 'Conteudo', 'created_at': 'Data Criação'},
+                    title="Historico de Prompts", file_stem="historico_prompts"
+                )
+                st.divider()
+                for item in state["items"]:
+                    fb_icon = " ✨" if item.get('feedback') == 1 else (" 🔧" if item.get('feedback') == -1 else "")
+                    with st.expander(f"📌 {item['tema']}{fb_icon} ({item['created_at'][:16].replace('T', ' ')})"):
+                        detail = _detail("hist_prompts", item['id'], service.get_prompt_detail)
+                        if detail:
+                            saas_card(
+                                detail['tema'],
+                                detail['conteudo'],
+                                adaptive_height=True
+                            )
+                            st.download_button(f"Baixar conteúdo", detail['conteudo'], file_name=f"prompt_{item['id']}.txt", key=f"dl_{item['id']}")
+                _load_more_button("hist_prompts", state)
         except Exception as e:
             st.error(f"Erro de conexão: {e}")
 
     with tab_rag:
         try:
-            res = service.get_rag_history()
-            if res and res.status_code == 200:
-                data = res.json()
-                if not data:
-                    st.info("Nenhuma conversa no RAG ainda.")
-                else:
-                    # Export Button
-                    df = pd.DataFrame(data)
-                    if 'feedback' in df.columns:
-                        df['Sentimento'] = df['feedback'].map({1: 'Positivo', 0: 'Neutro', -1: 'Negativo'})
-                        df = df.rename(columns={'pergunta': 'Pergunta', 'resposta': 'Resposta', 'created_at': 'Data Criação'})
-                        export_df = df[['Data Criação', 'Pergunta', 'Resposta', 'Sentimento']]
-                    else:
-                        export_df = df
-
-                    csv = export_df.to_csv(index=False).encode('utf-8')
-                    pdf_data_rag = to_pdf(export_df, "Historico RAG")
-                    
-                    cr1, cr2 = st.columns(2)
-                    with cr1:
-                        st.download_button(
-                            label="📥 Exportar CSV",
-                            data=csv,
-                            file_name='historico_rag.csv',
-                            mime='text/csv',
-                            use_container_width=True
-                        )
-                    with cr2:
-                        st.download_button(
-                            label="📄 Exportar PDF",
-                            data=pdf_data_rag,
-                            file_name='historico_rag.pdf',
-                            mime='application/pdf',
-                            use_container_width=True
-                        )
-                    st.divider()
-                for item in data:
-                    fb_icon = " ✅" if item.get('feedback') == 1 else (" ⚠️" if item.get('feedback') == -1 else "")
-                    with st.expander(f"💬 {item['pergunta'][:50]}...{fb_icon} ({item['created_at'][:16].replace('T', ' ')})"):
-                        st.write(f"**Pergunta:** {item['pergunta']}")
-                        response_html = item['resposta'].replace('\n', '<br>')
-                        saas_card(
-                            item['pergunta'],
-                            item['resposta'],
-                            adaptive_height=True
-                        )
-                        if item['sources']:
-                            st.write("**Fontes:**")
-                            for s in item['sources']:
-                                st.caption(f"- {s['source']} (Pág {s['page']})")
-            elif res:
+            filters = _history_filters("hist_rag")
+            state = _load_history("hist_rag", service.get_rag_history, filters)
+            if state is None:
                 st.error("Falha ao carregar histórico do RAG.")
+            elif not state["items"]:
+                st.info("Nenhuma conversa encontrada.")
             else:
-                st.error(f"Erro de conexão: Não foi possível conectar ao serviço.")
+                _export_buttons(
+                    "hist_rag", service.get_rag_history, filters,
+                    columns=['Data Criação', 'Pergunta', 'Resposta', 'Sentimento'],
+                    rename={'pergunta': 'Pergunta', 'resposta': 'Resposta', 'created_at': 'Data Criação'},
+                    title="Historico RAG", file_stem="historico_rag"
+                )
+                st.divider()
+                for item in state["items"]:
+                    fb_icon = " ✅" if item.get('feedback') == 1 else (" ⚠️" if item.get('feedback') == -1 else "")
+                    with st.expander(f"💬 {item['pergunta'][:50]}...{fb_icon} ({item['created_at'][:16].replace('T', ' ')})"):
+                        detail = _detail("hist_rag", item['id'], service.get_rag_detail)
+                        if detail:
+                            st.write(f"**Pergunta:** {detail['pergunta']}")
+                            saas_card(
+                                detail['pergunta'],
+                                detail['resposta'],
+                                adaptive_height=True
+                            )
+                            if detail['sources']:
+                                st.write("**Fontes:**")
+                                for s in detail['sources']:
+                                    st.caption(f"- {s['source']} (Pág {s['page']})")
+                _load_more_button("hist_rag", state)
         except Exception as e:
             st.error(f"Erro de conexão: {e}")
 
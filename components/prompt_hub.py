@@ -18,38 +18,79 @@ def render_prompt_hub(service, logout_fn):
             if not tema:
                 st.warning("Informe um tema para continuar.")
             else:
-                with st.spinner("Estruturando e processando via LLM..."):
-                    res = service.generate_content(tema)
-                    if res and res.status_code == 200:
-                        data = res.json()
-                        st.balloons()
-                        st.subheader("✅ Resultado Gerado")
-                        saas_card(
-                            "Conteúdo Estruturado", 
-                            data['conteudo_gerado'], 
-                            adaptive_height=True
-                        )
-                        
-                        # Feedback UI
-                        st.markdown("<div style='margin-top: 1.5rem; border-top: 1px solid var(--border-light); padding-top: 1rem;'></div>", unsafe_allow_html=True)
-                        f_col1, f_col2, f_col3 = st.columns([0.5, 0.5, 4])
-                        
-                        p_id = data.get("prompt_id")
-                        
-                        with f_col1:
-                            if st.button("👍", key=f"p_up_{p_id}"):
-                                if service.update_prompt_feedback(p_id, 1):
-                                    st.toast("Gostamos que gostou!", icon="✨")
-                        with f_col2:
-                            if st.button("👎", key=f"p_down_{p_id}"):
-                                if service.update_prompt_feedback(p_id, -1):
-                                    st.toast("Vamos ajustar a IA!", icon="🔧")
+                # Conteúdo em stream: o texto aparece conforme o LLM gera
+                meta = {}
+                def token_stream():
+                    for event, payload in service.generate_content_stream(tema):
+                        if event == "token":
+                            yield payload["text"]
+                        else:
+                            meta[event] = payload
 
-                        st.download_button("📥 Baixar Conteúdo (.txt)", data['conteudo_gerado'], file_name="ai_content.txt")
-                    elif res and res.status_code == 401:
-                        st.error("Sessão expirada.")
-                        logout_fn()
-                    elif res:
-                        st.error(f"Erro na API: {res.text}")
-                    else:
-                        st.error(f"Erro ao chamar a API.")
+                st.subheader("✅ Resultado Gerado")
+                with st.container(border=True):
+                    conteudo = st.write_stream(token_stream())
+
+                error = meta.get("error")
+                if error and error.get("status") == 401:
+                    st.error("Sessão expirada.")
+                    logout_fn()
+                elif error and error.get("status"):
+                    st.error(f"Erro na API: {error['detail']}")
+                elif error:
+                    st.error(f"Erro ao chamar a API: {error['detail']}")
+                else:
+                    st.balloons()
+                    provider = (meta.get("done") or {}).get("provider")
+                    if provider and provider != "groq":
+                        st.caption(f"Conteúdo gerado pelo modelo de contingência ({provider}).")
+                    
+                    # Feedback UI
+                    st.markdown("<div style='margin-top: 1.5rem; border-top: 1px solid var(--border-light); padding-top: 1rem;'></div>", unsafe_allow_html=True)
+                    f_col1, f_col2, f_col3 = st.columns([0.5, 0.5, 4])
+                    
+                    p_id = (meta.get("done") or {}).get("prompt_id")
+                    
+                    with f_col1:
+                        if st.button("👍", key=f"p_up_{p_id}"):
+                            if service.update_prompt_feedback(p_id, 1):
+                                st.toast("Gostamos que gostou!", icon="✨")
+                    with f_col2:
+                        if st.button("👎", key=f"p_down_{p_id}"):
+                            if service.update_prompt_feedback(p_id, -1):
+                                st.toast("Vamos ajustar a IA!", icon="🔧")
+
+                    st.download_button("📥 Baixar Conteúdo (.txt)", conteudo, file_name="ai_content.txt")
+
+
+    with st.expander("📦 Geração em lote"):
+        temas_lote = st.text_area("Um tema por linha:",
+                                  placeholder="Ex: Observabilidade em APIs\nCache distribuído com Redis",
+                                  key="temas_lote")
+
+        if st.button("Gerar Lote ✨"):
+            temas = [t.strip() for t in temas_lote.splitlines() if t.strip()]
+            if not temas:
+                st.warning("Informe ao menos um tema.")
+            else:
+                # Cada item aparece assim que termina, fora da ordem de envio
+                progresso = st.progress(0.0, text=f"0 de {len(temas)} concluídos")
+                concluidos = 0
+                for event, payload in service.generate_content_batch_stream(temas):
+                    if event == "result":
+                        concluidos += 1
+                        progresso.progress(concluidos / len(temas), text=f"{concluidos} de {len(temas)} concluídos")
+                        with st.container(border=True):
+                            st.markdown(f"**{payload['indice'] + 1}. {payload['tema']}**")
+                            if payload["status"] == "sucesso":
+                                st.markdown(payload["conteudo_gerado"])
+                            else:
+                                st.error(payload["detail"])
+                    elif event == "done":
+                        st.success(f"Lote concluído: {payload['total'] - payload['falhas']} de {payload['total']} conteúdos salvos no histórico.")
+                    elif event == "error":
+                        if payload.get("status") == 401:
+                            st.error("Sessão expirada.")
+                            logout_fn()
+                        else:
+                            st.error(f"Erro na API: {payload['detail']}")
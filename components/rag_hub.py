@@ -2,6 +2,27 @@ import streamlit as st
 from components.ui import saas_card
 import time
 
+SCOPE_LABELS = {"user": "Meus documentos", "tenant": "Organização", "global": "Base global"}
+
+def _fetch_search_page(service, query, k, scopes, filters, cursor=None):
+    """Busca uma página do Explorador e acumula os resultados na sessão."""
+    try:
+        res = service.rag_search(query, k, scopes, filters, cursor)
+        if res and res.status_code == 200:
+            data = res.json()
+            st.session_state.search_results = st.session_state.get("search_results", []) + data["results"]
+            st.session_state.search_cursor = data.get("next_cursor")
+            if not st.session_state.search_results:
+                st.info("Nenhum resultado encontrado.")
+        elif res:
+            detail = res.json().get("detail", res.text) if res.status_code != 500 else "Erro interno no servidor"
+            st.error(f"Erro na busca: {detail}")
+        else:
+            st.error(f"Erro de conexão: Não foi possível conectar ao serviço.")
+    except Exception as e:
+        # Add Debug Info
+        st.error(f"Erro de conexão (DEBUG: {type(e).__name__}): {e}")
+
 def render_rag_hub(service):
 
     st.markdown(f"""
@@ -18,37 +39,53 @@ def render_rag_hub(service):
         col1, col2 = st.columns([4, 1])
         query = col1.text_input("O que você procura nos seus documentos?", placeholder="Ex: Regras de segurança...")
         k = col2.slider("Resultados", 1, 10, 3)
+        scopes = st.multiselect(
+            "Bases consultadas", list(SCOPE_LABELS), default=["user"],
+            format_func=SCOPE_LABELS.get,
+            help="As bases selecionadas são consultadas em paralelo e os resultados ranqueados em conjunto."
+        )
         
+        with st.expander("🎯 Filtros"):
+            files_res = service.list_files()
+            file_names = [f["name"] for f in files_res.json()] if files_res and files_res.status_code == 200 else []
+            f_col1, f_col2, f_col3 = st.columns([2, 1, 1])
+            sel_sources = f_col1.multiselect("Documentos", file_names)
+            page_from = f_col2.number_input("Página inicial", min_value=0, value=0, help="0 = sem limite")
+            page_to = f_col3.number_input("Página final", min_value=0, value=0, help="0 = sem limite")
+            filters = {
+                "sources": sel_sources or None,
+                "page_from": int(page_from) or None,
+                "page_to": int(page_to) or None,
+            }
+
+        search_args = (query, k, tuple(scopes or ["user"]), repr(filters))
         if st.button("Executar Busca 🔎"):
-            try:
-                res = service.rag_search(query, k)
-                if res and res.status_code == 200:
-                    results = res.json()["results"]
-                    if not results:
-                        st.info("Nenhum resultado encontrado.")
-                    for doc in results:
-                        footer = f"""
-                            <div style="display: flex; gap: 10px;">
-                                <span class="status-badge badge-process">📄 {doc['source']}</span>
-                                <span class="status-badge badge-active">Pág. {doc['page']}</span>
-                            </div>
-                        """
-                        # CALLING THE STANDARDIZED saas_card
-                        saas_card(
-                            doc['source'], 
-                            doc['content'], 
-                            footer_html=footer,
-                            adaptive_height=True,
-                            extra_classes="animate-slide-up hover-scale"
-                        )
-                elif res:
-                    detail = res.json().get("detail", res.text) if res.status_code != 500 else "Erro interno no servidor"
-                    st.error(f"Erro na busca: {detail}")
-                else:
-                    st.error(f"Erro de conexão: Não foi possível conectar ao serviço.")
-            except Exception as e:
-                # Add Debug Info
-                st.error(f"Erro de conexão (DEBUG: {type(e).__name__}): {e}")
+            st.session_state.search_results = []
+            st.session_state.search_cursor = None
+            st.session_state.search_args = search_args
+            _fetch_search_page(service, query, k, scopes or ["user"], filters)
+
+        # Páginas seguintes vêm do cache ranqueado do servidor (sem nova busca)
+        if st.session_state.get("search_args") == search_args:
+            for doc in st.session_state.get("search_results", []):
+                footer = f"""
+                    <div style="display: flex; gap: 10px;">
+                        <span class="status-badge badge-process">📄 {doc['source']}</span>
+                        <span class="status-badge badge-active">Pág. {doc['page']}</span>
+                    </div>
+                """
+                # CALLING THE STANDARDIZED saas_card
+                saas_card(
+                    doc['source'], 
+                    doc['content'], 
+                    footer_html=footer,
+                    adaptive_height=True,
+                    extra_classes="animate-slide-up hover-scale"
+                )
+            if st.session_state.get("search_cursor"):
+                if st.button("Carregar mais resultados ⬇️"):
+                    _fetch_search_page(service, query, k, scopes or ["user"], filters, st.session_state.search_cursor)
+                    st.rerun()
 
     with tab2:
         st.subheader("Chat com Documentos")
@@ -64,9 +101,14 @@ def render_rag_hub(service):
                 "Sensibilidade (Threshold)", 0.0, 2.0, st.session_state.rag_threshold, 0.1,
                 help="Quanto menor o valor, mais rigorosa é a busca. Valores altos permitem respostas mais amplas, mas com risco de alucinação."
             )
+            st.session_state.rag_scopes = st.multiselect(
+                "Bases consultadas", list(SCOPE_LABELS), default=st.session_state.rag_scopes,
+                format_func=SCOPE_LABELS.get, key="rag_scopes_chat"
+            ) or ["user"]
             if st.button("Resetar Padrões"):
                 st.session_state.rag_k = 4
                 st.session_state.rag_threshold = 1.1
+                st.session_state.rag_scopes = ["user"]
                 st.rerun()
 
         # Container para o histórico de chat
@@ -84,53 +126,62 @@ def render_rag_hub(service):
             st.session_state.chat_history.append({"role": "user", "content": prompt})
             
             with st.chat_message("assistant"):
-                with st.spinner("Consultando base de dados..."):
-                    res = service.rag_ask(prompt, st.session_state.rag_k, st.session_state.rag_threshold)
-                    if res and res.status_code == 200:
-                        data = res.json()
-                        answer = data["answer"]
-                        st.markdown(answer)
-                        
-                        if data["sources"]:
-                            st.markdown("<h4 style='margin: 1.5rem 0 0.8rem 0; font-size: 1.1rem;'>📚 Fontes Consultadas</h4>", unsafe_allow_html=True)
-                            source_cols = st.columns(min(len(data["sources"]), 3))
-                            for idx, s in enumerate(data["sources"]):
-                                with source_cols[idx % 3]:
-                                    st.markdown(f"""
-                                    <div class="source-card hover-scale animate-slide-up">
-                                        <div style="font-weight: 700; font-size: 0.85rem; color: var(--primary); display: flex; align-items: center; gap: 8px; margin-bottom: 0.8rem;">
-                                            <svg width="16" height="16" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2.5" stroke-linecap="round" stroke-linejoin="round"><path d="M14 2H6a2 2 0 0 0-2 2v16a2 2 0 0 0 2 2h12a2 2 0 0 0 2-2V8z"></path><polyline points="14 2 14 8 20 8"></polyline></svg>
-                                            {s['source']}
-                                        </div>
-                                        <div style="font-size: 0.75rem; color: var(--text-muted); line-height: 1.4;">
-                                            Trecho relevante extraído da <b>Página {s['page']}</b> do documento indexado.
-                                        </div>
-                                        <div style="margin-top: 1rem; display: flex; justify-content: flex-end;">
-                                            <span class="status-badge badge-process" style="font-size: 0.65rem;">Vetor ID: {idx+1}</span>
-                                        </div>
-                                    </div>
-                                    """, unsafe_allow_html=True)
-                        
-                        # Feedback UI refined
-                        st.markdown("<div style='margin-top: 2rem; border-top: 1px solid var(--border-light); padding-top: 1rem;'></div>", unsafe_allow_html=True)
-                        f_col1, f_col2, f_col3 = st.columns([0.5, 0.5, 4])
-                        
-                        msg_id = data.get("message_id")
-                        
-                        with f_col1:
-                            if st.button("👍", key=f"up_{msg_id}"):
-                                if service.update_rag_feedback(msg_id, 1):
-                                    st.toast("Obrigado pelo feedback!", icon="✅")
-                        with f_col2:
-                            if st.button("👎", key=f"down_{msg_id}"):
-                                if service.update_rag_feedback(msg_id, -1):
-                                    st.toast("Lamentamos. Vamos melhorar!", icon="⚠️")
-                        
-                        st.session_state.chat_history.append({"role": "assistant", "content": answer})
-                    elif res:
+                # Resposta em stream: fontes chegam primeiro, tokens em seguida, message_id ao final
+                meta = {}
+                def token_stream():
+                    for event, payload in service.rag_ask_stream(prompt, st.session_state.rag_k, st.session_state.rag_threshold, st.session_state.rag_scopes):
+                        if event == "token":
+                            yield payload["text"]
+                        else:
+                            meta[event] = payload
+
+                answer = st.write_stream(token_stream())
+                if "error" in meta:
+                    if meta["error"].get("status"):
                         st.error("Erro ao consultar a base de conhecimento.")
                     else:
-                        st.error(f"Erro de conexão: Não foi possível conectar ao serviço.")
+                        st.error(f"Erro de conexão: {meta['error']['detail']}")
+                else:
+                    data = {"sources": meta.get("sources") or [], "message_id": (meta.get("done") or {}).get("message_id")}
+                    provider = (meta.get("done") or {}).get("provider")
+                    if provider and provider != "groq":
+                        st.caption(f"Resposta gerada pelo modelo de contingência ({provider}).")
+                    if data["sources"]:
+                        st.markdown("<h4 style='margin: 1.5rem 0 0.8rem 0; font-size: 1.1rem;'>📚 Fontes Consultadas</h4>", unsafe_allow_html=True)
+                        source_cols = st.columns(min(len(data["sources"]), 3))
+                        for idx, s in enumerate(data["sources"]):
+                            with source_cols[idx % 3]:
+                                st.markdown(f"""
+                                <div class="source-card hover-scale animate-slide-up">
+                                    <div style="font-weight: 700; font-size: 0.85rem; color: var(--primary); display: flex; align-items: center; gap: 8px; margin-bottom: 0.8rem;">
+                                        <svg width="16" height="16" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2.5" stroke-linecap="round" stroke-linejoin="round"><path d="M14 2H6a2 2 0 0 0-2 2v16a2 2 0 0 0 2 2h12a2 2 0 0 0 2-2V8z"></path><polyline points="14 2 14 8 20 8"></polyline></svg>
+                                        {s['source']}
+                                    </div>
+                                    <div style="font-size: 0.75rem; color: var(--text-muted); line-height: 1.4;">
+                                        Trecho relevante extraído da <b>Página {s['page']}</b> do documento indexado.
+                                    </div>
+                                    <div style="margin-top: 1rem; display: flex; justify-content: flex-end;">
+                                        <span class="status-badge badge-process" style="font-size: 0.65rem;">Vetor ID: {idx+1}</span>
+                                    </div>
+                                </div>
+                                """, unsafe_allow_html=True)
+                    
+                    # Feedback UI refined
+                    st.markdown("<div style='margin-top: 2rem; border-top: 1px solid var(--border-light); padding-top: 1rem;'></div>", unsafe_allow_html=True)
+                    f_col1, f_col2, f_col3 = st.columns([0.5, 0.5, 4])
+                    
+                    msg_id = data.get("message_id")
+                    
+                    with f_col1:
+                        if st.button("👍", key=f"up_{msg_id}"):
+                            if service.update_rag_feedback(msg_id, 1):
+                                st.toast("Obrigado pelo feedback!", icon="✅")
+                    with f_col2:
+                        if st.button("👎", key=f"down_{msg_id}"):
+                            if service.update_rag_feedback(msg_id, -1):
+                                st.toast("Lamentamos. Vamos melhorar!", icon="⚠️")
+                    
+                    st.session_state.chat_history.append({"role": "assistant", "content": answer})
             st.rerun()
 
         if st.button("Limpar Conversa 🗑️"):
@@ -109,27 +109,20 @@ def render_user_management(service):
         """, unsafe_allow_html=True)
 
         try:
-            # Carregar dados completos (Admin recebe tudo)
-            p_res = service.get_prompt_history()
-            r_res = service.get_rag_history()
+            # Contagens agregadas do período (Admin recebe a quebra por usuário da organização)
+            usage_res = service.get_usage_analytics()
+            analytics = usage_res.json() if usage_res and usage_res.status_code == 200 else {}
+            totals = analytics.get("totals", {})
             
-            p_data = p_res.json() if p_res and p_res.status_code == 200 else []
-            r_data = r_res.json() if r_res and r_res.status_code == 200 else []
-            
-            if not p_data and not r_data:
+            if not analytics.get("users"):
                 st.info("Nenhum dado de uso registrado na organização ainda.")
             else:
                 user_stats = {}
                 
-                for item in p_data:
-                    u = item.get('usuario', 'Desconhecido')
-                    if u not in user_stats: user_stats[u] = {'prompts': 0, 'rag': 0}
-                    user_stats[u]['prompts'] += 1
-                    
-                for item in r_data:
-                    u = item.get('usuario', 'Desconhecido')
+                for item in analytics["users"]:
+                    u = item.get('usuario') or 'Desconhecido'
                     if u not in user_stats: user_stats[u] = {'prompts': 0, 'rag': 0}
-                    user_stats[u]['rag'] += 1
+                    user_stats[u]['prompts' if item['kind'] == 'prompt' else 'rag'] += item['count']
                 
                 df_stats = pd.DataFrame.from_dict(user_stats, orient='index').reset_index()
                 df_stats.columns = ['Usuário', 'Ger. Conteúdo (Prompts)', 'Consultas RAG']
@@ -152,9 +145,9 @@ def render_user_management(service):
                 st.divider()
                 c1, c2 = st.columns(2)
                 with c1:
-                    st.metric("Total Prompts", len(p_data))
+                    st.metric("Total Prompts", totals.get("prompt", 0))
                 with c2:
-                    st.metric("Total RAG", len(r_data))
+                    st.metric("Total RAG", totals.get("rag", 0))
 
         except Exception as e:
             st.error(f"Erro ao carregar dados de monitoramento: {str(e)}")
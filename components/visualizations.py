@@ -3,25 +3,25 @@ import plotly.express as px
 import pandas as pd
 from datetime import datetime
 
-def render_usage_charts(prompt_history, rag_history):
+def _rows(analytics, section, kind):
+    """Linhas de uma seção do /analytics/usage (daily, hourly, feedback) para um tipo de uso."""
+    return pd.DataFrame([r for r in analytics.get(section, []) if r['kind'] == kind])
+
+def render_usage_charts(analytics):
     """
-    Renderiza gráficos de uso baseados no histórico.
+    Renderiza gráficos de uso a partir das contagens agregadas de /analytics/usage.
     """
     st.markdown("### 📊 Analítico de Uso")
     
     col1, col2 = st.columns(2)
     
-    # Processamento de Prompts
-    if prompt_history:
-        df_prompts = pd.DataFrame(prompt_history)
-        df_prompts['created_at'] = pd.to_datetime(df_prompts['created_at'])
-        df_prompts['date'] = df_prompts['created_at'].dt.date
-        usage_prompts = df_prompts.groupby('date').size().reset_index(name='count')
-        
+    # Prompts por dia
+    usage_prompts = _rows(analytics, 'daily', 'prompt')
+    if not usage_prompts.empty:
         with col1:
-            fig_prompts = px.area(usage_prompts, x='date', y='count', 
+            fig_prompts = px.area(usage_prompts, x='day', y='count', 
                                 title='<b>Geração de Conteúdo</b> (Prompts/Dia)',
-                                labels={'count': 'Quantidade', 'date': 'Data'},
+                                labels={'count': 'Quantidade', 'day': 'Data'},
                                 color_discrete_sequence=['#6366f1'])
             fig_prompts.update_traces(
                 line_width=3, 
@@ -41,8 +41,8 @@ def render_usage_charts(prompt_history, rag_history):
             st.plotly_chart(fig_prompts, use_container_width=True)
             
             # Gráfico de Sentimento (Prompts)
-            if 'feedback' in df_prompts.columns:
-                sent_counts = df_prompts['feedback'].value_counts().reset_index(name='count')
+            sent_counts = _rows(analytics, 'feedback', 'prompt')
+            if not sent_counts.empty:
                 sent_counts['label'] = sent_counts['feedback'].map({1: 'Positivo', 0: 'Neutro', -1: 'Negativo'})
                 fig_sent = px.pie(sent_counts, values='count', names='label', hole=0.5,
                                 title='Satisfação (Prompts)',
@@ -53,17 +53,13 @@ def render_usage_charts(prompt_history, rag_history):
     else:
         col1.info("Sem dados de prompts para o gráfico.")
 
-    # Processamento de RAG (Buscas/Perguntas)
-    if rag_history:
-        df_rag = pd.DataFrame(rag_history)
-        df_rag['created_at'] = pd.to_datetime(df_rag['created_at'])
-        df_rag['date'] = df_rag['created_at'].dt.date
-        usage_rag = df_rag.groupby('date').size().reset_index(name='count')
-        
+    # RAG (Buscas/Perguntas) por dia
+    usage_rag = _rows(analytics, 'daily', 'rag')
+    if not usage_rag.empty:
         with col2:
-            fig_rag = px.line(usage_rag, x='date', y='count', 
+            fig_rag = px.line(usage_rag, x='day', y='count', 
                              title='<b>Interações RAG</b> (Consultas/Dia)',
-                             labels={'count': 'Interações', 'date': 'Data'},
+                             labels={'count': 'Interações', 'day': 'Data'},
                              color_discrete_sequence=['#a855f7'])
             fig_rag.update_traces(
                 line_width=3, 
@@ -83,8 +79,8 @@ def render_usage_charts(prompt_history, rag_history):
             st.plotly_chart(fig_rag, use_container_width=True)
 
             # Gráfico de Sentimento (RAG)
-            if 'feedback' in df_rag.columns:
-                sent_counts_rag = df_rag['feedback'].value_counts().reset_index(name='count')
+            sent_counts_rag = _rows(analytics, 'feedback', 'rag')
+            if not sent_counts_rag.empty:
                 sent_counts_rag['label'] = sent_counts_rag['feedback'].map({1: 'Positivo', 0: 'Neutro', -1: 'Negativo'})
                 fig_sent_rag = px.pie(sent_counts_rag, values='count', names='label', hole=0.5,
                                     title='Satisfação (RAG)',
@@ -97,20 +93,12 @@ def render_usage_charts(prompt_history, rag_history):
 
     # 3. Gráfico de Horários de Pico (Combinado)
     st.markdown("---")
-    all_data = []
-    if prompt_history:
-        for p in prompt_history:
-            all_data.append({'hour': pd.to_datetime(p['created_at']).hour, 'type': 'Prompt'})
-    if rag_history:
-        for r in rag_history:
-            all_data.append({'hour': pd.to_datetime(r['created_at']).hour, 'type': 'RAG'})
-    
-    if all_data:
-        df_hours = pd.DataFrame(all_data)
-        usage_hours = df_hours.groupby(['hour', 'type']).size().reset_index(name='count')
+    usage_hours = pd.DataFrame(analytics.get('hourly', []))
+    if not usage_hours.empty:
+        usage_hours['type'] = usage_hours['kind'].map({'prompt': 'Prompt', 'rag': 'RAG'})
         
         fig_hours = px.bar(usage_hours, x='hour', y='count', color='type',
-                          title='<b>Distribuição de Uso por Hora</b>',
+                          title='<b>Distribuição de Uso por Hora</b> (UTC)',
                           labels={'count': 'Requisições', 'hour': 'Hora do Dia'},
                           barmode='group',
                           color_discrete_map={'Prompt': '#6366f1', 'RAG': '#a855f7'})
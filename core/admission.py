@@ -0,0 +1,150 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# Classe de cada endpoint pesado; rotas fora deste mapa não passam pelo controle de admissão
+ENDPOINT_CLASSES = {
+    "/rag/search": "search",
+    "/rag/ask_prompt": "ask",
+    "/rag/ask_prompt/stream": "ask",
+    "/prompt/gerar_conteudo": "generate",
+    "/prompt/gerar_conteudo/stream": "generate",
+    "/prompt/gerar_lote": "generate",
+    "/rag/upload": "upload",
+}
+
+# Requisições simultâneas aceitas por classe; acima disso a API responde 503.
+# ADMISSION_LIMITS (JSON) sobrescreve, ex.: {"ask": 64}
+ADMISSION_LIMITS = {
+    "search": 64,
+    "ask": 32,
+    "generate": 32,
+    "upload": 4,
+    **json.loads(os.getenv("ADMISSION_LIMITS", "{}") or "{}"),
+}
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+# Classes cujo trabalho é cancelado quando o cliente desconecta (o upload roda em thread e segue até o fim)
+CANCEL_ON_DISCONNECT = {"search", "ask", "generate"}
+
+_in_flight: Dict[str, int] = {name: 0 for name in ADMISSION_LIMITS}
+
+
+def in_flight(endpoint_class: Optional[str] = None):
+    """Requisições em andamento (de uma classe ou de todas)."""
+    if endpoint_class is not None:
+        return _in_flight.get(endpoint_class, 0)
+    return dict(_in_flight)
+
+
+def _set_in_flight(endpoint_class: str, delta: int) -> None:
+    _in_flight[endpoint_class] = _in_flight.get(endpoint_class, 0) + delta
+    metrics.set_gauge(f"admission.{endpoint_class}.in_flight", _in_flight[endpoint_class])
+
+
+async def _reject(send) -> None:
+    body = json.dumps({"detail": "Servidor sobrecarregado. Tente novamente em instantes."}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(ADMISSION_RETRY_AFTER).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """
+    Controle de admissão na camada ASGI.
+
+    Conta as requisições em andamento por classe de endpoint (search, ask, generate, upload)
+    e rejeita com 503 + Retry-After as que passarem de ADMISSION_LIMITS, em vez de
+    enfileirá-las no thread pool. Nas classes de CANCEL_ON_DISCONNECT, o handler é
+    cancelado quando o cliente desconecta, interrompendo as chamadas ao LLM e à busca
+    que ninguém mais vai ler.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        endpoint_class = ENDPOINT_CLASSES.get(scope.get("path", "").rstrip("/")) if scope["type"] == "http" else None
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        if _in_flight.get(endpoint_class, 0) >= ADMISSION_LIMITS.get(endpoint_class, float("inf")):
+            metrics.incr(f"admission.{endpoint_class}.rejected")
+            await _reject(send)
+            return
+
+        _set_in_flight(endpoint_class, 1)
+        try:
+            if endpoint_class in CANCEL_ON_DISCONNECT:
+                await self._run_cancellable(endpoint_class, scope, receive, send)
+            else:
+                await self.app(scope, receive, send)
+        finally:
+            _set_in_flight(endpoint_class, -1)
+
+    async def _run_cancellable(self, endpoint_class: str, scope, receive, send):
+        # Lê o corpo (JSON pequeno) antes: depois disso, só o vigia consome `receive`
+        messages = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                metrics.incr(f"admission.{endpoint_class}.cancelled")
+                return
+            messages.append(message)
+            if not message.get("more_body"):
+                break
+
+        disconnected = asyncio.Event()
+        response_complete = False
+
+        async def tracked_send(message):
+            nonlocal response_complete
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                response_complete = True
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            # O app (ex.: StreamingResponse) também pode esperar pela desconexão
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def watch():
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    return
+
+        handler = asyncio.ensure_future(self.app(scope, replay, tracked_send))
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await asyncio.wait({handler, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            # Resposta já entregue (ex.: tarefas em background): deixa o handler terminar
+            if not handler.done() and not response_complete:
+                handler.cancel()
+                metrics.incr(f"admission.{endpoint_class}.cancelled")
+                logger.info(f"Cliente desconectou de {scope.get('path')}; trabalho cancelado.")
+        try:
+            await handler
+        except asyncio.CancelledError:
+            # Só engole o cancelamento do handler; o da própria requisição segue adiante
+            if not disconnected.is_set():
+                raise
@@ -0,0 +1,72 @@
+import time
+import logging
+import threading
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Disjuntor simples por provedor.
+
+    - fechado: chamadas liberadas; `failure_threshold` falhas seguidas abrem o circuito.
+    - aberto: chamadas recusadas por `cooldown` segundos.
+    - meio-aberto: após o cooldown, uma chamada de teste é liberada; sucesso fecha, falha reabre.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Indica se uma chamada pode ser feita agora (reserva a vaga de teste no meio-aberto)."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuito {self.name} fechado novamente.")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning(f"Circuito {self.name} aberto após {self._failures} falhas.")
+                    metrics.incr(f"circuit.{self.name}.opened")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def release(self) -> None:
+        """Devolve a vaga de teste sem resultado (ex.: chamada cancelada por ter perdido o hedge)."""
+        with self._lock:
+            self._probing = False
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Deque, Hashable, Optional
+
+from core import metrics
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class _Waiter:
+    """Chamada na fila: assíncrona (future no event loop dela) ou síncrona (thread bloqueada num Event)."""
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.granted = False
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+
+    def grant(self) -> None:
+        self.granted = True
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(_wake, self.future)
+        else:
+            self.event.set()
+
+
+class FairScheduler:
+    """
+    Limite de concorrência com fila justa entre inquilinos.
+
+    Até `capacity` chamadas rodam ao mesmo tempo. As excedentes esperam numa fila
+    por chave (inquilino) e as vagas liberadas são distribuídas em rodízio entre as
+    chaves: um inquilino com 100 chamadas na fila não atrasa quem tem só uma.
+    Chamadas assíncronas (`slot`) e síncronas em threads (`blocking_slot`) dividem
+    as mesmas vagas.
+    """
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = capacity
+        self._active = 0
+        self._queues: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable):
+        await self._acquire(key)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def blocking_slot(self, key: Hashable):
+        """Versão síncrona de `slot`, para código que roda em threads (bloqueia até a vaga)."""
+        waiter = self._enqueue(key, None)
+        if waiter is not None:
+            started = time.perf_counter()
+            waiter.event.wait()
+            metrics.observe(f"{self.name}.wait_ms", (time.perf_counter() - started) * 1000)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _enqueue(self, key: Hashable, loop: Optional[asyncio.AbstractEventLoop]) -> Optional[_Waiter]:
+        """Ocupa uma vaga livre (None) ou entra na fila da chave e devolve o waiter."""
+        with self._lock:
+            if self._active < self.capacity and not self._queues:
+                self._active += 1
+                return None
+            waiter = _Waiter(loop)
+            self._queues.setdefault(key, deque()).append(waiter)
+            waiting = self.waiting
+        metrics.incr(f"{self.name}.queued")
+        metrics.set_gauge(f"{self.name}.waiting", waiting)
+        return waiter
+
+    async def _acquire(self, key: Hashable) -> None:
+        waiter = self._enqueue(key, asyncio.get_running_loop())
+        if waiter is None:
+            return
+        started = time.perf_counter()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._discard(key, waiter)
+            if granted:
+                # A vaga chegou junto com o cancelamento: devolve para o próximo
+                self._release()
+            raise
+        metrics.observe(f"{self.name}.wait_ms", (time.perf_counter() - started) * 1000)
+
+    def _discard(self, key: Hashable, waiter: _Waiter) -> None:
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[key]
+        metrics.set_gauge(f"{self.name}.waiting", self.waiting)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._active -= 1
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._active < self.capacity and self._queues:
+            # Rodízio: atende o primeiro inquilino da fila e o manda para o fim
+            key, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                self._queues[key] = queue
+            self._active += 1
+            waiter.grant()
+        metrics.set_gauge(f"{self.name}.waiting", self.waiting)
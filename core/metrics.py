@@ -0,0 +1,51 @@
+import threading
+from collections import defaultdict
+from typing import Dict, List
+
+# Métricas simples em memória (por processo), expostas em /ops/metrics
+_counters: Dict[str, float] = defaultdict(float)
+# Resumos de observações: {nome: [quantidade, soma, máximo]}
+_summaries: Dict[str, List[float]] = {}
+# Valores instantâneos (ex.: requisições em andamento por classe de endpoint)
+_gauges: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def incr(name: str, value: float = 1) -> None:
+    """Incrementa o contador `name`."""
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, value: float) -> None:
+    """Registra uma observação (ex.: latência em ms); o snapshot expõe count, avg e max."""
+    with _lock:
+        summary = _summaries.setdefault(name, [0, 0.0, 0.0])
+        summary[0] += 1
+        summary[1] += value
+        summary[2] = max(summary[2], value)
+
+
+def set_gauge(name: str, value: float) -> None:
+    """Define o valor atual do medidor `name` (substitui o anterior)."""
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot() -> Dict[str, float]:
+    """Cópia dos contadores e resumos atuais."""
+    with _lock:
+        data = dict(_counters)
+        data.update(_gauges)
+        for name, (count, total, peak) in _summaries.items():
+            data[f"{name}.count"] = count
+            data[f"{name}.avg"] = round(total / count, 3) if count else 0.0
+            data[f"{name}.max"] = peak
+        return data
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _summaries.clear()
+        _gauges.clear()
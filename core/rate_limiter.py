@@ -0,0 +1,117 @@
+import time
+import sqlite3
+import threading
+from typing import Dict, Tuple
+
+
+class MemoryBackend:
+    """Baldes de tokens em memória (por processo). Custo O(1) por checagem."""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1) -> float:
+        """
+        Tenta consumir `cost` fichas do balde `key` (reposição de `rate` fichas/s até `capacity`).
+        Retorna 0 se liberado ou os segundos até haver fichas suficientes.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+        return (cost - tokens) / rate
+
+
+class SQLiteBackend:
+    """
+    Baldes compartilhados entre workers da mesma máquina num arquivo SQLite.
+    A leitura e a atualização do balde ocorrem na mesma transação (BEGIN IMMEDIATE).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1) -> float:
+        conn = self._connect()
+        # Relógio de parede: os workers não compartilham o monotonic
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute(
+                "INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return 0.0 if allowed else (cost - tokens) / rate
+
+
+# Mesmo algoritmo do MemoryBackend, executado atomicamente no servidor Redis
+_REDIS_TAKE = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, capacity, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """Baldes compartilhados entre máquinas em qualquer servidor compatível com Redis (requer o pacote `redis`)."""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT_BACKEND aponta para Redis, mas o pacote 'redis' não está instalado.") from e
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(_REDIS_TAKE)
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1) -> float:
+        return float(self._take(keys=[f"rate:{key}"], args=[rate, capacity, cost, time.time()]))
+
+
+def create_backend(url: str):
+    """
+    Backend a partir de uma URL: "memory" (padrão), "sqlite:///caminho.db" ou
+    "redis://host:porta/db" (também "rediss://" e "unix://").
+    """
+    if not url or url == "memory":
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"RATE_LIMIT_BACKEND inválido: {url}")
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Broadcast:
+    """Itens produzidos por um único stream, reproduzidos para cada ouvinte desde o início."""
+
+    def __init__(self):
+        self.items: List = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def pump(self, source: AsyncIterator):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def follow(self) -> AsyncIterator:
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class _Flight:
+    """Trabalho em andamento e quantos clientes ainda aguardam por ele."""
+
+    def __init__(self, task: asyncio.Task, broadcast: Optional[_Broadcast] = None):
+        self.task = task
+        self.broadcast = broadcast
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalescência de trabalho idêntico em andamento (single-flight).
+
+    A primeira chamada com uma chave (líder) executa o trabalho; as chamadas
+    seguintes com a mesma chave, enquanto ele não termina, aguardam o mesmo
+    resultado (ou a mesma exceção). Nada é guardado após a conclusão: não é cache.
+    O trabalho roda numa task própria, então a desconexão de um cliente não
+    interrompe os demais; quando o último cliente desiste, o trabalho é cancelado.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self._streams: Dict[Hashable, _Flight] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """Retorna (resultado, compartilhado); compartilhado=True para quem só aguardou o líder."""
+        flight = self._inflight.get(key)
+        shared = flight is not None
+        if shared:
+            metrics.incr(f"{self.name}.coalesced")
+        else:
+            flight = _Flight(asyncio.ensure_future(func()))
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda t: self._finish(self._inflight, key, flight))
+            metrics.incr(f"{self.name}.executed")
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            self._leave(self._inflight, key, flight)
+
+    def stream(self, key: Hashable, factory: Callable[[], AsyncIterator]) -> Tuple[AsyncIterator, bool]:
+        """
+        Versão para streams: o líder abre `factory()` e todos os participantes
+        recebem a mesma sequência de itens. Retorna (iterador, compartilhado).
+        """
+        flight = self._streams.get(key)
+        shared = flight is not None
+        if shared:
+            metrics.incr(f"{self.name}.coalesced")
+        else:
+            broadcast = _Broadcast()
+            flight = _Flight(asyncio.ensure_future(broadcast.pump(factory())), broadcast)
+            self._streams[key] = flight
+            flight.task.add_done_callback(lambda t: self._finish(self._streams, key, flight))
+            metrics.incr(f"{self.name}.executed")
+        return self._follow(key, flight), shared
+
+    async def _follow(self, key: Hashable, flight: _Flight) -> AsyncIterator:
+        # Conta como cliente a partir da primeira iteração
+        flight.waiters += 1
+        try:
+            async for item in flight.broadcast.follow():
+                yield item
+        finally:
+            self._leave(self._streams, key, flight)
+
+    def _leave(self, registry: Dict, key: Hashable, flight: _Flight) -> None:
+        """Um cliente terminou ou desistiu; sem ninguém aguardando, cancela o trabalho."""
+        flight.waiters -= 1
+        if flight.waiters or flight.task.done():
+            return
+        # Quem chegar depois começa um trabalho novo em vez de herdar o cancelado
+        if registry.get(key) is flight:
+            del registry[key]
+        flight.task.cancel()
+        metrics.incr(f"{self.name}.cancelled")
+
+    @staticmethod
+    def _finish(registry: Dict, key: Hashable, flight: _Flight) -> None:
+        if registry.get(key) is flight:
+            del registry[key]
+        task = flight.task
+        # Marca a exceção como lida mesmo se todos os clientes já tiverem desistido
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Trabalho coalescido falhou para {key!r}")
@@ -1,16 +1,41 @@
 import logging
 from service.search_service import init_search
+from service import llm_gateway, usage_service, prompt_template_service, history_writer
+from db.database import engine, async_engine, SessionLocal
+from db.migrations import run_migrations
 
 logger = logging.getLogger(__name__)
 
 def startup_event():
     """
     Hook de inicialização executado pelo FastAPI no boot.
-    Configura o FAISS e prepara a base de busca.
+    Cria tabelas ausentes, aplica migrações pendentes e registra a versão do template de prompt; configura o FAISS e prepara a base de busca.
     """
+    version = run_migrations(engine)
+    logger.info(f"Esquema do banco na versão {version}.")
+    with SessionLocal() as db:
+        prompt_template_service.register_templates(db)
+
     logger.info("Inicializando FAISS...")
     try:
         init_search()
         logger.info("FAISS inicializado com sucesso (se houver PDFs válidos).")
     except Exception as e:
         logger.error(f"Falha crítica na inicialização do FAISS: {e}")
+
+
+async def start_background_tasks():
+    """Tarefas periódicas que rodam no event loop da API (gravação do consumo de tokens e do histórico)."""
+    usage_service.start_flusher()
+    history_writer.start_flusher()
+
+
+async def shutdown_event():
+    """
+    Hook de encerramento: grava o que estiver na fila (consumo e histórico) e libera os pools
+    HTTP compartilhados do LLM e o engine assíncrono.
+    """
+    await usage_service.stop_flusher()
+    await history_writer.stop_flusher()
+    await llm_gateway.aclose()
+    await async_engine.dispose()
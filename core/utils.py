@@ -1,5 +1,6 @@
 import os
 import re
+import json
 import unicodedata
 from pathlib import Path
 from typing import Union
@@ -38,3 +39,21 @@ def get_tenant_path(tenant_id: Union[int, str], tenant_name: str = None) -> str:
         return os.path.join(uploads_dir, f"{tid_str}_{slugify(tenant_name)}")
     
     return os.path.join(uploads_dir, tid_str)
+
+# Cabeçalhos para respostas Server-Sent Events (desliga buffering de proxies como o Nginx)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(event: str, data) -> str:
+    """
+    Serializa um evento no formato Server-Sent Events.
+    O payload vai como JSON em uma única linha `data:`.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def normalize_text(value: str) -> str:
+    """
+    Normaliza um texto livre para comparação (pergunta, tema):
+    minúsculas, espaços colapsados e sem pontuação final.
+    Ex: "  Qual a política  de férias? " -> "qual a política de férias"
+    """
+    return " ".join(str(value).casefold().split()).rstrip("?!.;: ")
@@ -0,0 +1,273 @@
+import os
+import json
+import sqlite3
+import logging
+from collections import Counter
+from datetime import date, datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, select, func, text, delete, insert, update, bindparam, inspect
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from db.models import Base, Prompt, ChatMessage, TokenUsage, QuotaUsage, DocumentChunk, ChatMessageSource, chunk_hash, PromptTemplate, ActivityRollup
+
+logger = logging.getLogger(__name__)
+
+_metadata = MetaData()
+schema_version = Table(
+    "schema_version", _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+
+def _create_indexes(*models) -> Callable[[Connection], None]:
+    def migrate(conn: Connection) -> None:
+        for model in models:
+            for index in model.__table__.indexes:
+                index.create(conn, checkfirst=True)
+    return migrate
+
+
+def _backfill_quota_usage(conn: Connection) -> None:
+    """Recria os contadores diários do ledger de quota a partir do histórico já gravado."""
+    conn.execute(delete(QuotaUsage.__table__))
+    # Mesmos tipos de uso de service.quota_service (PROMPTS, RAG_QUESTIONS)
+    for kind, model in (("prompt", Prompt), ("rag", ChatMessage)):
+        day = func.date(model.created_at)
+        rows = conn.execute(
+            select(model.tenant_id, day, func.count())
+            .where(model.tenant_id.isnot(None), model.created_at.isnot(None))
+            .group_by(model.tenant_id, day)
+        ).all()
+        if rows:
+            conn.execute(insert(QuotaUsage.__table__), [
+                # SQLite devolve date() como texto; PostgreSQL, como date
+                {"tenant_id": tenant_id, "day": date.fromisoformat(str(row_day)[:10]), "kind": kind, "count": count}
+                for tenant_id, row_day, count in rows
+            ])
+
+
+def _normalize_chat_sources(conn: Connection, batch_size: int = 500) -> None:
+    """
+    Converte o JSON de chat_messages.sources em referências (chat_message_sources) a trechos
+    gravados uma vez por inquilino (document_chunks) e limpa a coluna antiga.
+    """
+    chunk_ids = {
+        (tenant_id, h): chunk_id
+        for chunk_id, tenant_id, h in conn.execute(
+            select(DocumentChunk.id, DocumentChunk.tenant_id, DocumentChunk.chunk_hash)
+        )
+    }
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(ChatMessage.id, ChatMessage.tenant_id, ChatMessage.sources)
+            .where(ChatMessage.id > last_id, ChatMessage.sources.isnot(None), ChatMessage.tenant_id.isnot(None))
+            .order_by(ChatMessage.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        links = []
+        for message_id, tenant_id, raw in rows:
+            try:
+                sources = json.loads(raw) or []
+            except ValueError:
+                logger.warning(f"Fontes ilegíveis na mensagem {message_id}; descartadas.")
+                sources = []
+            for position, src in enumerate(sources):
+                source = src.get("source", "desconhecido")
+                page = int(src.get("page", 0))
+                content = src.get("content", "")
+                key = (tenant_id, chunk_hash(source, page, content))
+                if key not in chunk_ids:
+                    chunk_ids[key] = conn.execute(insert(DocumentChunk.__table__).values(
+                        tenant_id=tenant_id, chunk_hash=key[1], source=source, page=page, content=content
+                    )).inserted_primary_key[0]
+                links.append({"message_id": message_id, "chunk_id": chunk_ids[key], "position": position})
+
+        if links:
+            conn.execute(insert(ChatMessageSource.__table__), links)
+        conn.execute(
+            update(ChatMessage.__table__)
+            .where(ChatMessage.id.in_([row[0] for row in rows]))
+            .values(sources=None)
+        )
+        last_id = rows[-1][0]
+
+
+def _prompt_template_references(conn: Connection, batch_size: int = 500) -> None:
+    """
+    Adiciona prompts.template_id, registra a versão 1 do template e troca o texto renderizado
+    das linhas antigas pela referência ao template quando ele pode ser refeito idêntico.
+    Linhas cujo texto não bate com o template continuam com o prompt gravado.
+    """
+    from service import prompt_template_service
+
+    if "template_id" not in {c["name"] for c in inspect(conn).get_columns("prompts")}:
+        conn.execute(text("ALTER TABLE prompts ADD COLUMN template_id INTEGER REFERENCES prompt_templates(id)"))
+
+    name, version = prompt_template_service.TEMPLATE_NAME, 1
+    system, human = prompt_template_service.TEMPLATES[version]
+    template_id = conn.execute(select(PromptTemplate.id).where(
+        PromptTemplate.name == name, PromptTemplate.version == version
+    )).scalar()
+    if template_id is None:
+        template_id = conn.execute(insert(PromptTemplate.__table__).values(
+            name=name, version=version, system=system, human=human
+        )).inserted_primary_key[0]
+
+    set_template = (
+        update(Prompt.__table__)
+        .where(Prompt.id == bindparam("row_id"))
+        .values(template_id=template_id, prompt=None)
+    )
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(Prompt.id, Prompt.tema, Prompt.usuario, Prompt.prompt)
+            .where(Prompt.id > last_id, Prompt.template_id.is_(None), Prompt.prompt.isnot(None))
+            .order_by(Prompt.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        matches = [
+            {"row_id": row_id}
+            for row_id, tema, usuario, rendered in rows
+            if rendered == prompt_template_service.render(system, human, tema=tema, usuario=usuario)
+        ]
+        if matches:
+            conn.execute(set_template, matches)
+        last_id = rows[-1][0]
+
+
+def _backfill_activity_rollup(conn: Connection, batch_size: int = 5000) -> None:
+    """Recria o rollup de analytics (activity_rollup) a partir do histórico já gravado."""
+    from service import analytics_service, quota_service
+
+    conn.execute(delete(ActivityRollup.__table__))
+    counts = Counter()
+    for kind, model in ((quota_service.PROMPTS, Prompt), (quota_service.RAG_QUESTIONS, ChatMessage)):
+        result = conn.execution_options(yield_per=batch_size).execute(
+            select(model.tenant_id, model.usuario, model.created_at, model.feedback)
+            .where(model.tenant_id.isnot(None), model.created_at.isnot(None))
+        )
+        for tenant_id, usuario, created_at, feedback in result:
+            counts[analytics_service.bucket(tenant_id, usuario, kind, created_at, feedback)] += 1
+    if counts:
+        conn.execute(insert(ActivityRollup.__table__), [
+            {"tenant_id": t, "usuario": u, "kind": k, "day": d, "hour": h, "feedback": f, "count": n}
+            for (t, u, k, d, h, f), n in counts.items()
+        ])
+
+
+def _history_search_index(conn: Connection) -> None:
+    """Índice de busca textual do histórico (FTS5 com gatilhos no SQLite, GIN no PostgreSQL)."""
+    from service import history_search_service
+
+    history_search_service.create_search_index(conn)
+
+
+def _history_search_scope(conn: Connection) -> None:
+    """Índice de busca refeito com a coluna de escopo (inquilino/usuário) e índices de prefixo."""
+    from service import history_search_service
+
+    history_search_service.rebuild_search_index(conn)
+
+
+# Migrações versionadas, aplicadas no startup. Cada uma roda numa transação e deve ser
+# idempotente: bancos novos já nascem com o esquema atual pelo `create_all` e a migração
+# só registra a versão em `schema_version`. Para mudar o esquema, altere os modelos e
+# acrescente aqui a próxima versão.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Índices compostos de quota e histórico (prompts, chat_messages, token_usage_daily)",
+     _create_indexes(Prompt, ChatMessage, TokenUsage)),
+    (2, "Ledger de quota diária (quota_usage_daily) preenchido a partir do histórico",
+     _backfill_quota_usage),
+    (3, "Fontes do chat normalizadas (document_chunks, chat_message_sources)",
+     _normalize_chat_sources),
+    (4, "Prompts referenciam a versão do template (prompt_templates) em vez do texto renderizado",
+     _prompt_template_references),
+    (5, "Rollup de analytics por inquilino/usuário/dia/hora/feedback (activity_rollup)",
+     _backfill_activity_rollup),
+    (6, "Busca textual no histórico (prompts_fts, chat_messages_fts)",
+     _history_search_index),
+    (7, "Busca no histórico restrita ao inquilino no próprio índice (coluna scope) e com índices de prefixo",
+     _history_search_scope),
+]
+
+
+def current_version(conn: Connection) -> int:
+    return conn.execute(select(func.coalesce(func.max(schema_version.c.version), 0))).scalar()
+
+
+def _backup_sqlite(engine: Engine, version: int) -> None:
+    """Cópia consistente (API de backup do SQLite, segura com WAL) antes de migrar um banco existente."""
+    path = engine.url.database
+    if not path or path == ":memory:" or not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    backup_path = f"{path}.bak-v{version}"
+    source = sqlite3.connect(path)
+    try:
+        target = sqlite3.connect(backup_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    logger.info(f"Backup do banco antes da migração: {backup_path}")
+
+
+def _vacuum_sqlite(engine: Engine) -> None:
+    """Devolve ao sistema o espaço liberado pelas migrações (o SQLite não encolhe o arquivo sozinho)."""
+    try:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+    except Exception as e:
+        logger.warning(f"VACUUM após a migração falhou (o banco segue válido): {e}")
+
+
+def run_migrations(engine: Engine) -> int:
+    """
+    Cria as tabelas ausentes e aplica as migrações pendentes, uma transação por versão.
+    Retorna a versão final do esquema.
+    """
+    is_sqlite = engine.dialect.name == "sqlite"
+    _metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        version = current_version(conn)
+
+    pending = [m for m in MIGRATIONS if m[0] > version]
+    if pending and is_sqlite:
+        _backup_sqlite(engine, version)
+
+    Base.metadata.create_all(bind=engine)
+
+    applied = False
+    for number, description, migrate in pending:
+        try:
+            with engine.begin() as conn:
+                if engine.dialect.name == "postgresql":
+                    # Vários workers sobem juntos: só um aplica cada migração
+                    conn.execute(text("SELECT pg_advisory_xact_lock(4201)"))
+                if current_version(conn) >= number:
+                    continue
+                logger.info(f"Aplicando migração {number}: {description}")
+                migrate(conn)
+                conn.execute(schema_version.insert().values(version=number, description=description))
+                applied = True
+        except IntegrityError:
+            # Outro worker registrou a mesma versão ao mesmo tempo (as migrações são idempotentes)
+            logger.info(f"Migração {number} já aplicada por outro processo.")
+
+    if applied and is_sqlite:
+        _vacuum_sqlite(engine)
+
+    with engine.connect() as conn:
+        return current_version(conn)
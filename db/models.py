@@ -1,23 +1,43 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Date, Float, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
+import hashlib
 
 # --- CONFIGURAÇÃO DE LIMITES POR TIER ---
 TIER_LIMITS = {
     "free": {
         "max_documents": 5,
-        "max_prompts_per_day": 100
+        "max_prompts_per_day": 100,
+        "max_rag_questions_per_day": None,
+        "max_tokens_per_day": 200_000,
+        "llm_requests_per_minute": 20,
+        "llm_burst": 10,
+        "model_routing": "auto"
     },
     "pro": {
         "max_documents": 50,
-        "max_prompts_per_day": 500
+        "max_prompts_per_day": 500,
+        "max_rag_questions_per_day": None,
+        "max_tokens_per_day": 2_000_000,
+        "llm_requests_per_minute": 120,
+        "llm_burst": 30,
+        "model_routing": "auto"
     },
     "enterprise": {
         "max_documents": 1000,
-        "max_prompts_per_day": 10000
+        "max_prompts_per_day": 10000,
+        "max_rag_questions_per_day": None,
+        "max_tokens_per_day": 50_000_000,
+        "llm_requests_per_minute": 600,
+        "llm_burst": 100,
+        "model_routing": "auto"
     }
 }
+# max_rag_questions_per_day: perguntas ao RAG por dia (contadas em quota_usage_daily); None = ilimitado
+# max_tokens_per_day: tokens de LLM (prompt + resposta) por dia somando RAG e Prompt Hub; None = ilimitado
+# llm_requests_per_minute / llm_burst: balde de chamadas ao LLM por inquilino (ver rate_limit_service)
+# model_routing: "auto" (roteamento por complexidade), "small" ou "large" (tier fixo)
 
 Base = declarative_base()
 
@@ -52,19 +72,40 @@ class User(Base):
     tenant = relationship("Tenant", back_populates="users")
 
 
+class PromptTemplate(Base):
+    """Versão de um template do Prompt Hub (imutável; ver service.prompt_template_service.TEMPLATES)."""
+    __tablename__ = "prompt_templates"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    version = Column(Integer, nullable=False)
+    system = Column(Text, nullable=False)
+    human = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("name", "version", name="uq_prompt_templates_name_version"),)
+
+
 class Prompt(Base):
     __tablename__ = "prompts"
     id = Column(Integer, primary_key=True)
     usuario = Column(String)
     tenant_id = Column(Integer, ForeignKey("tenants.id"))
     tema = Column(String)
-    prompt = Column(Text)
+    # Versão do template usada; com `tema` e `usuario`, basta para refazer o prompt enviado ao LLM
+    template_id = Column(Integer, ForeignKey("prompt_templates.id"), nullable=True)
+    prompt = Column(Text) # Legado: prompt renderizado, só em linhas sem template_id
     resposta = Column(Text)
     feedback = Column(Integer, default=0) # 0: none, 1: positive, -1: negative
     created_at = Column(DateTime, default=datetime.utcnow)
     
     tenant = relationship("Tenant", back_populates="prompts")
 
+    # Quota diária e histórico do admin: (tenant_id, created_at); histórico do membro: + usuario
+    __table_args__ = (
+        Index("ix_prompts_tenant_created", "tenant_id", "created_at"),
+        Index("ix_prompts_tenant_usuario_created", "tenant_id", "usuario", "created_at"),
+    )
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     id = Column(Integer, primary_key=True)
@@ -72,8 +113,159 @@ class ChatMessage(Base):
     tenant_id = Column(Integer, ForeignKey("tenants.id"))
     pergunta = Column(Text)
     resposta = Column(Text)
-    sources = Column(Text) # Armazenado como JSON string
+    sources = Column(Text) # Legado (JSON); as fontes ficam em chat_message_sources (migração 3)
     feedback = Column(Integer, default=0) # 0: none, 1: positive, -1: negative
     created_at = Column(DateTime, default=datetime.utcnow)
     
     tenant = relationship("Tenant", back_populates="chat_messages")
+
+    __table_args__ = (
+        Index("ix_chat_messages_tenant_created", "tenant_id", "created_at"),
+        Index("ix_chat_messages_tenant_usuario_created", "tenant_id", "usuario", "created_at"),
+    )
+
+
+def chunk_hash(source: str, page: int, content: str) -> str:
+    """Identificador estável de um trecho: mesmo arquivo, página e texto geram o mesmo hash."""
+    return hashlib.sha256(f"{source}\x00{page}\x00{content}".encode("utf-8")).hexdigest()
+
+
+class DocumentChunk(Base):
+    """
+    Trecho de documento citado como fonte, gravado uma única vez por inquilino
+    (chave: `chunk_hash`) e referenciado pelas mensagens em chat_message_sources.
+    """
+    __tablename__ = "document_chunks"
+    id = Column(Integer, primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    chunk_hash = Column(String(64), nullable=False)
+    source = Column(String, nullable=False)
+    page = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("tenant_id", "chunk_hash", name="uq_document_chunks_tenant_hash"),)
+
+
+class ChatMessageSource(Base):
+    """Fontes de uma mensagem de chat, na ordem em que foram usadas no contexto."""
+    __tablename__ = "chat_message_sources"
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, ForeignKey("chat_messages.id"), nullable=False)
+    chunk_id = Column(Integer, ForeignKey("document_chunks.id"), nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_chat_message_sources_message", "message_id", "position"),)
+
+
+class IdAllocator(Base):
+    """
+    Próximo id livre por tabela para a alocação em blocos (hi-lo) de service.history_writer:
+    cada worker reserva um bloco com um UPDATE e distribui os ids dele em memória.
+    """
+    __tablename__ = "id_allocator"
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer, nullable=False)
+
+
+class IdBlock(Base):
+    """
+    Bloco de ids [start, end) reservado por um worker em service.history_writer. Enquanto
+    `touched_at` é recente, linhas do bloco podem estar na fila de gravação de algum worker:
+    só ids de um bloco vivo aceitam feedback guardado em pending_feedback.
+    """
+    __tablename__ = "id_blocks"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    start = Column(Integer, nullable=False)
+    end = Column(Integer, nullable=False)
+    touched_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (Index("ix_id_blocks_name_start", "name", "start"),)
+
+
+class PendingFeedback(Base):
+    """
+    Feedback de uma linha do histórico que ainda estava na fila de gravação de outro worker
+    (service.history_writer): fica guardado aqui e é aplicado quando a linha chega ao banco.
+    """
+    __tablename__ = "pending_feedback"
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    value = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("table_name", "row_id", "tenant_id", name="uq_pending_feedback_row"),
+        Index("ix_pending_feedback_created", "created_at"),
+    )
+
+
+class CacheVersion(Base):
+    """
+    Carimbo de versão dos caches em memória (ex.: "tenants" em service.tenant_cache).
+    Quem altera os dados incrementa o carimbo na mesma transação; os outros workers
+    descartam o cache ao perceber a mudança.
+    """
+    __tablename__ = "cache_versions"
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class ActivityRollup(Base):
+    """
+    Contagem de Prompts ("prompt") e perguntas do RAG ("rag") por inquilino, usuário, dia, hora
+    (UTC) e feedback, mantida incrementalmente na gravação e na troca de feedback.
+    Base de /analytics/usage.
+    """
+    __tablename__ = "activity_rollup"
+    id = Column(Integer, primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    usuario = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+    day = Column(Date, nullable=False)
+    hour = Column(Integer, nullable=False)
+    feedback = Column(Integer, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("tenant_id", "usuario", "kind", "day", "hour", "feedback", name="uq_activity_rollup_bucket"),
+        Index("ix_activity_rollup_tenant_day", "tenant_id", "day"),
+    )
+
+
+class TokenUsage(Base):
+    """Consumo de LLM agregado por inquilino, dia e modelo (alimentado pelo usage_service)."""
+    __tablename__ = "token_usage_daily"
+    id = Column(Integer, primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    model = Column(String, nullable=False)
+    calls = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    latency_ms_total = Column(Float, default=0.0)
+
+    __table_args__ = (
+        UniqueConstraint("tenant_id", "day", "model", name="uq_token_usage_tenant_day_model"),
+        # /ops/usage global filtra só por período
+        Index("ix_token_usage_day", "day"),
+    )
+
+
+class QuotaUsage(Base):
+    """
+    Contador diário por inquilino e tipo de uso ("prompt", "rag"), incrementado na mesma
+    transação que grava o Prompt/ChatMessage: a checagem de quota lê uma única linha.
+    O dia é o do created_at da linha, em UTC (quota_service.today()).
+    """
+    __tablename__ = "quota_usage_daily"
+    id = Column(Integer, primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    kind = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint("tenant_id", "day", "kind", name="uq_quota_usage_tenant_day_kind"),)
@@ -47,6 +47,8 @@ if "rag_k" not in st.session_state:
     st.session_state.rag_k = 4
 if "rag_threshold" not in st.session_state:
     st.session_state.rag_threshold = 1.1
+if "rag_scopes" not in st.session_state:
+    st.session_state.rag_scopes = ["user"]
 
 # --- NAVEGAÇÃO PRINCIPAL ---
 def main():
@@ -2,8 +2,12 @@ from fastapi import FastAPI
 from api.prompt_router_API import router as prompt_router
 from api.rag_router_API import router as rag_router
 from api.auth_API import router as auth_router
+from api.ops_API import router as ops_router
+from api.analytics_API import router as analytics_router
+from api.history_search_API import router as history_search_router
 
-from core.startup import startup_event
+from core.startup import startup_event, start_background_tasks, shutdown_event
+from core.admission import AdmissionMiddleware
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -14,11 +18,19 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Controle de admissão: 503 quando uma classe de endpoint satura, cancela trabalho de clientes desconectados
+app.add_middleware(AdmissionMiddleware)
+
 app.add_event_handler("startup", startup_event)
+app.add_event_handler("startup", start_background_tasks)
+app.add_event_handler("shutdown", shutdown_event)
 
 app.include_router(auth_router)
 app.include_router(rag_router)
 app.include_router(prompt_router)
+app.include_router(ops_router)
+app.include_router(analytics_router)
+app.include_router(history_search_router)
 
 @app.get("/health")
 def health_check():
@@ -5,17 +5,53 @@ from dotenv import load_dotenv
 # Carrega variáveis de ambiente
 load_dotenv()
 
-def get_llm(temperature=0.3):
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+SMALL_MODEL = "llama-3.1-8b-instant"
+
+# Preço por 1M de tokens (entrada, saída) em USD, usado nas métricas de custo por tier
+MODEL_PRICING = {
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+    "llama-3.1-8b-instant": (0.05, 0.08),
+}
+
+# Orçamento de tokens reservado ao CONTEXTO do RAG por modelo.
+# Deixa folga para o template, a pergunta e a resposta dentro da janela do modelo.
+CONTEXT_TOKEN_BUDGETS = {
+    "llama-3.3-70b-versatile": 3000,
+    "llama-3.1-8b-instant": 2000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 2000
+
+
+def get_context_budget(model: str = DEFAULT_MODEL) -> int:
+    """
+    Retorna o orçamento de tokens de contexto para o modelo informado.
+    Pode ser sobrescrito globalmente via RAG_CONTEXT_TOKENS.
+    """
+    override = os.getenv("RAG_CONTEXT_TOKENS")
+    if override:
+        return int(override)
+    return CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def get_llm(temperature=0.3, model: str = DEFAULT_MODEL, **client_kwargs):
     """
     Factory para instanciar o modelo Groq de forma centralizada.
     Padrão: llama-3.3-70b-versatile
+    `client_kwargs` repassa http_client, timeout e max_retries (usados pelo llm_gateway).
+    GROQ_BASE_URL permite apontar para um servidor compatível (ex.: fake local em testes).
     """
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         raise RuntimeError("GROQ_API_KEY não encontrada no ambiente (.env)")
-        
+
+    base_url = os.getenv("GROQ_BASE_URL")
+    if base_url:
+        client_kwargs.setdefault("base_url", base_url)
+
     return ChatGroq(
-        model="llama-3.3-70b-versatile",
+        model=model,
         temperature=temperature,
-        api_key=api_key
+        api_key=api_key,
+        **client_kwargs
     )
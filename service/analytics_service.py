@@ -0,0 +1,133 @@
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.database import dialect_insert
+from db.models import ActivityRollup
+
+# Chave de um balde do rollup: (tenant_id, usuario, tipo, dia, hora, feedback)
+RollupKey = Tuple[int, str, str, date, int, int]
+# Tentativas de troca de feedback quando outra requisição troca o da mesma linha ao mesmo tempo
+FEEDBACK_UPDATE_ATTEMPTS = 3
+
+
+def bucket(tenant_id: int, usuario: str, kind: str, created_at: datetime, feedback: Optional[int]) -> RollupKey:
+    return (tenant_id, usuario or "", kind, created_at.date(), created_at.hour, feedback or 0)
+
+
+def increment_stmt(key: RollupKey, amount: int):
+    """Upsert que soma `amount` (pode ser negativo) ao balde; executar na transação da gravação."""
+    tenant_id, usuario, kind, day, hour, feedback = key
+    stmt = dialect_insert(ActivityRollup).values(
+        tenant_id=tenant_id, usuario=usuario, kind=kind, day=day, hour=hour, feedback=feedback, count=amount
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[
+            ActivityRollup.tenant_id, ActivityRollup.usuario, ActivityRollup.kind,
+            ActivityRollup.day, ActivityRollup.hour, ActivityRollup.feedback
+        ],
+        set_={"count": ActivityRollup.count + stmt.excluded.count}
+    )
+
+
+def feedback_changes(kind: str, row, new_feedback: int) -> Iterable:
+    """
+    Upserts que movem uma linha (Prompt/ChatMessage) do balde do feedback antigo para o novo.
+    Vazio quando o feedback não muda.
+    """
+    if (row.feedback or 0) == new_feedback or row.created_at is None:
+        return []
+    old = bucket(row.tenant_id, row.usuario, kind, row.created_at, row.feedback)
+    new = old[:5] + (new_feedback,)
+    return [increment_stmt(old, -1), increment_stmt(new, 1)]
+
+
+def feedback_update(row, new_feedback: int):
+    """
+    UPDATE condicional do feedback: só vale se a linha ainda tiver o feedback lido em `row`.
+    rowcount 0 = outra requisição trocou antes, e os baldes não devem ser movidos.
+    """
+    model = type(row)
+    return (
+        update(model)
+        .where(model.id == row.id, model.feedback.is_not_distinct_from(row.feedback))
+        .values(feedback=new_feedback)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def change_feedback(db: Session, kind: str, row, new_feedback: int) -> bool:
+    """
+    Troca o feedback de `row` e move os baldes do rollup na transação de `db` (quem chama faz
+    o commit). Se outra requisição trocou o feedback no meio, relê a linha e tenta de novo;
+    False se não conseguir em FEEDBACK_UPDATE_ATTEMPTS tentativas.
+    """
+    for _ in range(FEEDBACK_UPDATE_ATTEMPTS):
+        changes = feedback_changes(kind, row, new_feedback)
+        if db.execute(feedback_update(row, new_feedback)).rowcount == 1:
+            for stmt in changes:
+                db.execute(stmt)
+            db.expire(row, ["feedback"])
+            return True
+        db.refresh(row)
+    return False
+
+
+async def achange_feedback(db: AsyncSession, kind: str, row, new_feedback: int) -> bool:
+    """Versão assíncrona de `change_feedback`."""
+    for _ in range(FEEDBACK_UPDATE_ATTEMPTS):
+        changes = feedback_changes(kind, row, new_feedback)
+        if (await db.execute(feedback_update(row, new_feedback))).rowcount == 1:
+            for stmt in changes:
+                await db.execute(stmt)
+            await db.refresh(row, ["feedback"])
+            return True
+        await db.refresh(row)
+    return False
+
+
+async def add_counts(db: AsyncSession, counts: Counter) -> None:
+    for key, amount in counts.items():
+        await db.execute(increment_stmt(key, amount))
+
+
+async def usage(
+    db: AsyncSession,
+    tenant_id: int,
+    day_from: date,
+    day_to: date,
+    usuario: Optional[str] = None,
+    by_user: bool = False,
+) -> Dict:
+    """Contagens agregadas do período por dia, hora e feedback (e por usuário, se pedido)."""
+    base = [ActivityRollup.tenant_id == tenant_id, ActivityRollup.day >= day_from, ActivityRollup.day <= day_to]
+    if usuario:
+        base.append(ActivityRollup.usuario == usuario)
+    total = func.sum(ActivityRollup.count).label("count")
+
+    async def grouped(*columns):
+        rows = (await db.execute(
+            select(*columns, ActivityRollup.kind, total)
+            .where(*base)
+            .group_by(*columns, ActivityRollup.kind)
+            .having(total > 0)
+            .order_by(*columns, ActivityRollup.kind)
+        )).all()
+        return [dict(row._mapping) for row in rows]
+
+    daily = await grouped(ActivityRollup.day)
+    for row in daily:
+        row["day"] = row["day"].isoformat()
+    result = {
+        "daily": daily,
+        "hourly": await grouped(ActivityRollup.hour),
+        "feedback": await grouped(ActivityRollup.feedback),
+        "totals": {row["kind"]: row["count"] for row in await grouped()},
+    }
+    if by_user:
+        result["users"] = await grouped(ActivityRollup.usuario)
+    return result
@@ -6,8 +6,8 @@ from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Any, Union
 from passlib.context import CryptContext
 from sqlalchemy.orm import Session
-from db.database import SessionLocal
 from db.models import User, Tenant
+from service import tenant_cache
 
 # Configuração do contexto de hashing (usando sha256_crypt por ser mais estável em Windows/Python 3.11)
 pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
@@ -24,37 +24,33 @@ def obter_JWT():
     """Retorna o segredo JWT centralizado no core/config."""
     return JWT_SECRET
 
-def verificar_login(username_tentativa: str, senha_tentativa: str) -> Optional[User]:
+def verificar_login(db: Session, username_tentativa: str, senha_tentativa: str) -> Optional[User]:
     """
     Verifica as credenciais do usuário. 
     Suporta fallback para texto plano caso o hash falhe (migração).
+    `db` é a sessão da requisição (ver db.database.get_db).
     """
-    db = SessionLocal()
-    try:
-        username_tentativa = username_tentativa.strip().lower()
-        user = db.query(User).filter(User.username == username_tentativa).first()
-        
-        if not user:
-            return None
-            
-        try:
-            if verify_password(senha_tentativa, user.password_hash):
-                return user
-        except Exception:
-            # Fallback para texto plano se necessário
-            if user.password_hash == senha_tentativa:
-                return user
-        
+    username_tentativa = username_tentativa.strip().lower()
+    user = db.query(User).filter(User.username == username_tentativa).first()
+    
+    if not user:
         return None
-    finally:
-        db.close()
+        
+    try:
+        if verify_password(senha_tentativa, user.password_hash):
+            return user
+    except Exception:
+        # Fallback para texto plano se necessário
+        if user.password_hash == senha_tentativa:
+            return user
+    
+    return None
 
-def cadastrar_usuario(usuario: str, senha_plana: str, tenant_name: str = None, tenant_id: int = None) -> bool:
+def cadastrar_usuario(db: Session, usuario: str, senha_plana: str, tenant_name: str = None, tenant_id: int = None) -> bool:
     """
     Cadastra um novo usuário e opcionalmente uma nova organização.
     Se tenant_id for fornecido, vincula diretamente (usado por admins para membros).
     """
-    db = SessionLocal()
     try:
         usuario = usuario.strip().lower()
         existing_user = db.query(User).filter(User.username == usuario).first()
@@ -101,12 +97,10 @@ def cadastrar_usuario(usuario: str, senha_plana: str, tenant_name: str = None, t
         print(f"Erro ao cadastrar usuário: {e}")
         db.rollback()
         return False
-    finally:
-        db.close()
 
-def criar_token(usuario: str, senha: str) -> Optional[str]:   
+def criar_token(db: Session, usuario: str, senha: str) -> Optional[str]:   
     """Gera um token JWT com validade de 8 horas."""
-    user = verificar_login(usuario, senha)
+    user = verificar_login(db, usuario, senha)
     if not user:
         return None
     
@@ -144,8 +138,7 @@ def validar_token_optional(authorization: Optional[str] = Header(None)) -> Optio
         token = authorization.split(" ")[1]
     return validar_token(token)
 
-def alterar_senha(usuario: str, nova_senha_plana: str) -> bool:
-    db = SessionLocal()
+def alterar_senha(db: Session, usuario: str, nova_senha_plana: str) -> bool:
     try:
         usuario_target = usuario.strip().lower()
         user = db.query(User).filter(User.username == usuario_target).first()
@@ -160,22 +153,16 @@ def alterar_senha(usuario: str, nova_senha_plana: str) -> bool:
         print(f"Erro ao alterar senha: {e}")
         db.rollback()
         return False
-    finally:
-        db.close()
 
-def obter_info_tenant(tenant_id: int) -> Optional[Dict[str, Any]]:
-    """Busca informações de limites e uso de um Tenant."""
-    db = SessionLocal()
-    try:
-        tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
-        if not tenant:
-            return None
-        return {
-            "name": tenant.name,
-            "subscription_tier": tenant.subscription_tier,
-            "max_documents": tenant.max_documents,
-            "max_prompts_per_day": tenant.max_prompts_per_day,
-            "current_document_count": tenant.current_document_count
-        }
-    finally:
-        db.close()
+def obter_info_tenant(db: Session, tenant_id: int) -> Optional[Dict[str, Any]]:
+    """Busca informações de limites e uso de um Tenant (via cache de inquilinos)."""
+    tenant = tenant_cache.get(db, tenant_id)
+    if not tenant:
+        return None
+    return {
+        "name": tenant.name,
+        "subscription_tier": tenant.subscription_tier,
+        "max_documents": tenant.max_documents,
+        "max_prompts_per_day": tenant.max_prompts_per_day,
+        "current_document_count": tenant.current_document_count
+    }
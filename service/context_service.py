@@ -0,0 +1,194 @@
+import os
+import re
+import logging
+from functools import lru_cache
+from typing import List, Dict, Tuple, Optional
+
+from service.ai_config import DEFAULT_MODEL, get_context_budget
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+    logging.info("tiktoken não instalado. Contagem de tokens será estimada por caracteres.")
+
+# Separador entre blocos do contexto (mesmo formato usado historicamente no /ask_prompt)
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+# Similaridade (Jaccard de shingles) a partir da qual dois blocos são considerados duplicados
+NEAR_DUPLICATE_THRESHOLD = 0.85
+
+# Maior sobreposição textual procurada quando o chunk não traz start_index
+# (o splitter usa chunk_overlap=150, deixamos margem)
+MAX_TEXT_OVERLAP = 300
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Carrega o encoding do tiktoken uma única vez (pode exigir download no primeiro uso)."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(f"Não foi possível carregar o encoding do tiktoken: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Conta tokens com tiktoken. O cl100k_base é uma aproximação razoável para o Llama;
+    sem tiktoken disponível, estima ~4 caracteres por token.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _clean(text: str) -> str:
+    # Remove quebras de linha duras que confundem o LLM
+    return " ".join(text.split())
+
+
+def _source_name(doc: Dict) -> str:
+    return os.path.basename(doc.get("source", "desconhecido")).replace("_ocr.pdf", ".pdf")
+
+
+def _text_overlap(left: str, right: str) -> int:
+    """Tamanho do maior sufixo de `left` que é prefixo de `right`."""
+    limit = min(len(left), len(right), MAX_TEXT_OVERLAP)
+    for size in range(limit, 20, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _merge_page_chunks(docs: List[Dict]) -> List[Dict]:
+    """
+    Une chunks adjacentes ou sobrepostos da mesma página.
+    Com start_index (metadado do splitter) a sobreposição é exata;
+    sem ele, procuramos o sufixo/prefixo textual comum.
+    """
+    groups: Dict[Tuple[str, int], List[Dict]] = {}
+    for rank, doc in enumerate(docs):
+        key = (doc.get("source", "desconhecido"), int(doc.get("page", 0)))
+        groups.setdefault(key, []).append({**doc, "_rank": rank})
+
+    blocks = []
+    for items in groups.values():
+        items.sort(key=lambda d: (d.get("start_index") is None, d.get("start_index") or 0, d["_rank"]))
+        current = None
+        for doc in items:
+            text = doc["content"]
+            start = doc.get("start_index")
+            if current is not None:
+                if start is not None and current["end"] is not None and start <= current["end"]:
+                    skip = current["end"] - start
+                    current["content"] += text[skip:]
+                    current["end"] = max(current["end"], start + len(text))
+                    current["members"].append(doc)
+                    continue
+                overlap = _text_overlap(current["content"], text)
+                if overlap:
+                    current["content"] += text[overlap:]
+                    current["end"] = start + len(text) if start is not None else None
+                    current["members"].append(doc)
+                    continue
+                blocks.append(current)
+            current = {
+                "content": text,
+                "end": start + len(text) if start is not None else None,
+                "members": [doc],
+            }
+        if current is not None:
+            blocks.append(current)
+
+    for block in blocks:
+        members = block["members"]
+        block["score"] = min(m["score"] for m in members)
+        block["rank"] = min(m["_rank"] for m in members)
+        block["source"] = members[0].get("source", "desconhecido")
+        block["page"] = members[0].get("page", 0)
+    return blocks
+
+
+def _drop_near_duplicates(blocks: List[Dict]) -> List[Dict]:
+    """Remove blocos quase idênticos (ex.: o mesmo PDF enviado duas vezes), mantendo o melhor."""
+    kept = []
+    for block in blocks:
+        block["_shingles"] = _shingles(block["content"])
+        if any(_jaccard(block["_shingles"], k["_shingles"]) >= NEAR_DUPLICATE_THRESHOLD for k in kept):
+            continue
+        kept.append(block)
+    return kept
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Corta o texto no limite de tokens, recuando até o fim da última frase completa."""
+    encoding = _get_encoding()
+    if encoding is None:
+        cut = text[:max_tokens * 4]
+    else:
+        cut = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    end = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    return cut[:end + 1] if end > 0 else cut
+
+
+def build_context(docs: List[Dict], model: str = DEFAULT_MODEL, max_tokens: Optional[int] = None) -> Tuple[str, List[Dict]]:
+    """
+    Monta o contexto do RAG respeitando um orçamento de tokens.
+
+    Etapas:
+    1. Une chunks adjacentes/sobrepostos da mesma página (elimina o overlap do splitter).
+    2. Descarta blocos quase duplicados.
+    3. Empacota blocos inteiros por score (menor é melhor) até o orçamento do modelo.
+
+    Retorna o contexto formatado e a lista de chunks originais efetivamente enviados.
+    """
+    if not docs:
+        return "", []
+
+    budget = max_tokens if max_tokens is not None else get_context_budget(model)
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+
+    blocks = _merge_page_chunks(docs)
+    blocks.sort(key=lambda b: (b["score"], b["rank"]))
+    blocks = _drop_near_duplicates(blocks)
+
+    parts = []
+    used_docs = []
+    used_tokens = 0
+    for block in blocks:
+        header = f"[[FONTE: {_source_name(block)}, PÁGINA: {int(block['page']) + 1}]]\n"
+        body = _clean(block["content"])
+        cost = count_tokens(header + body) + (separator_tokens if parts else 0)
+
+        if used_tokens + cost > budget:
+            if parts:
+                # Bloco inteiro não cabe; tenta o próximo (pode ser menor)
+                continue
+            # Nem o melhor bloco cabe sozinho: envia o trecho inicial até o fim de frase
+            body = _truncate_to_tokens(body, budget - count_tokens(header))
+            cost = count_tokens(header + body)
+
+        parts.append(header + body)
+        used_docs.extend(block["members"])
+        used_tokens += cost
+
+    logging.info(f"Contexto RAG: {len(parts)} blocos de {len(docs)} chunks, ~{used_tokens}/{budget} tokens")
+    used_docs.sort(key=lambda d: d["_rank"])
+    return CONTEXT_SEPARATOR.join(parts), [{k: v for k, v in d.items() if k != "_rank"} for d in used_docs]
@@ -0,0 +1,230 @@
+import re
+import json
+import time
+import base64
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text, DateTime
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from service import quota_service
+from service.history_service import SUMMARY_TITLE_CHARS
+from core import metrics
+
+# Busca textual no histórico. Em SQLite, uma tabela FTS5 por tabela de histórico (external
+# content: o texto não é duplicado, só o índice), mantida por gatilhos em cada INSERT/UPDATE/DELETE.
+# Além do texto, o índice tem uma coluna `scope` com um termo do inquilino e um do usuário, então o
+# MATCH já percorre só as linhas do inquilino em vez de todo o histórico.
+# Em PostgreSQL, índice GIN sobre to_tsvector das mesmas colunas (o filtro por inquilino usa o
+# índice B-tree de tenant_id, combinado pelo planejador).
+# Tipo de uso -> (tabela, colunas indexadas; a primeira é o título do resultado)
+SEARCH_TABLES: Dict[str, Tuple[str, Tuple[str, str]]] = {
+    quota_service.PROMPTS: ("prompts", ("tema", "resposta")),
+    quota_service.RAG_QUESTIONS: ("chat_messages", ("pergunta", "resposta")),
+}
+SEARCH_MAX_PAGE_SIZE = 50
+# Palavras em torno dos termos encontrados no trecho devolvido
+SNIPPET_TOKENS = 16
+# Marcação (markdown) dos termos encontrados no trecho
+SNIPPET_MARK = "**"
+# Configuração de texto do PostgreSQL (stemming em português)
+PG_TS_CONFIG = "portuguese"
+# Sem diferenciar acentos: "ferias" encontra "férias"
+FTS5_TOKENIZER = "unicode61 remove_diacritics 2"
+# Índices de prefixo de 2 e 3 letras: a última palavra digitada é buscada como prefixo
+FTS5_PREFIX = "2 3"
+SCOPE_COLUMN = "scope"
+
+
+def tenant_token(tenant_id) -> str:
+    return f"t{tenant_id}"
+
+
+def user_token(usuario: str) -> str:
+    """Um único termo por usuário (hex do nome), sem colidir com nomes que compartilham palavras."""
+    return "u" + usuario.encode("utf-8").hex()
+
+
+def _scope_expr(alias: str) -> str:
+    """Mesmos termos de tenant_token/user_token, calculados em SQL (hex do SQLite = bytes UTF-8)."""
+    return f"'t' || coalesce({alias}.tenant_id, '') || ' u' || lower(hex(coalesce({alias}.usuario, '')))"
+
+
+def fts_table(table: str) -> str:
+    return f"{table}_fts"
+
+
+def _content_view(table: str) -> str:
+    # Conteúdo externo do FTS5: as colunas do texto e a de escopo, calculada a partir da linha
+    return f"{table}_search"
+
+
+def _pg_document(columns: Tuple[str, ...], alias: str = "") -> str:
+    """Expressão indexada no PostgreSQL; a consulta precisa usar exatamente a mesma para usar o índice."""
+    parts = " || ' ' || ".join(f"coalesce({alias}{c}, '')" for c in columns)
+    return f"to_tsvector('{PG_TS_CONFIG}', {parts})"
+
+
+def create_search_index(conn: Connection) -> None:
+    """Cria (idempotente) o índice de busca do histórico e indexa as linhas já gravadas."""
+    for table, columns in SEARCH_TABLES.values():
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING gin ({_pg_document(columns)})"))
+            continue
+        fts = fts_table(table)
+        view = _content_view(table)
+        cols = ", ".join(columns + (SCOPE_COLUMN,))
+        new_values = ", ".join([f"new.{c}" for c in columns] + [_scope_expr("new")])
+        old_values = ", ".join([f"old.{c}" for c in columns] + [_scope_expr("old")])
+        conn.execute(text(
+            f"CREATE VIEW IF NOT EXISTS {view} AS SELECT id, {', '.join(columns)}, {_scope_expr(table)} AS {SCOPE_COLUMN} FROM {table}"
+        ))
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content='{view}', content_rowid='id', "
+            f"tokenize='{FTS5_TOKENIZER}', prefix='{FTS5_PREFIX}')"
+        ))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_values}); END"
+        ))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values}); END"
+        ))
+        # Feedback e outras colunas não indexadas não mexem no índice
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {', '.join(columns)}, tenant_id, usuario ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_values}); END"
+        ))
+        conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+
+def rebuild_search_index(conn: Connection) -> None:
+    """Recria o índice do zero (mudança de colunas ou opções do FTS5) e reindexa o histórico."""
+    if conn.dialect.name != "postgresql":
+        for table, _ in SEARCH_TABLES.values():
+            fts = fts_table(table)
+            for suffix in ("ai", "ad", "au"):
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {fts}_{suffix}"))
+            conn.execute(text(f"DROP TABLE IF EXISTS {fts}"))
+            conn.execute(text(f"DROP VIEW IF EXISTS {_content_view(table)}"))
+    create_search_index(conn)
+
+
+def fts5_query(query: str, columns: Tuple[str, ...], tenant_id, usuario: Optional[str] = None) -> Optional[str]:
+    """
+    Converte o texto digitado numa consulta FTS5 segura: cada palavra entre aspas (todas
+    obrigatórias) e a última como prefixo, para achar "contrat" em "contrato", buscadas só nas
+    colunas de texto e restritas aos termos de escopo do inquilino (e do usuário). None se não
+    houver palavras.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    scope = [f"{SCOPE_COLUMN}:{tenant_token(tenant_id)}"]
+    if usuario:
+        scope.append(f"{SCOPE_COLUMN}:{user_token(usuario)}")
+    terms = " ".join(f'"{w}"' for w in words) + "*"
+    return " AND ".join(scope) + f" AND {{{' '.join(columns)}}}:({terms})"
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        offset = int(json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["offset"])
+    except Exception:
+        raise ValueError("Cursor inválido.")
+    if offset < 0:
+        raise ValueError("Cursor inválido.")
+    return offset
+
+
+def _select_sqlite(kind: str, table: str, columns: Tuple[str, str], by_user: bool) -> str:
+    fts = fts_table(table)
+    # Trecho da resposta; se os termos só aparecem no título, o do título
+    body, title = (f"snippet({fts}, {i}, :mark, :mark, '…', {SNIPPET_TOKENS})" for i in (1, 0))
+    return (
+        f"SELECT '{kind}' AS kind, t.id AS id, t.usuario AS usuario, t.{columns[0]} AS titulo, "
+        f"t.feedback AS feedback, t.created_at AS created_at, "
+        f"CASE WHEN instr({body}, :mark) > 0 THEN {body} ELSE {title} END AS snippet, "
+        # A coluna de escopo casa em todas as linhas do inquilino: não entra na relevância
+        f"bm25({fts}, 1.0, 1.0, 0.0) AS score "
+        f"FROM {fts} JOIN {table} t ON t.id = {fts}.rowid "
+        # O escopo no MATCH restringe o índice; a condição na tabela garante a igualdade exata
+        f"WHERE {fts} MATCH :q_{kind} AND t.tenant_id = :tenant_id" + (" AND t.usuario = :usuario" if by_user else "")
+    )
+
+
+def _select_postgresql(kind: str, table: str, columns: Tuple[str, str], by_user: bool) -> str:
+    document = _pg_document(columns, alias="t.")
+    headline_options = f"StartSel={SNIPPET_MARK}, StopSel={SNIPPET_MARK}, MaxWords={SNIPPET_TOKENS}, MinWords={SNIPPET_TOKENS // 2}"
+    return (
+        f"SELECT '{kind}' AS kind, t.id AS id, t.usuario AS usuario, t.{columns[0]} AS titulo, "
+        f"t.feedback AS feedback, t.created_at AS created_at, "
+        f"ts_headline('{PG_TS_CONFIG}', coalesce(t.{columns[1]}, ''), tsq, '{headline_options}') AS snippet, "
+        # Menor primeiro, como o bm25 do SQLite
+        f"-ts_rank({document}, tsq) AS score "
+        f"FROM {table} t, websearch_to_tsquery('{PG_TS_CONFIG}', :q) tsq "
+        f"WHERE {document} @@ tsq AND t.tenant_id = :tenant_id" + (" AND t.usuario = :usuario" if by_user else "")
+    )
+
+
+async def search(
+    db: AsyncSession,
+    tenant_id: int,
+    query: str,
+    usuario: Optional[str] = None,
+    kinds: Optional[List[str]] = None,
+    cursor: Optional[str] = None,
+    page_size: int = 20,
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Página de resultados da busca no histórico do inquilino (do usuário, se informado), do mais
+    relevante ao menos relevante, com o trecho onde os termos aparecem. Retorna (itens, próximo cursor).
+    """
+    offset = decode_cursor(cursor) if cursor else 0
+    is_postgresql = db.bind.dialect.name == "postgresql"
+    kinds = kinds or list(SEARCH_TABLES)
+    if is_postgresql:
+        queries = {"q": query.strip()}
+    else:
+        # Uma consulta por tabela: as colunas de texto mudam
+        queries = {f"q_{kind}": fts5_query(query, SEARCH_TABLES[kind][1], tenant_id, usuario) for kind in kinds}
+    if not all(queries.values()):
+        return [], None
+    params = {**queries, "tenant_id": tenant_id, "limit": page_size + 1, "offset": offset}
+    if not is_postgresql:
+        params["mark"] = SNIPPET_MARK
+
+    build = _select_postgresql if is_postgresql else _select_sqlite
+    selects = [build(kind, *SEARCH_TABLES[kind], by_user=bool(usuario)) for kind in kinds]
+    sql = (
+        " UNION ALL ".join(selects)
+        + " ORDER BY score, created_at DESC, id DESC LIMIT :limit OFFSET :offset"
+    )
+    if usuario:
+        params["usuario"] = usuario
+
+    started = time.perf_counter()
+    rows = (await db.execute(text(sql).columns(created_at=DateTime), params)).mappings().all()
+    metrics.observe("history.search_ms", (time.perf_counter() - started) * 1000)
+
+    next_cursor = encode_cursor(offset + page_size) if len(rows) > page_size else None
+    items = [
+        {
+            "kind": row["kind"],
+            "id": row["id"],
+            "usuario": row["usuario"],
+            "titulo": (row["titulo"] or "")[:SUMMARY_TITLE_CHARS],
+            "snippet": row["snippet"],
+            "feedback": row["feedback"],
+            "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+        }
+        for row in rows[:page_size]
+    ]
+    return items, next_cursor
@@ -0,0 +1,128 @@
+import os
+import json
+import base64
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, insert, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.database import dialect_insert
+from db.models import DocumentChunk, ChatMessageSource, chunk_hash
+
+# Limite de itens por página dos endpoints de histórico
+HISTORY_MAX_PAGE_SIZE = 100
+# Caracteres da pergunta devolvidos na visão resumida do histórico de chat
+SUMMARY_TITLE_CHARS = 120
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps({"created_at": created_at.isoformat(), "id": row_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(data["created_at"]), int(data["id"])
+    except Exception:
+        raise ValueError("Cursor inválido.")
+
+
+def build_query(
+    model,
+    columns,
+    tenant_id: int,
+    usuario: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    feedback: Optional[int] = None,
+    cursor: Optional[str] = None,
+    page_size: int = 20,
+):
+    """
+    Página do histórico (Prompt ou ChatMessage) em ordem decrescente de (created_at, id).
+    Paginação por keyset: a próxima página começa logo após a última linha vista, usando o
+    índice (tenant_id[, usuario], created_at) sem OFFSET. Busca uma linha a mais para saber
+    se há próxima página.
+    """
+    query = select(*columns).where(model.tenant_id == tenant_id)
+    if usuario:
+        query = query.where(model.usuario == usuario)
+    if date_from:
+        query = query.where(model.created_at >= datetime.combine(date_from, time.min))
+    if date_to:
+        query = query.where(model.created_at < datetime.combine(date_to + timedelta(days=1), time.min))
+    if feedback is not None:
+        query = query.where(model.feedback == feedback)
+    if cursor:
+        last_created_at, last_id = decode_cursor(cursor)
+        query = query.where(or_(
+            model.created_at < last_created_at,
+            and_(model.created_at == last_created_at, model.id < last_id)
+        ))
+    return query.order_by(model.created_at.desc(), model.id.desc()).limit(page_size + 1)
+
+
+def split_page(rows: List, page_size: int) -> Tuple[List, Optional[str]]:
+    """Separa a linha extra da consulta e monta o cursor da próxima página."""
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, encode_cursor(last.created_at, last.id)
+
+
+async def save_sources(db: AsyncSession, tenant_id: int, message_id: int, docs: List[dict]) -> None:
+    """
+    Grava as fontes de uma mensagem como referências (chat_message_sources) a trechos
+    únicos por inquilino (document_chunks). O texto de um trecho citado em várias
+    respostas é gravado uma só vez. Roda na transação do chamador.
+    """
+    if not docs:
+        return
+    refs = []
+    chunks = {}
+    for d in docs:
+        source = os.path.basename(d.get("source", "desconhecido"))
+        page = int(d.get("page", 0)) + 1
+        h = chunk_hash(source, page, d["content"])
+        refs.append(h)
+        chunks[h] = {"tenant_id": tenant_id, "chunk_hash": h, "source": source, "page": page, "content": d["content"]}
+
+    await db.execute(
+        dialect_insert(DocumentChunk).values(list(chunks.values()))
+        .on_conflict_do_nothing(index_elements=["tenant_id", "chunk_hash"])
+    )
+    ids = dict((await db.execute(
+        select(DocumentChunk.chunk_hash, DocumentChunk.id)
+        .where(DocumentChunk.tenant_id == tenant_id, DocumentChunk.chunk_hash.in_(list(chunks)))
+    )).all())
+    await db.execute(insert(ChatMessageSource), [
+        {"message_id": message_id, "chunk_id": ids[h], "position": position}
+        for position, h in enumerate(refs)
+    ])
+
+
+async def load_sources(db: AsyncSession, message_ids: List[int], with_content: bool = False) -> Dict[int, List[dict]]:
+    """Fontes (arquivo e página; com `with_content`, também o texto) de cada mensagem."""
+    if not message_ids:
+        return {}
+    columns = [ChatMessageSource.message_id, DocumentChunk.source, DocumentChunk.page]
+    if with_content:
+        columns.append(DocumentChunk.content)
+    rows = (await db.execute(
+        select(*columns)
+        .join(DocumentChunk, DocumentChunk.id == ChatMessageSource.chunk_id)
+        .where(ChatMessageSource.message_id.in_(message_ids))
+        .order_by(ChatMessageSource.message_id, ChatMessageSource.position)
+    )).all()
+
+    sources = defaultdict(list)
+    for row in rows:
+        item = {"source": row.source, "page": row.page}
+        if with_content:
+            item["content"] = row.content
+        sources[row.message_id].append(item)
+    return sources
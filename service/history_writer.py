@@ -0,0 +1,361 @@
+import os
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+from db.database import AsyncSessionLocal, dialect_insert
+from db.models import ChatMessage, Prompt, IdAllocator, IdBlock, PendingFeedback
+from service import history_service, quota_service, analytics_service
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# Gravação em lote (write-behind) do histórico: Prompts e ChatMessages entram numa fila em memória
+# e são gravados a cada HISTORY_FLUSH_INTERVAL segundos ou quando a fila chega a HISTORY_FLUSH_MAX_ROWS
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1"))
+HISTORY_FLUSH_MAX_ROWS = int(os.getenv("HISTORY_FLUSH_MAX_ROWS", "200"))
+# Ids reservados por ida ao banco (hi-lo)
+HISTORY_ID_BLOCK_SIZE = int(os.getenv("HISTORY_ID_BLOCK_SIZE", "100"))
+# Feedback guardado para uma linha que nunca chegou ao banco (ex.: worker derrubado com a fila cheia) é descartado depois disso;
+# é também por quanto tempo um bloco de ids sem uso continua aceitando feedback guardado
+HISTORY_PENDING_FEEDBACK_TTL = int(os.getenv("HISTORY_PENDING_FEEDBACK_TTL", "3600"))
+# Intervalo mínimo (s) entre limpezas de feedback guardado e blocos de ids expirados
+HISTORY_CLEANUP_INTERVAL = float(os.getenv("HISTORY_CLEANUP_INTERVAL", "60"))
+# Erros que se repetem a cada tentativa com a mesma linha: ela é descartada em vez de travar a fila
+_BAD_ROW_ERRORS = (IntegrityError, DataError)
+
+# Linhas ainda não gravadas: {(tabela, id): item}; item = {"obj", "tenant_id", "day", "kind", "docs"}
+_pending: Dict[Tuple[str, int], dict] = {}
+# Lote sendo gravado agora (ainda sem commit)
+_flushing: Dict[Tuple[str, int], dict] = {}
+# Feedback recebido durante a gravação do lote, aplicado logo após o commit: {(tabela, id): (tenant_id, valor)}
+_late_feedback: Dict[Tuple[str, int], Tuple[int, int]] = {}
+_lock = threading.Lock()
+
+# Bloco de ids em uso por tabela: [próximo, fim, id em id_blocks, última renovação (monotonic)]
+_id_blocks: Dict[str, List] = {}
+_id_lock = None
+_flush_lock = None
+_flusher_task = None
+_last_cleanup = 0.0
+
+
+def _get_id_lock() -> asyncio.Lock:
+    global _id_lock
+    if _id_lock is None:
+        _id_lock = asyncio.Lock()
+    return _id_lock
+
+
+def _get_flush_lock() -> asyncio.Lock:
+    global _flush_lock
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+    return _flush_lock
+
+
+async def _reserve_block(model, size: int) -> Tuple[int, int]:
+    """
+    Reserva `size` ids consecutivos da tabela do `model` e registra o bloco em id_blocks.
+    Devolve (primeiro id, id do bloco em id_blocks).
+    """
+    name = model.__tablename__
+    async with AsyncSessionLocal() as db:
+        # Primeira reserva: começa depois do maior id já gravado
+        await db.execute(
+            dialect_insert(IdAllocator)
+            .values(name=name, next_id=select(func.coalesce(func.max(model.id), 0) + 1).scalar_subquery())
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+        # O UPDATE trava a linha até o commit: workers concorrentes recebem blocos distintos
+        await db.execute(update(IdAllocator).where(IdAllocator.name == name).values(next_id=IdAllocator.next_id + size))
+        end = await db.scalar(select(IdAllocator.next_id).where(IdAllocator.name == name))
+        block = IdBlock(name=name, start=end - size, end=end, touched_at=datetime.utcnow())
+        db.add(block)
+        await db.commit()
+    metrics.incr("history.id_blocks")
+    return end - size, block.id
+
+
+async def _touch_block(block_id: int) -> None:
+    """Renova o bloco em id_blocks: continua vivo para o feedback guardado por outros workers."""
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(IdBlock).where(IdBlock.id == block_id).values(touched_at=datetime.utcnow()))
+        await db.commit()
+
+
+async def allocate_ids(model, count: int = 1) -> List[int]:
+    """Ids para novas linhas de `model`, sem inserir nada (uma ida ao banco a cada bloco)."""
+    name = model.__tablename__
+    ids = []
+    async with _get_id_lock():
+        while len(ids) < count:
+            block = _id_blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                start, block_id = await _reserve_block(model, HISTORY_ID_BLOCK_SIZE)
+                block = _id_blocks[name] = [start, start + HISTORY_ID_BLOCK_SIZE, block_id, time.monotonic()]
+            elif time.monotonic() - block[3] > HISTORY_PENDING_FEEDBACK_TTL / 2:
+                # Bloco usado devagar: renova antes que expire com linhas ainda por gravar
+                await _touch_block(block[2])
+                block[3] = time.monotonic()
+            take = min(count - len(ids), block[1] - block[0])
+            ids.extend(range(block[0], block[0] + take))
+            block[0] += take
+    return ids
+
+
+async def add_all(objs: List, kind: str, docs: Optional[List[List[dict]]] = None) -> List[int]:
+    """
+    Enfileira novas linhas (Prompt ou ChatMessage, todas do mesmo modelo) e devolve os ids já
+    definitivos. `kind` é o tipo de uso contado no ledger de quota; `docs`, as fontes de cada
+    ChatMessage. A quota já enxerga o uso enfileirado.
+    """
+    if not objs:
+        return []
+    model = type(objs[0])
+    ids = await allocate_ids(model, len(objs))
+    now = datetime.utcnow()
+    with _lock:
+        for i, (obj, row_id) in enumerate(zip(objs, ids)):
+            obj.id = row_id
+            if obj.created_at is None:
+                obj.created_at = now
+            _pending[(model.__tablename__, row_id)] = {
+                "obj": obj,
+                "tenant_id": obj.tenant_id,
+                "day": obj.created_at.date(),
+                "kind": kind,
+                "docs": docs[i] if docs else None,
+            }
+            quota_service.add_pending(obj.tenant_id, kind, obj.created_at.date())
+        size = len(_pending)
+    metrics.set_gauge("history.pending", size)
+    if size >= HISTORY_FLUSH_MAX_ROWS:
+        asyncio.ensure_future(flush())
+    return ids
+
+
+async def add(obj, kind: str, docs: Optional[List[dict]] = None) -> int:
+    return (await add_all([obj], kind, [docs] if docs is not None else None))[0]
+
+
+def apply_feedback(model, row_id: int, tenant_id: int, value: int) -> bool:
+    """
+    Aplica o feedback a uma linha ainda não gravada. Retorna False quando a linha não está
+    na fila (já gravada ou inexistente): aí quem chama atualiza o banco normalmente.
+    """
+    key = (model.__tablename__, row_id)
+    with _lock:
+        item = _pending.get(key)
+        if item is not None:
+            if item["tenant_id"] != tenant_id:
+                return False
+            item["obj"].feedback = value
+            return True
+        item = _flushing.get(key)
+        owner = item["tenant_id"] if item is not None else _late_feedback.get(key, (None, None))[0]
+        if owner is None or owner != tenant_id:
+            return False
+        _late_feedback[key] = (tenant_id, value)
+        return True
+
+
+def defer_feedback(db: Session, model, row_id: int, tenant_id: int, value: int) -> bool:
+    """
+    Feedback de uma linha que não está no banco nem na fila deste worker. Se o id é de um
+    bloco ainda vivo em id_blocks, a linha pode estar na fila de outro worker: o feedback é
+    guardado em pending_feedback e aplicado quando ela for gravada (True). Fora disso: False.
+    """
+    live_since = datetime.utcnow() - timedelta(seconds=HISTORY_PENDING_FEEDBACK_TTL)
+    block = db.scalar(
+        select(IdBlock.id).where(
+            IdBlock.name == model.__tablename__,
+            IdBlock.start <= row_id,
+            IdBlock.end > row_id,
+            IdBlock.touched_at >= live_since
+        ).limit(1)
+    )
+    if block is None:
+        return False
+    stmt = dialect_insert(PendingFeedback).values(
+        table_name=model.__tablename__, row_id=row_id, tenant_id=tenant_id, value=value, created_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PendingFeedback.table_name, PendingFeedback.row_id, PendingFeedback.tenant_id],
+        set_={"value": stmt.excluded.value, "created_at": stmt.excluded.created_at}
+    )
+    db.execute(stmt)
+    db.commit()
+    metrics.incr("history.deferred_feedback")
+    return True
+
+
+async def _write(batch: Dict[Tuple[str, int], dict]) -> None:
+    async with AsyncSessionLocal() as db:
+        db.add_all([item["obj"] for item in batch.values()])
+        await db.flush()
+        for item in batch.values():
+            if item["docs"]:
+                await history_service.save_sources(db, item["tenant_id"], item["obj"].id, item["docs"])
+        for (tenant_id, day, kind), amount in _quota_counts(batch).items():
+            await quota_service.increment(db, tenant_id, kind, amount, day=day)
+        await analytics_service.add_counts(db, Counter(
+            analytics_service.bucket(item["tenant_id"], item["obj"].usuario, item["kind"], item["obj"].created_at, item["obj"].feedback)
+            for item in batch.values()
+        ))
+        await db.commit()
+
+
+def _quota_counts(batch: Dict[Tuple[str, int], dict]) -> Counter:
+    return Counter((item["tenant_id"], item["day"], item["kind"]) for item in batch.values())
+
+
+# Tabela -> (modelo, tipo de uso no rollup de analytics)
+_MODELS = {ChatMessage.__tablename__: (ChatMessage, quota_service.RAG_QUESTIONS), Prompt.__tablename__: (Prompt, quota_service.PROMPTS)}
+
+
+async def _apply_late_feedback() -> None:
+    while True:
+        with _lock:
+            late = dict(_late_feedback)
+        if not late:
+            return
+        async with AsyncSessionLocal() as db:
+            for (table, row_id), (_, value) in late.items():
+                model, kind = _MODELS[table]
+                row = await db.get(model, row_id)
+                if row is None:
+                    continue
+                if not await analytics_service.achange_feedback(db, kind, row, value):
+                    logger.warning(f"Feedback de {table} id={row_id} não aplicado: a linha mudou em todas as tentativas.")
+            await db.commit()
+        with _lock:
+            # Um feedback mais novo chegado durante o UPDATE fica para a próxima volta
+            for key, entry in late.items():
+                if _late_feedback.get(key) == entry:
+                    del _late_feedback[key]
+
+
+async def _apply_stored_feedback() -> None:
+    """
+    Aplica às linhas já gravadas o feedback guardado em pending_feedback (por qualquer worker).
+    Só lê entradas cuja linha já está no banco (JOIN): as que ainda esperam não ocupam o lote
+    e, se a linha nunca chegar, saem na limpeza periódica.
+    """
+    global _last_cleanup
+    async with AsyncSessionLocal() as db:
+        for table, (model, kind) in _MODELS.items():
+            stored = (await db.execute(
+                select(PendingFeedback, model)
+                .join(model, (model.id == PendingFeedback.row_id) & (model.tenant_id == PendingFeedback.tenant_id))
+                .where(PendingFeedback.table_name == table)
+                .order_by(PendingFeedback.id)
+                .limit(HISTORY_FLUSH_MAX_ROWS)
+            )).all()
+            for entry, row in stored:
+                # Quem apagar a entrada aplica o feedback: dois workers não movem o rollup duas vezes
+                taken = await db.execute(delete(PendingFeedback).where(PendingFeedback.id == entry.id))
+                if taken.rowcount != 1:
+                    continue
+                if not await analytics_service.achange_feedback(db, kind, row, entry.value):
+                    logger.warning(f"Feedback guardado de {table} id={entry.row_id} não aplicado: a linha mudou em todas as tentativas.")
+        if time.monotonic() - _last_cleanup >= HISTORY_CLEANUP_INTERVAL:
+            expire_before = datetime.utcnow() - timedelta(seconds=HISTORY_PENDING_FEEDBACK_TTL)
+            await db.execute(delete(PendingFeedback).where(PendingFeedback.created_at < expire_before))
+            await db.execute(delete(IdBlock).where(IdBlock.touched_at < expire_before))
+            _last_cleanup = time.monotonic()
+        await db.commit()
+
+
+async def _write_each(batch: Dict[Tuple[str, int], dict]) -> Tuple[dict, dict, dict]:
+    """
+    Grava o lote uma linha por transação, depois que a gravação conjunta falhou, para isolar
+    a linha com problema. Retorna (gravadas, descartadas, a tentar de novo).
+    """
+    written, dropped, retry = {}, {}, {}
+    for key, item in batch.items():
+        try:
+            await _write({key: item})
+            written[key] = item
+        except _BAD_ROW_ERRORS as e:
+            logger.error(f"Linha do histórico descartada ({key[0]} id={key[1]}, inquilino {item['tenant_id']}): {e}")
+            metrics.incr("history.dropped_rows")
+            dropped[key] = item
+        except Exception as e:
+            logger.error(f"Erro ao gravar linha do histórico ({key[0]} id={key[1]}): {e}")
+            retry[key] = item
+    return written, dropped, retry
+
+
+async def flush() -> None:
+    """Grava a fila numa única transação (linhas, fontes do chat, contadores de quota e rollup de analytics)."""
+    global _pending, _flushing
+    async with _get_flush_lock():
+        with _lock:
+            batch, _pending = _pending, {}
+            _flushing = batch
+        if batch:
+            written, dropped, retry = batch, {}, {}
+            try:
+                await _write(batch)
+            except Exception as e:
+                logger.error(f"Erro ao gravar histórico em lote ({len(batch)} linhas): {e}")
+                metrics.incr("history.flush_errors")
+                written, dropped, retry = await _write_each(batch)
+            # Linha descartada não conta mais na quota nem recebe feedback
+            quota_service.settle_pending(_quota_counts({**written, **dropped}))
+            metrics.observe("history.flush_rows", len(written))
+            with _lock:
+                for key in dropped:
+                    _late_feedback.pop(key, None)
+                # Devolve à fila o que falhou por outro motivo (ex.: banco fora do ar), com o feedback recebido nesse meio-tempo
+                for key, item in retry.items():
+                    if key in _late_feedback:
+                        item["obj"].feedback = _late_feedback.pop(key)[1]
+                _pending = {**retry, **_pending}
+                _flushing = {}
+                size = len(_pending)
+            metrics.set_gauge("history.pending", size)
+            if retry:
+                return
+        try:
+            await _apply_late_feedback()
+        except Exception as e:
+            logger.error(f"Erro ao aplicar feedback recebido durante a gravação: {e}")
+        try:
+            await _apply_stored_feedback()
+        except Exception as e:
+            logger.error(f"Erro ao aplicar feedback guardado por outros workers: {e}")
+
+
+async def _flush_forever():
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"Erro no flush periódico do histórico: {e}")
+
+
+def start_flusher() -> None:
+    """Inicia a gravação periódica (chamado no startup da API, dentro do event loop)."""
+    global _flusher_task
+    if _flusher_task is None:
+        _flusher_task = asyncio.get_running_loop().create_task(_flush_forever())
+
+
+async def stop_flusher() -> None:
+    """Para a gravação periódica e grava tudo o que estiver na fila (shutdown)."""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        _flusher_task = None
+    await flush()
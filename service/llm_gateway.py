@@ -0,0 +1,442 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from typing import Dict, Tuple, Optional
+
+import httpx
+import groq
+from tenacity import AsyncRetrying, retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential, before_sleep_log
+
+from langchain_core.messages import AIMessageChunk, message_chunk_to_message
+from langchain_ollama import ChatOllama
+
+from service.ai_config import get_llm, DEFAULT_MODEL
+from service.context_service import count_tokens
+from service import model_router, usage_service
+from core.circuit_breaker import CircuitBreaker
+from core.fair_scheduler import FairScheduler
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURAÇÃO DO GATEWAY ---
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "32"))
+
+# Provedor secundário (hedge/fallback): modelo de chat local no Ollama. Vazio = desligado.
+OLLAMA_CHAT_MODEL = os.getenv("OLLAMA_CHAT_MODEL", "")
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+# Sem primeiro token do provedor atual neste tempo (s), dispara o próximo em paralelo
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "2.5"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+PRIMARY_PROVIDER = "groq"
+FALLBACK_PROVIDER = "ollama"
+
+# Erros transitórios: vale a pena tentar de novo (com jitter)
+TRANSIENT_ERRORS = (
+    groq.APIConnectionError,
+    groq.APITimeoutError,
+    groq.RateLimitError,
+    groq.InternalServerError,
+    httpx.TransportError,
+)
+
+# Clientes de longa duração por (modelo, temperatura), todos sobre o mesmo pool HTTP
+_models: Dict[Tuple[str, float], object] = {}
+_models_lock = threading.Lock()
+_http_client = None
+_async_http_client = None
+# Limite de chamadas simultâneas ao LLM por processo, com fila justa entre inquilinos;
+# os caminhos síncrono e assíncrono dividem as mesmas vagas
+_scheduler = None
+# Um disjuntor por provedor: contorna quem está falhando
+_breakers = {
+    provider: CircuitBreaker(provider, failure_threshold=LLM_BREAKER_FAILURES, cooldown=LLM_BREAKER_COOLDOWN)
+    for provider in (PRIMARY_PROVIDER, FALLBACK_PROVIDER)
+}
+
+
+def _get_http_client() -> httpx.Client:
+    """Pool HTTP compartilhado (keep-alive: evita novo handshake TLS a cada chamada)."""
+    global _http_client
+    if _http_client is None:
+        with _models_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(
+                        max_connections=LLM_POOL_CONNECTIONS,
+                        max_keepalive_connections=LLM_POOL_CONNECTIONS
+                    ),
+                )
+    return _http_client
+
+
+def _get_async_http_client() -> httpx.AsyncClient:
+    """Pool HTTP assíncrono compartilhado, usado por ainvoke/astream."""
+    global _async_http_client
+    if _async_http_client is None:
+        with _models_lock:
+            if _async_http_client is None:
+                _async_http_client = httpx.AsyncClient(
+                    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(
+                        max_connections=LLM_POOL_CONNECTIONS,
+                        max_keepalive_connections=LLM_POOL_CONNECTIONS
+                    ),
+                )
+    return _async_http_client
+
+
+def _get_scheduler() -> FairScheduler:
+    global _scheduler
+    with _models_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler("llm.scheduler", LLM_MAX_CONCURRENCY)
+        return _scheduler
+
+
+def get_chat_model(temperature: float = 0.3, model: str = DEFAULT_MODEL):
+    """
+    Retorna o cliente de chat reutilizável para (modelo, temperatura).
+    Os retries do SDK ficam desligados: quem tenta de novo é o gateway, com jitter.
+    """
+    key = (model, float(temperature))
+    chat_model = _models.get(key)
+    if chat_model is None:
+        http_client = _get_http_client()
+        http_async_client = _get_async_http_client()
+        with _models_lock:
+            chat_model = _models.get(key)
+            if chat_model is None:
+                chat_model = get_llm(
+                    temperature=temperature,
+                    model=model,
+                    http_client=http_client,
+                    http_async_client=http_async_client,
+                    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    max_retries=0,
+                )
+                _models[key] = chat_model
+                logger.info(f"Cliente LLM criado para {model} (temperature={temperature})")
+    return chat_model
+
+
+def get_fallback_model(temperature: float = 0.3):
+    """Cliente de chat do provedor secundário (Ollama local), reutilizado por temperatura."""
+    key = (f"{FALLBACK_PROVIDER}:{OLLAMA_CHAT_MODEL}", float(temperature))
+    chat_model = _models.get(key)
+    if chat_model is None:
+        with _models_lock:
+            chat_model = _models.get(key)
+            if chat_model is None:
+                chat_model = ChatOllama(model=OLLAMA_CHAT_MODEL, temperature=temperature, base_url=OLLAMA_BASE_URL)
+                _models[key] = chat_model
+                logger.info(f"Cliente LLM secundário criado para {OLLAMA_CHAT_MODEL} (temperature={temperature})")
+    return chat_model
+
+
+def _attempt_order():
+    """
+    Provedores na ordem de tentativa, pulando os de circuito aberto.
+    Gerador preguiçoso: o disjuntor do próximo só é consultado se ele for de fato acionado.
+    Se todos estiverem abertos, tenta o primário mesmo assim.
+    """
+    providers = [PRIMARY_PROVIDER] + ([FALLBACK_PROVIDER] if OLLAMA_CHAT_MODEL else [])
+    tried = False
+    for provider in providers:
+        if _breakers[provider].allow():
+            tried = True
+            yield provider
+    if not tried:
+        yield PRIMARY_PROVIDER
+
+
+def _record(response, provider: str):
+    """Anota no AIMessage qual provedor respondeu."""
+    response.response_metadata["provider"] = provider
+    metrics.incr(f"llm.provider.{provider}")
+    return response
+
+
+def _usage_model(provider: str, model: str) -> str:
+    """Modelo que de fato respondeu (o secundário tem seu próprio tier nas métricas)."""
+    return model if provider == PRIMARY_PROVIDER else f"{provider}:{OLLAMA_CHAT_MODEL}"
+
+
+def _record_usage(provider: str, model: str, started: float, prompt, output: str = None, response=None, tenant_id=None):
+    """
+    Latência, tokens e custo da chamada (por tier e, com tenant_id, por inquilino/dia).
+    Tokens reportados pelo provedor quando disponíveis, senão estimados.
+    """
+    model = _usage_model(provider, model)
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage:
+        input_tokens, output_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    else:
+        text = prompt if isinstance(prompt, str) else "\n".join(str(getattr(m, "content", m)) for m in prompt)
+        input_tokens, output_tokens = count_tokens(text), count_tokens(output or "")
+    seconds = time.perf_counter() - started
+    model_router.record_usage(model, seconds, input_tokens, output_tokens)
+    usage_service.record(tenant_id, model, input_tokens, output_tokens, seconds * 1000)
+
+
+def provider_of(response) -> Optional[str]:
+    """Provedor que gerou o AIMessage retornado por invoke/ainvoke."""
+    return getattr(response, "response_metadata", {}).get("provider")
+
+
+@retry(
+    retry=retry_if_exception_type(TRANSIENT_ERRORS),
+    stop=stop_after_attempt(LLM_MAX_RETRIES),
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+def _invoke_with_retry(chat_model, prompt):
+    return chat_model.invoke(prompt)
+
+
+def _with_fallback(call):
+    """Caminho síncrono: tenta os provedores em sequência (sem hedge), alimentando os disjuntores."""
+    last_error = None
+    for provider in _attempt_order():
+        try:
+            result = call(provider)
+        except Exception as e:
+            _breakers[provider].record_failure()
+            logger.warning(f"Provedor LLM {provider} falhou: {e}")
+            last_error = e
+            continue
+        _breakers[provider].record_success()
+        return result, provider
+    raise last_error
+
+
+def invoke(prompt, temperature: float = 0.3, model: str = DEFAULT_MODEL, tenant_id=None):
+    """
+    Ponto único de chamada ao LLM: cliente em pool, timeouts explícitos,
+    retry com jitter para erros transitórios e limite de concorrência por processo
+    (as mesmas vagas do `ainvoke`).
+    Se o primário falhar (ou estiver com o circuito aberto), usa o secundário.
+    Aceita string ou lista de mensagens; retorna o AIMessage (ver `provider_of`).
+    Com `tenant_id`, o consumo é contabilizado para o inquilino (usage_service).
+    """
+    def call(provider):
+        if provider == PRIMARY_PROVIDER:
+            return _invoke_with_retry(get_chat_model(temperature=temperature, model=model), prompt)
+        return get_fallback_model(temperature).invoke(prompt)
+
+    started = time.perf_counter()
+    with _get_scheduler().blocking_slot(tenant_id):
+        response, provider = _with_fallback(call)
+    _record_usage(provider, model, started, prompt, response=response, tenant_id=tenant_id)
+    return _record(response, provider)
+
+
+def stream(prompt, temperature: float = 0.3, model: str = DEFAULT_MODEL, meta: Optional[dict] = None, tenant_id=None):
+    """
+    Versão em stream do `invoke`: produz os trechos de texto conforme chegam.
+    O retry só cobre a abertura do stream (antes do primeiro token); uma falha
+    no meio da resposta é propagada, pois o cliente já recebeu parte do texto.
+    A vaga de concorrência fica ocupada até o fim do stream.
+    `meta["provider"]` recebe o provedor que respondeu.
+    """
+    def call(provider):
+        if provider == PRIMARY_PROVIDER:
+            return _open_stream_with_retry(get_chat_model(temperature=temperature, model=model), prompt)
+        return _open_stream(get_fallback_model(temperature), prompt)
+
+    started = time.perf_counter()
+    with _get_scheduler().blocking_slot(tenant_id):
+        chunks, provider = _with_fallback(call)
+        metrics.incr(f"llm.provider.{provider}")
+        if meta is not None:
+            meta["provider"] = provider
+        parts = []
+        try:
+            for chunk in chunks:
+                if chunk.content:
+                    parts.append(chunk.content)
+                    yield chunk.content
+        finally:
+            # Também quando o cliente desiste ou o provedor falha no meio: o já gerado é cobrado
+            _record_usage(provider, model, started, prompt, output="".join(parts), tenant_id=tenant_id)
+
+
+@retry(
+    retry=retry_if_exception_type(TRANSIENT_ERRORS),
+    stop=stop_after_attempt(LLM_MAX_RETRIES),
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+def _open_stream_with_retry(chat_model, prompt):
+    return _open_stream(chat_model, prompt)
+
+
+def _open_stream(chat_model, prompt):
+    iterator = iter(chat_model.stream(prompt))
+    # Força a conexão e o primeiro chunk dentro do retry
+    first = next(iterator, None)
+    if first is None:
+        return iter(())
+    return itertools.chain([first], iterator)
+
+
+def _async_retrying() -> AsyncRetrying:
+    return AsyncRetrying(
+        retry=retry_if_exception_type(TRANSIENT_ERRORS),
+        stop=stop_after_attempt(LLM_MAX_RETRIES),
+        wait=wait_random_exponential(multiplier=0.5, max=8),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True,
+    )
+
+
+async def _hedged(start):
+    """
+    Hedge entre provedores: `start(provider)` é disparado para o primeiro provedor; se não
+    concluir em LLM_HEDGE_DELAY segundos, o próximo é disparado em paralelo (e também
+    imediatamente após uma falha). Vence o primeiro a concluir com sucesso; os demais são
+    cancelados. Retorna (resultado, provedor).
+    """
+    order = _attempt_order()
+    pending = {}
+    errors = []
+
+    def launch() -> bool:
+        provider = next(order, None)
+        if provider is None:
+            return False
+        pending[asyncio.ensure_future(start(provider))] = provider
+        return True
+
+    launch()
+    exhausted = False
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending, timeout=None if exhausted else LLM_HEDGE_DELAY, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                exhausted = not launch()
+                if not exhausted:
+                    metrics.incr("llm.hedge.fired")
+                continue
+            for task in done:
+                provider = pending.pop(task)
+                if task.exception() is None:
+                    _breakers[provider].record_success()
+                    return task.result(), provider
+                _breakers[provider].record_failure()
+                logger.warning(f"Provedor LLM {provider} falhou: {task.exception()}")
+                errors.append(task.exception())
+            if not pending and not exhausted:
+                exhausted = not launch()
+        raise errors[0]
+    finally:
+        for task, provider in pending.items():
+            task.cancel()
+            _breakers[provider].release()
+
+
+async def _aopen_stream(provider: str, prompt, temperature: float, model: str):
+    """Abre o stream e aguarda o primeiro chunk (é ele que decide o hedge). Retorna (primeiro, iterador)."""
+    async def open_once(chat_model):
+        iterator = chat_model.astream(prompt).__aiter__()
+        try:
+            return await iterator.__anext__(), iterator
+        except StopAsyncIteration:
+            return None, iterator
+
+    if provider != PRIMARY_PROVIDER:
+        return await open_once(get_fallback_model(temperature))
+    chat_model = get_chat_model(temperature=temperature, model=model)
+    async for attempt in _async_retrying():
+        with attempt:
+            return await open_once(chat_model)
+
+
+async def ainvoke(prompt, temperature: float = 0.3, model: str = DEFAULT_MODEL, tenant_id=None):
+    """
+    Versão assíncrona do `invoke`: não ocupa thread enquanto espera o LLM,
+    permitindo centenas de chamadas em andamento num único worker.
+    Com OLLAMA_CHAT_MODEL configurado, faz hedge com o modelo local (ver `_hedged`) até o
+    primeiro token; a resposta é montada a partir do stream do provedor vencedor.
+    Acima de LLM_MAX_CONCURRENCY, as chamadas esperam em fila justa por inquilino.
+    """
+    started = time.perf_counter()
+    async with _get_scheduler().slot(tenant_id):
+        # O hedge decide pelo primeiro token (como no astream), não pela resposta inteira:
+        # gerações longas do primário não disparam uma segunda geração no secundário
+        (first, iterator), provider = await _hedged(lambda p: _aopen_stream(p, prompt, temperature, model))
+        response = first if first is not None else AIMessageChunk(content="")
+        try:
+            if first is not None:
+                async for chunk in iterator:
+                    response = response + chunk
+        except BaseException:
+            # Cancelada ou interrompida no meio: cobra o texto já gerado
+            _record_usage(provider, model, started, prompt, output=response.content, tenant_id=tenant_id)
+            raise
+    response = message_chunk_to_message(response)
+    _record_usage(provider, model, started, prompt, response=response, tenant_id=tenant_id)
+    return _record(response, provider)
+
+
+async def astream(prompt, temperature: float = 0.3, model: str = DEFAULT_MODEL, meta: Optional[dict] = None, tenant_id=None):
+    """
+    Versão assíncrona do `stream`. Mesmo contrato: retry só até o primeiro chunk.
+    O hedge vale para o primeiro token; depois dele o stream segue com o provedor vencedor.
+    """
+    started = time.perf_counter()
+    async with _get_scheduler().slot(tenant_id):
+        (first, iterator), provider = await _hedged(lambda p: _aopen_stream(p, prompt, temperature, model))
+        metrics.incr(f"llm.provider.{provider}")
+        metrics.observe(f"llm.tier.{model_router.tier_of(_usage_model(provider, model))}.ttft_ms", (time.perf_counter() - started) * 1000)
+        if meta is not None:
+            meta["provider"] = provider
+        parts = []
+        try:
+            if first is None:
+                return
+            if first.content:
+                parts.append(first.content)
+                yield first.content
+            async for chunk in iterator:
+                if chunk.content:
+                    parts.append(chunk.content)
+                    yield chunk.content
+        finally:
+            # Também quando o cliente desconecta ou o provedor falha no meio: o já gerado é cobrado
+            _record_usage(provider, model, started, prompt, output="".join(parts), tenant_id=tenant_id)
+
+
+def close():
+    """Fecha os pools HTTP (chamado no shutdown da API)."""
+    global _http_client, _async_http_client, _scheduler
+    with _models_lock:
+        _models.clear()
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+        # O pool assíncrono só pode ser fechado com await (ver aclose)
+        _async_http_client = None
+        _scheduler = None
+
+
+async def aclose():
+    """Fecha também o pool assíncrono; usado no shutdown da API."""
+    async_client = _async_http_client
+    close()
+    if async_client is not None:
+        await async_client.aclose()
@@ -1,11 +1,31 @@
-from service.ai_config import get_llm
+from service import llm_gateway
+from service.ai_config import DEFAULT_MODEL
 
 # Usamos temperature 0.1 para respostas mais precisas e estruturadas
-llm = get_llm(temperature=0.1)
+TEMPERATURE = 0.1
 
-def gerar_resposta(prompt: str | list) -> str:
+def gerar_resposta(prompt: str | list, model: str = DEFAULT_MODEL, tenant_id=None) -> str:
     """
     Invoca o LLM. Aceita tanto uma string simples quanto uma 
     lista de mensagens formatadas por um template.
     """
-    return llm.invoke(prompt).content
+    return llm_gateway.invoke(prompt, temperature=TEMPERATURE, model=model, tenant_id=tenant_id).content
+
+
+def gerar_resposta_stream(prompt: str | list, model: str = DEFAULT_MODEL, tenant_id=None):
+    """Versão em stream do gerar_resposta: produz os trechos de texto conforme chegam."""
+    yield from llm_gateway.stream(prompt, temperature=TEMPERATURE, model=model, tenant_id=tenant_id)
+
+
+async def agerar_resposta(prompt: str | list, model: str = DEFAULT_MODEL, tenant_id=None):
+    """
+    Versão assíncrona do gerar_resposta (não bloqueia o event loop).
+    Retorna o AIMessage para preservar o provedor que respondeu (llm_gateway.provider_of).
+    """
+    return await llm_gateway.ainvoke(prompt, temperature=TEMPERATURE, model=model, tenant_id=tenant_id)
+
+
+async def agerar_resposta_stream(prompt: str | list, meta: dict = None, model: str = DEFAULT_MODEL, tenant_id=None):
+    """Versão assíncrona do gerar_resposta_stream; `meta["provider"]` recebe o provedor."""
+    async for text in llm_gateway.astream(prompt, temperature=TEMPERATURE, model=model, meta=meta, tenant_id=tenant_id):
+        yield text
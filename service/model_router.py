@@ -0,0 +1,92 @@
+import os
+import json
+import logging
+from typing import NamedTuple, Optional
+
+from service.ai_config import DEFAULT_MODEL, SMALL_MODEL, MODEL_PRICING
+from service.context_service import count_tokens
+from db.models import TIER_LIMITS
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# Tiers de modelo disponíveis para o roteamento
+MODEL_TIERS = {
+    "small": SMALL_MODEL,
+    "large": DEFAULT_MODEL,
+}
+
+# Política global: "auto" (por complexidade), "small" ou "large"
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "auto").lower()
+# Overrides por inquilino: JSON {"<tenant_id>": "small" | "large" | "auto"}
+MODEL_ROUTING_OVERRIDES = json.loads(os.getenv("MODEL_ROUTING_OVERRIDES", "{}") or "{}")
+
+# Acima destes limites a pergunta do RAG vai para o modelo grande
+SMALL_MAX_QUESTION_TOKENS = int(os.getenv("ROUTING_SMALL_MAX_QUESTION_TOKENS", "40"))
+SMALL_MAX_CONTEXT_TOKENS = int(os.getenv("ROUTING_SMALL_MAX_CONTEXT_TOKENS", "1200"))
+
+# Indícios de raciocínio (comparar, explicar, analisar...) que pedem o modelo grande
+COMPLEX_MARKERS = (
+    "compar", "diferença", "por que", "porque", "explique", "explica", "analis", "análise",
+    "avali", "resum", "vantage", "desvantage", "passo a passo", "justifi", "impacto",
+    "why", "explain", "analy", "summar",
+)
+
+
+class Route(NamedTuple):
+    tier: str
+    model: str
+    reason: str
+
+
+def _policy(tenant_id=None, subscription_tier: Optional[str] = None) -> str:
+    """Política efetiva: override do inquilino > política do plano (TIER_LIMITS) > MODEL_ROUTING."""
+    override = MODEL_ROUTING_OVERRIDES.get(str(tenant_id)) if tenant_id is not None else None
+    if override:
+        return override.lower()
+    tier_policy = TIER_LIMITS.get(subscription_tier or "", {}).get("model_routing")
+    if tier_policy and tier_policy != "auto":
+        return tier_policy
+    return MODEL_ROUTING
+
+
+def route(task: str, question: str, context: str = "", tenant_id=None, subscription_tier: Optional[str] = None) -> Route:
+    """
+    Escolhe o tier de modelo da requisição a partir de sinais baratos:
+    tipo de tarefa ("rag" ou "generation"), tamanho da pergunta e do contexto recuperado.
+    Consultas pontuais do RAG vão para o modelo pequeno; geração do Prompt Hub e
+    perguntas longas/analíticas vão para o grande.
+    """
+    policy = _policy(tenant_id, subscription_tier)
+    if policy in MODEL_TIERS:
+        return Route(policy, MODEL_TIERS[policy], "override")
+
+    if task != "rag":
+        return Route("large", MODEL_TIERS["large"], "generation")
+
+    lowered = question.casefold()
+    if any(marker in lowered for marker in COMPLEX_MARKERS):
+        return Route("large", MODEL_TIERS["large"], "complex_question")
+    if count_tokens(question) > SMALL_MAX_QUESTION_TOKENS:
+        return Route("large", MODEL_TIERS["large"], "long_question")
+    if context and count_tokens(context) > SMALL_MAX_CONTEXT_TOKENS:
+        return Route("large", MODEL_TIERS["large"], "large_context")
+    return Route("small", MODEL_TIERS["small"], "simple_lookup")
+
+
+def tier_of(model: str) -> str:
+    for tier, tier_model in MODEL_TIERS.items():
+        if tier_model == model:
+            return tier
+    return model
+
+
+def record_usage(model: str, seconds: float, input_tokens: int, output_tokens: int) -> None:
+    """Registra chamadas, latência, tokens e custo estimado por tier em /ops/metrics."""
+    tier = tier_of(model)
+    price_in, price_out = MODEL_PRICING.get(model, (0.0, 0.0))
+    metrics.incr(f"llm.tier.{tier}.calls")
+    metrics.observe(f"llm.tier.{tier}.latency_ms", seconds * 1000)
+    metrics.incr(f"llm.tier.{tier}.input_tokens", input_tokens)
+    metrics.incr(f"llm.tier.{tier}.output_tokens", output_tokens)
+    metrics.incr(f"llm.tier.{tier}.cost_usd", (input_tokens * price_in + output_tokens * price_out) / 1_000_000)
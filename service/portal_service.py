@@ -1,6 +1,9 @@
 import streamlit as st
 import requests
+import httpx
+import json
 import time
+from httpx_sse import connect_sse
 
 class PortalService:
     def __init__(self, api_url):
@@ -53,6 +56,35 @@ class PortalService:
             st.error(f"❌ Erro inesperado: {str(e)}")
         return None
 
+    def _stream_events(self, method, endpoint, **kwargs):
+        """
+        Consome um endpoint Server-Sent Events e produz tuplas (evento, dados).
+        Falhas de conexão/HTTP viram um evento `error` para a UI tratar no mesmo fluxo.
+        """
+        url = f"{self.api_url}{endpoint}"
+        # Sem read-timeout curto: tokens podem demorar entre si, mas a conexão deve abrir rápido
+        timeout = httpx.Timeout(120, connect=5)
+        try:
+            with httpx.Client(timeout=timeout) as client:
+                with connect_sse(client, method, url, headers=self.get_headers(), **kwargs) as event_source:
+                    response = event_source.response
+                    if response.status_code != 200:
+                        response.read()
+                        try:
+                            detail = response.json().get("detail", response.text)
+                        except ValueError:
+                            detail = response.text
+                        yield "error", {"status": response.status_code, "detail": detail}
+                        return
+                    for sse in event_source.iter_sse():
+                        yield sse.event, json.loads(sse.data) if sse.data else None
+        except httpx.ConnectError:
+            yield "error", {"status": None, "detail": "O servidor da API parece estar offline."}
+        except httpx.TimeoutException:
+            yield "error", {"status": None, "detail": "A requisição demorou muito para responder (Timeout)."}
+        except Exception as e:
+            yield "error", {"status": None, "detail": f"Erro inesperado: {str(e)}"}
+
     def login(self, username, password):
         res = self._safe_request("POST", "/auth/login", params={"usuario": username, "senha": password})
         if res and res.status_code == 200:
@@ -88,11 +120,25 @@ class PortalService:
     def generate_content(self, tema):
         return self._safe_request("POST", "/prompt/gerar_conteudo", params={"tema": tema})
 
-    def rag_search(self, query, k):
-        return self._safe_request("GET", "/rag/search", params={"msg": query, "k": k})
+    def generate_content_stream(self, tema):
+        return self._stream_events("POST", "/prompt/gerar_conteudo/stream", params={"tema": tema})
 
-    def rag_ask(self, question, k, threshold):
-        payload = {"question": question, "k": k, "score_threshold": threshold}
+    def generate_content_batch_stream(self, temas):
+        return self._stream_events("POST", "/prompt/gerar_lote", json={"temas": temas, "stream": True})
+
+    def rag_ask_stream(self, question, k, threshold, scopes=None, filters=None):
+        payload = {"question": question, "k": k, "score_threshold": threshold, "scopes": scopes or ["user"], "filters": filters}
+        return self._stream_events("POST", "/rag/ask_prompt/stream", json=payload)
+
+    def rag_search(self, query, k, scopes=None, filters=None, cursor=None):
+        params = {"msg": query, "k": k, "scopes": scopes or ["user"]}
+        params.update({key: value for key, value in (filters or {}).items() if value})
+        if cursor:
+            params["cursor"] = cursor
+        return self._safe_request("GET", "/rag/search", params=params)
+
+    def rag_ask(self, question, k, threshold, scopes=None, filters=None):
+        payload = {"question": question, "k": k, "score_threshold": threshold, "scopes": scopes or ["user"], "filters": filters}
         return self._safe_request("POST", "/rag/ask_prompt", json=payload)
 
     def update_rag_feedback(self, message_id, value):
@@ -120,8 +166,35 @@ class PortalService:
     def register_user(self, username, password):
         return self._safe_request("POST", "/auth/register", params={"usuario": username, "senha": password})
 
-    def get_prompt_history(self):
-        return self._safe_request("GET", "/prompt/historico")
-
-    def get_rag_history(self):
-        return self._safe_request("GET", "/rag/historico")
+    @staticmethod
+    def _history_params(view, page_size, cursor, filters):
+        params = {"view": view, "page_size": page_size}
+        if cursor:
+            params["cursor"] = cursor
+        # Filtros opcionais: date_from, date_to, feedback, usuario
+        params.update({k: v for k, v in filters.items() if v is not None and v != ""})
+        return params
+
+    def get_prompt_history(self, view="full", page_size=20, cursor=None, **filters):
+        """Uma página do histórico de prompts; a próxima vem de `next_cursor` na resposta."""
+        return self._safe_request("GET", "/prompt/historico", params=self._history_params(view, page_size, cursor, filters))
+
+    def get_rag_history(self, view="full", page_size=20, cursor=None, **filters):
+        """Uma página do histórico de chat; a próxima vem de `next_cursor` na resposta."""
+        return self._safe_request("GET", "/rag/historico", params=self._history_params(view, page_size, cursor, filters))
+
+    def search_history(self, q, kind=None, usuario=None, page_size=20, cursor=None):
+        """Busca textual no histórico (prompts e RAG), por relevância; a próxima página vem de `next_cursor`."""
+        params = {k: v for k, v in {"q": q, "kind": kind, "usuario": usuario, "page_size": page_size, "cursor": cursor}.items() if v}
+        return self._safe_request("GET", "/historico/search", params=params)
+
+    def get_usage_analytics(self, date_from=None, date_to=None, usuario=None):
+        """Contagens agregadas de uso (por dia, hora, feedback e usuário) para o Dashboard."""
+        params = {k: v for k, v in {"date_from": date_from, "date_to": date_to, "usuario": usuario}.items() if v}
+        return self._safe_request("GET", "/analytics/usage", params=params)
+
+    def get_prompt_detail(self, prompt_id):
+        return self._safe_request("GET", f"/prompt/historico/{prompt_id}")
+
+    def get_rag_detail(self, message_id):
+        return self._safe_request("GET", f"/rag/historico/{message_id}")
@@ -1,12 +1,24 @@
+import logging
+from typing import Dict, Optional, Tuple
+
 from langchain_core.prompts import ChatPromptTemplate
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-def get_professional_prompt_template():
-    """
-    Retorna um template de prompt estruturado para geração de conteúdo.
-    Define persona, diretrizes e formato esperado.
-    """
-    return ChatPromptTemplate.from_messages([
-        ("system", """Você é um Assistente de Inteligência Artificial Especialista e Consultor Técnico.
+from db.models import Prompt, PromptTemplate
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_NAME = "professional"
+
+# Versões do template (system, human), gravadas em prompt_templates. Cada Prompt guarda só o id
+# da versão usada e as variáveis (tema, usuario); o texto renderizado é refeito sob demanda.
+# Para mudar o template, acrescente uma nova versão em vez de editar as anteriores.
+TEMPLATES: Dict[int, Tuple[str, str]] = {
+    1: (
+        """Você é um Assistente de Inteligência Artificial Especialista e Consultor Técnico.
         Sua tarefa é fornecer respostas precisas, claras e bem estruturadas sobre o tema solicitado.
         
         DIRETRIZES:
@@ -14,15 +26,79 @@ def get_professional_prompt_template():
         2. Se o tema for uma pergunta, forneça a resposta técnica detalhada.
         3. Se o tema for uma solicitação de criação de conteúdo, gere o conteúdo estruturado.
         4. Use um tom de voz executivo, preciso e inspirador.
-        5. Responda sempre em Português Brasileiro (pt-BR)."""),
-        
-        ("human", "Tema ou Pergunta: '{tema}'. \n\nPor favor, forneça o melhor conteúdo ou resposta possível para o usuário '{usuario}'.")
-    ])
+        5. Responda sempre em Português Brasileiro (pt-BR).""",
+        "Tema ou Pergunta: '{tema}'. \n\nPor favor, forneça o melhor conteúdo ou resposta possível para o usuário '{usuario}'."
+    ),
+}
+
+# Versão em uso: respostas de versões diferentes não são intercambiáveis
+TEMPLATE_VERSION = max(TEMPLATES)
+
+# id da versão em uso em prompt_templates (definido no startup por `register_templates`)
+_current_template_id: Optional[int] = None
+# Versões já lidas do banco (as linhas de prompt_templates são imutáveis)
+_templates_by_id: Dict[int, Tuple[str, str]] = {}
+
 
-def format_prompt(tema: str, usuario: str) -> str:
+def _build(system: str, human: str) -> ChatPromptTemplate:
+    return ChatPromptTemplate.from_messages([("system", system), ("human", human)])
+
+
+def get_professional_prompt_template(version: int = TEMPLATE_VERSION):
+    """
+    Retorna um template de prompt estruturado para geração de conteúdo.
+    Define persona, diretrizes e formato esperado.
+    """
+    return _build(*TEMPLATES[version])
+
+def format_prompt(tema: str, usuario: str, version: int = TEMPLATE_VERSION) -> str:
     """
     Formata o prompt usando o template estruturado.
     """
-    template = get_professional_prompt_template()
+    template = get_professional_prompt_template(version)
     # Retorna o objeto formatado pronto para o LLM.invoke()
     return template.format_messages(tema=tema, usuario=usuario)
+
+
+def render(system: str, human: str, tema: str, usuario: str) -> str:
+    """Texto do prompt como era gravado em Prompt.prompt (str das mensagens formatadas)."""
+    return str(_build(system, human).format_messages(tema=tema, usuario=usuario))
+
+
+def register_templates(db: Session) -> int:
+    """
+    Garante uma linha em prompt_templates para cada versão de TEMPLATES (idempotente, seguro
+    com vários workers) e guarda o id da versão em uso. Chamado no startup.
+    """
+    global _current_template_id
+    for version, (system, human) in TEMPLATES.items():
+        exists = db.scalar(select(PromptTemplate.id).where(
+            PromptTemplate.name == TEMPLATE_NAME, PromptTemplate.version == version
+        ))
+        if exists is None:
+            try:
+                db.add(PromptTemplate(name=TEMPLATE_NAME, version=version, system=system, human=human))
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+    _current_template_id = db.scalar(select(PromptTemplate.id).where(
+        PromptTemplate.name == TEMPLATE_NAME, PromptTemplate.version == TEMPLATE_VERSION
+    ))
+    logger.info(f"Template de prompt '{TEMPLATE_NAME}' v{TEMPLATE_VERSION} (id {_current_template_id}).")
+    return _current_template_id
+
+
+def current_template_id() -> Optional[int]:
+    return _current_template_id
+
+
+async def rebuild_prompt(db: AsyncSession, prompt: Prompt) -> str:
+    """Prompt enviado ao LLM, refeito a partir da versão do template e das variáveis gravadas."""
+    if prompt.template_id is None:
+        # Linhas antigas que não vieram deste template guardam o texto renderizado
+        return prompt.prompt or ""
+    template = _templates_by_id.get(prompt.template_id)
+    if template is None:
+        row = await db.get(PromptTemplate, prompt.template_id)
+        template = _templates_by_id[prompt.template_id] = (row.system, row.human)
+    return render(*template, tema=prompt.tema, usuario=prompt.usuario)
@@ -0,0 +1,118 @@
+import threading
+from datetime import date, datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select
+
+from db.database import dialect_insert
+from db.models import QuotaUsage, TIER_LIMITS
+from service.tenant_cache import TenantInfo
+
+# Tipos de uso contados no ledger diário
+PROMPTS = "prompt"
+RAG_QUESTIONS = "rag"
+
+# Uso já aceito mas ainda na fila de gravação (service.history_writer): {(tenant_id, dia, tipo): quantidade}
+_pending: Dict[Tuple[int, date, str], int] = {}
+_lock = threading.Lock()
+
+
+def today() -> date:
+    """Dia corrente do ledger, em UTC: o mesmo relógio do created_at das linhas (datetime.utcnow)."""
+    return datetime.utcnow().date()
+
+
+async def used_today(db, tenant_id: int, kind: str) -> int:
+    """Uso do dia pelo inquilino: leitura de uma linha (índice único tenant/dia/tipo) mais o pendente."""
+    day = today()
+    used = await db.scalar(
+        select(QuotaUsage.count).where(
+            QuotaUsage.tenant_id == tenant_id,
+            QuotaUsage.day == day,
+            QuotaUsage.kind == kind
+        )
+    )
+    with _lock:
+        pending = _pending.get((tenant_id, day, kind), 0)
+    return (used or 0) + pending
+
+
+def add_pending(tenant_id: int, kind: str, day: date, amount: int = 1) -> None:
+    """Conta um uso cuja linha ainda não foi gravada, para a checagem de quota já enxergá-lo."""
+    with _lock:
+        _pending[(tenant_id, day, kind)] = _pending.get((tenant_id, day, kind), 0) + amount
+
+
+def settle_pending(counts: Dict[Tuple[int, date, str], int]) -> None:
+    """Retira do pendente o uso que acabou de ser gravado no ledger."""
+    with _lock:
+        for key, amount in counts.items():
+            remaining = _pending.get(key, 0) - amount
+            if remaining > 0:
+                _pending[key] = remaining
+            else:
+                _pending.pop(key, None)
+
+
+class Reservation:
+    """
+    Uso reservado antes de gerar (ex.: os itens de um lote): conta no pendente, e portanto na
+    checagem de quota, até ser liberado item a item (gravado ou falho) ou de uma vez com `release_all`.
+    """
+
+    def __init__(self, tenant_id: int, kind: str, day: date, amount: int):
+        self.key = (tenant_id, day, kind)
+        self.remaining = amount
+
+    def release(self, amount: int = 1) -> None:
+        with _lock:
+            amount = min(amount, self.remaining)
+            self.remaining -= amount
+        if amount > 0:
+            settle_pending({self.key: amount})
+
+    def release_all(self) -> None:
+        self.release(self.remaining)
+
+
+async def reserve(db, tenant_id: int, kind: str, amount: int, limit: Optional[int]) -> Optional[Reservation]:
+    """
+    Reserva `amount` usos do dia se couberem no limite, checando e somando ao pendente sob a mesma
+    trava: requisições simultâneas não passam juntas do limite. Retorna None se não couber.
+    """
+    day = today()
+    used = await db.scalar(
+        select(QuotaUsage.count).where(
+            QuotaUsage.tenant_id == tenant_id,
+            QuotaUsage.day == day,
+            QuotaUsage.kind == kind
+        )
+    )
+    with _lock:
+        if limit is not None and (used or 0) + _pending.get((tenant_id, day, kind), 0) + amount > limit:
+            return None
+        _pending[(tenant_id, day, kind)] = _pending.get((tenant_id, day, kind), 0) + amount
+    return Reservation(tenant_id, kind, day, amount)
+
+
+async def increment(db, tenant_id: int, kind: str, amount: int = 1, day: Optional[date] = None) -> None:
+    """
+    Soma `amount` ao contador do dia (hoje em UTC, se `day` não for informado) na transação da sessão
+    `db`; quem chama faz o commit junto com o Prompt/ChatMessage. O upsert é atômico no banco,
+    então vale entre workers.
+    """
+    stmt = dialect_insert(QuotaUsage).values(tenant_id=tenant_id, day=day or today(), kind=kind, count=amount)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[QuotaUsage.tenant_id, QuotaUsage.day, QuotaUsage.kind],
+        set_={"count": QuotaUsage.count + stmt.excluded.count}
+    )
+    await db.execute(stmt)
+
+
+def daily_limit(tenant: TenantInfo, kind: str) -> Optional[int]:
+    """Limite diário do tipo de uso para o inquilino (None = ilimitado)."""
+    if kind == PROMPTS:
+        return tenant.max_prompts_per_day
+    if kind == RAG_QUESTIONS:
+        return TIER_LIMITS.get(tenant.subscription_tier or "free", {}).get("max_rag_questions_per_day")
+    return None
@@ -1,15 +1,13 @@
-from service.ai_config import get_llm
+from service import llm_gateway
+from service.ai_config import DEFAULT_MODEL
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 import os
 
-
-def get_rag_chain():
-    llm = get_llm()
-
-    prompt = PromptTemplate(
-        input_variables=["context", "question"],
-        template="""Você é um assistente técnico especializado.
+# Template montado uma única vez no import (antes era recriado a cada pergunta)
+RAG_PROMPT = PromptTemplate(
+    input_variables=["context", "question"],
+    template="""Você é um assistente técnico especializado.
 
 Responda à PERGUNTA do usuário baseando-se EXCLUSIVAMENTE no CONTEXTO fornecido abaixo.
 O contexto contém fragmentos de documentos identificados por [[FONTE: nome_do_arquivo, PÁGINA: numero]].
@@ -28,16 +26,32 @@ PERGUNTA:
 
 RESPOSTA:
 """
-    )
+)
+
+
+def get_rag_chain():
+    return RAG_PROMPT | llm_gateway.get_chat_model()
+
+
+def ask_rag(context: str, question: str, model: str = DEFAULT_MODEL, tenant_id=None):
+    prompt = RAG_PROMPT.format(context=context, question=question)
+    return llm_gateway.invoke(prompt, model=model, tenant_id=tenant_id)
+
+
+def stream_rag(context: str, question: str, model: str = DEFAULT_MODEL, tenant_id=None):
+    """Gera a resposta do RAG em trechos (tokens) conforme o LLM produz."""
+    prompt = RAG_PROMPT.format(context=context, question=question)
+    yield from llm_gateway.stream(prompt, model=model, tenant_id=tenant_id)
+
 
-    return prompt | llm
+async def aask_rag(context: str, question: str, model: str = DEFAULT_MODEL, tenant_id=None):
+    """Versão assíncrona do ask_rag."""
+    prompt = RAG_PROMPT.format(context=context, question=question)
+    return await llm_gateway.ainvoke(prompt, model=model, tenant_id=tenant_id)
 
 
-def ask_rag(context: str, question: str):
-    chain = get_rag_chain()
-    return chain.invoke(
-        {
-            "context": context,
-            "question": question
-        }
-    )
+async def astream_rag(context: str, question: str, meta: dict = None, model: str = DEFAULT_MODEL, tenant_id=None):
+    """Versão assíncrona do stream_rag; `meta["provider"]` recebe o provedor que respondeu."""
+    prompt = RAG_PROMPT.format(context=context, question=question)
+    async for text in llm_gateway.astream(prompt, model=model, meta=meta, tenant_id=tenant_id):
+        yield text
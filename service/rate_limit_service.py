@@ -0,0 +1,59 @@
+import os
+import logging
+from typing import Optional, Tuple
+
+from core.rate_limiter import create_backend
+from core import metrics
+from db.models import TIER_LIMITS
+
+logger = logging.getLogger(__name__)
+
+# Onde ficam os baldes: "memory" (por processo), "sqlite:///rate_limits.db" (workers da
+# mesma máquina) ou "redis://host:6379/0" (vários servidores)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
+_backend = None
+
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        _backend = create_backend(RATE_LIMIT_BACKEND)
+    return _backend
+
+
+def limits(subscription_tier: Optional[str]) -> Tuple[Optional[int], int]:
+    """(chamadas de LLM por minuto, rajada) do plano; None = sem limite de taxa."""
+    tier_limits = TIER_LIMITS.get(subscription_tier or "free", {})
+    per_minute = tier_limits.get("llm_requests_per_minute")
+    return per_minute, tier_limits.get("llm_burst") or per_minute or 1
+
+
+def max_batch(subscription_tier: Optional[str]) -> Optional[int]:
+    """Maior lote de chamadas aceito de uma vez (a rajada do plano); None = sem limite de taxa."""
+    per_minute, burst = limits(subscription_tier)
+    return None if per_minute is None else burst
+
+
+def check(tenant_id, subscription_tier: Optional[str], cost: int = 1) -> float:
+    """
+    Consome `cost` chamadas do balde do inquilino.
+    Retorna 0 se liberado ou os segundos a aguardar (para o Retry-After do 429).
+    Um custo acima de max_batch() nunca cabe no balde: quem chama deve recusá-lo antes.
+    """
+    per_minute, burst = limits(subscription_tier)
+    if per_minute is None:
+        return 0.0
+    if cost > burst:
+        raise ValueError(f"Custo {cost} acima da rajada do plano ({burst}).")
+    try:
+        retry_after = _get_backend().take(f"llm:{tenant_id}", per_minute / 60.0, burst, cost)
+    except Exception as e:
+        # Backend compartilhado indisponível: não derruba o atendimento por causa do limitador
+        logger.error(f"Erro no backend de rate limit ({RATE_LIMIT_BACKEND}): {e}")
+        metrics.incr("ratelimit.backend_errors")
+        return 0.0
+    if retry_after:
+        metrics.incr("ratelimit.rejected")
+        metrics.incr(f"ratelimit.rejected.tenant.{tenant_id}")
+    return retry_after
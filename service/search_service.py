@@ -1,7 +1,20 @@
 import os
 import glob
+import time
+import asyncio
+import functools
+import hashlib
+import hmac
 import logging
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from typing import Union, Dict, List, Optional
+import base64
+import json
+import threading
+import numpy as np
+import faiss
+from cachetools import TTLCache
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
@@ -9,6 +22,8 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_classic.retrievers.ensemble import EnsembleRetriever
 from langchain_community.retrievers import BM25Retriever
 from core.utils import get_tenant_path
+from core.config import JWT_SECRET
+from core import metrics
 
 # OCR opcional
 try:
@@ -28,6 +43,78 @@ logging.basicConfig(
 _tenant_retrievers = {}
 # Retriever global para documentos compartilhados
 _global_retriever = None
+# Versão de cada store, incrementada a cada (re)indexação: {store_key: int}
+_store_versions = {}
+# PDFs (caminho, mtime, tamanho) da última indexação de cada store: recarga sem mudança não refaz nada
+_store_fingerprints = {}
+# Índice invertido (posting lists BM25) por store: {store_key: dict}
+# As posições coincidem com a ordem dos chunks no BM25 e no FAISS.
+_sparse_indexes = {}
+
+# Modo de busca: "ensemble" (BM25 + FAISS no corpus inteiro, padrão) ou
+# "cascade" (BM25/metadados geram candidatos, FAISS pontua apenas os candidatos)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "ensemble").lower()
+# Quantidade máxima de candidatos esparsos repassados ao estágio denso
+CASCADE_CANDIDATES = int(os.getenv("SEARCH_CASCADE_CANDIDATES", "200"))
+# Abaixo deste número de candidatos, cai para a busca densa completa
+CASCADE_MIN_CANDIDATES = int(os.getenv("SEARCH_CASCADE_MIN_CANDIDATES", "20"))
+# Pesos do ensemble (Keywords, Semântico) também usados na fusão da cascata
+ENSEMBLE_WEIGHTS = [0.4, 0.6]
+
+# Escopos de busca:
+#   user: PDFs enviados pelo usuário (pasta do usuário dentro da pasta do inquilino, onde o /upload grava)
+#   tenant: base compartilhada do inquilino, PDFs na raiz da pasta do inquilino. O /upload não grava
+#     ali; a base é abastecida fora da API (cópia direta pelo administrador) e fica vazia sem isso
+#   global: data/docs, comum a todos os inquilinos
+SEARCH_SCOPES = ("user", "tenant", "global")
+# Peso de cada escopo na fusão RRF (iguais = ranking puramente por relevância).
+# Ex.: SEARCH_SCOPE_WEIGHTS="user=1,tenant=1,global=0.5" privilegia as bases do inquilino
+SCOPE_WEIGHTS = {"user": 1.0, "tenant": 1.0, "global": 1.0}
+SCOPE_WEIGHTS.update({
+    name.strip(): float(weight)
+    for name, _, weight in (item.partition("=") for item in os.getenv("SEARCH_SCOPE_WEIGHTS", "").split(","))
+    if name.strip() in SCOPE_WEIGHTS and weight.strip()
+})
+# Tempo máximo aguardando um escopo lento antes de responder com os já concluídos
+SCOPE_TIMEOUT = float(os.getenv("SEARCH_SCOPE_TIMEOUT", "10"))
+RRF_C = 60
+
+# Paginação por cursor: lista ranqueada profunda guardada por pouco tempo
+SEARCH_CURSOR_DEPTH = int(os.getenv("SEARCH_CURSOR_DEPTH", "50"))
+SEARCH_CURSOR_TTL = int(os.getenv("SEARCH_CURSOR_TTL", "300"))
+_ranked_cache = TTLCache(maxsize=int(os.getenv("SEARCH_CURSOR_CACHE_SIZE", "512")), ttl=SEARCH_CURSOR_TTL)
+_ranked_cache_lock = threading.Lock()
+# Pool dedicado ao fan-out de escopos (não disputa com o pool de threads do Starlette)
+_scope_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SEARCH_SCOPE_WORKERS", "8")),
+    thread_name_prefix="search-scope"
+)
+# Pool para o trabalho de CPU da busca (BM25, FAISS, montagem de contexto) chamado
+# pelos endpoints async: mantém o event loop livre para as chamadas ao LLM em andamento
+_retrieval_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SEARCH_RETRIEVAL_WORKERS", "8")),
+    thread_name_prefix="retrieval"
+)
+
+
+# Tarefas submetidas ao pool e ainda não concluídas (fila + em execução), exposto em /ops/metrics
+_retrieval_pending = 0
+
+
+async def run_in_retrieval_pool(func, *args, **kwargs):
+    """
+    Executa `func` no pool de recuperação sem bloquear o event loop.
+    Se a requisição for cancelada (cliente desconectou) antes de a tarefa começar, ela nem roda.
+    """
+    global _retrieval_pending
+    loop = asyncio.get_running_loop()
+    _retrieval_pending += 1
+    metrics.set_gauge("retrieval.pending", _retrieval_pending)
+    try:
+        return await loop.run_in_executor(_retrieval_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        _retrieval_pending -= 1
+        metrics.set_gauge("retrieval.pending", _retrieval_pending)
 
 
 def garantir_pdf_textual(caminho_pdf: str) -> str:
@@ -57,6 +144,19 @@ def garantir_pdf_textual(caminho_pdf: str) -> str:
         return caminho_pdf
 
 
+def _list_pdfs(paths: List[str]) -> List[str]:
+    """PDFs originais das pastas (as cópias _ocr.pdf geradas pelo OCR ficam de fora), em ordem estável."""
+    pdfs = []
+    for path in paths:
+        if not os.path.exists(path):
+            logging.info(f"Diretório não existe: {path}")
+            continue
+        for file in sorted(os.listdir(path)):
+            if file.lower().endswith(".pdf") and not file.lower().endswith("_ocr.pdf"):
+                pdfs.append(os.path.join(path, file))
+    return pdfs
+
+
 def init_search(tenant_id: Union[str, int] = None, username: str = None, force_reload=False):
     """
     Inicializa ou recarrega o Sistema Híbrido (BM25 + FAISS) para um usuário.
@@ -91,31 +191,41 @@ def init_search(tenant_id: Union[str, int] = None, username: str = None, force_r
         if _global_retriever is not None and not force_reload:
             return
 
+    # Os mesmos PDFs da última indexação (ex.: base vazia consultada de novo): nada a refazer
+    pdfs = _list_pdfs(docs_paths)
+    fingerprint = [(p, os.path.getmtime(p), os.path.getsize(p)) for p in pdfs]
+    if _store_fingerprints.get(store_key) == fingerprint:
+        return
+    _store_fingerprints[store_key] = fingerprint
+
+    # Qualquer cursor/cache montado sobre a versão anterior deixa de valer
+    _store_versions[store_key] = _store_versions.get(store_key, 0) + 1
+
     # 4. Carregamento de Documentos
     documents = []
-    for path in docs_paths:
-        if not os.path.exists(path):
-            logging.info(f"Diretório não existe: {path}")
-            continue
-            
-        for file in os.listdir(path):
-            if file.lower().endswith(".pdf") and not file.lower().endswith("_ocr.pdf"):
-                caminho_pdf = os.path.join(path, file)
-                # Tenta garantir que o PDF seja textual
-                caminho_final = garantir_pdf_textual(caminho_pdf)
-                
-                try:
-                    loader = PyPDFLoader(caminho_final)
-                    docs = loader.load()
-                    if docs:
-                        documents.extend(docs)
-                        logging.info(f"Carregado: {file} ({len(docs)} pgs)")
-                except Exception as e:
-                    logging.warning(f"Erro ao ler {file}: {e}")
+    for caminho_pdf in pdfs:
+        file = os.path.basename(caminho_pdf)
+        # Tenta garantir que o PDF seja textual
+        caminho_final = garantir_pdf_textual(caminho_pdf)
+        
+        try:
+            loader = PyPDFLoader(caminho_final)
+            docs = loader.load()
+            # Metadados usados pelos filtros de busca (nome original e data de upload)
+            uploaded_at = os.path.getmtime(caminho_pdf)
+            for d in docs:
+                d.metadata["file_name"] = file
+                d.metadata["uploaded_at"] = uploaded_at
+            if docs:
+                documents.extend(docs)
+                logging.info(f"Carregado: {file} ({len(docs)} pgs)")
+        except Exception as e:
+            logging.warning(f"Erro ao ler {file}: {e}")
 
     # 5. Fallback se não houver documentos
     if not documents:
         logging.info(f"Nenhum PDF válido encontrado para {store_key}")
+        _sparse_indexes.pop(store_key, None)
         if t_id:
             _tenant_retrievers[store_key] = None
         else:
@@ -124,7 +234,8 @@ def init_search(tenant_id: Union[str, int] = None, username: str = None, force_r
 
     # 6. Processamento Híbrido (BM25 + FAISS)
     try:
-        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
+        # add_start_index permite ao empacotador de contexto unir chunks sobrepostos
+        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150, add_start_index=True)
         chunks = splitter.split_documents(documents)
         chunks = [c for c in chunks if c.page_content and c.page_content.strip()]
 
@@ -149,8 +260,11 @@ def init_search(tenant_id: Union[str, int] = None, username: str = None, force_r
         # Pesando 40% Keywords + 60% Semântico
         ensemble_retriever = EnsembleRetriever(
             retrievers=[bm25_retriever, faiss_retriever],
-            weights=[0.4, 0.6]
+            weights=ENSEMBLE_WEIGHTS
         )
+
+        # --- D. Posting lists para a busca em cascata ---
+        _sparse_indexes[store_key] = _build_sparse_index(bm25_retriever)
         
         if t_id:
             _tenant_retrievers[store_key] = ensemble_retriever
@@ -161,92 +275,471 @@ def init_search(tenant_id: Union[str, int] = None, username: str = None, force_r
         
     except Exception as e:
         logging.error(f"Erro crítico no processamento Híbrido ({store_key}): {e}")
+        # Permite nova tentativa na próxima recarga, mesmo sem mudança nos arquivos
+        _store_fingerprints.pop(store_key, None)
+        _sparse_indexes.pop(store_key, None)
         if t_id:
             _tenant_retrievers[store_key] = None
         else:
             _global_retriever = None
 
 
-def similarity_search(query: str, tenant_id: str = None, username: str = None, k: int = 4, include_global: bool = False):
+def _build_sparse_index(bm25_retriever: BM25Retriever) -> Dict:
     """
-    Busca Híbrida combinando BM25 + FAISS.
+    Converte as frequências do BM25Okapi em posting lists (termo -> posições, tf).
+    Permite pontuar apenas os documentos que contêm os termos da consulta,
+    em vez de varrer o corpus inteiro como o `get_scores` do rank_bm25.
     """
-    final_results = []
-    
-    # Normaliza para string
-    tid_str = str(tenant_id) if tenant_id is not None else None
-    usr_str = str(username) if username is not None else None
-    
-    # 1. Busca na base do usuário
-    if tid_str and usr_str:
+    vectorizer = bm25_retriever.vectorizer
+    postings = {}
+    for pos, freqs in enumerate(vectorizer.doc_freqs):
+        for term, tf in freqs.items():
+            postings.setdefault(term, ([], []))
+            postings[term][0].append(pos)
+            postings[term][1].append(tf)
+
+    # Metadados colunares para restringir posições sem varrer Documents
+    by_file = {}
+    for pos, doc in enumerate(bm25_retriever.docs):
+        by_file.setdefault(doc.metadata.get("file_name") or os.path.basename(doc.metadata.get("source", "")), []).append(pos)
+
+    return {
+        "postings": {t: (np.array(ids, dtype=np.int64), np.array(tfs, dtype=np.float32)) for t, (ids, tfs) in postings.items()},
+        "by_file": {f: np.array(ids, dtype=np.int64) for f, ids in by_file.items()},
+        "pages": np.array([int(d.metadata.get("page", 0)) for d in bm25_retriever.docs], dtype=np.int64),
+        "uploaded_at": np.array([float(d.metadata.get("uploaded_at", 0.0)) for d in bm25_retriever.docs], dtype=np.float64),
+        "idf": vectorizer.idf,
+        "doc_len": np.array(vectorizer.doc_len, dtype=np.float32),
+        "avgdl": vectorizer.avgdl,
+        "k1": vectorizer.k1,
+        "b": vectorizer.b,
+        "size": len(vectorizer.doc_freqs),
+    }
+
+
+def _allowed_positions(index: Dict, filters: Optional[Dict]) -> Optional[np.ndarray]:
+    """
+    Converte os filtros em um conjunto ordenado de posições permitidas no store.
+    Filtros aceitos (todos opcionais):
+      - sources: lista de nomes de arquivo
+      - page_from / page_to: intervalo de páginas (1-based, como exibido ao usuário)
+      - uploaded_from / uploaded_to: intervalo [from, to) de data de upload (datetime)
+    Retorna None quando não há filtro ativo.
+    """
+    if not filters or not any(v is not None for v in filters.values()):
+        return None
+
+    mask = np.ones(index["size"], dtype=bool)
+    if filters.get("sources") is not None:
+        names = {n.replace("_ocr.pdf", ".pdf") for n in filters["sources"]}
+        mask[:] = False
+        for name in names:
+            ids = index["by_file"].get(name)
+            if ids is not None:
+                mask[ids] = True
+    if filters.get("page_from") is not None:
+        mask &= index["pages"] >= int(filters["page_from"]) - 1
+    if filters.get("page_to") is not None:
+        mask &= index["pages"] <= int(filters["page_to"]) - 1
+    if filters.get("uploaded_from") is not None:
+        mask &= index["uploaded_at"] >= _as_timestamp(filters["uploaded_from"])
+    if filters.get("uploaded_to") is not None:
+        mask &= index["uploaded_at"] < _as_timestamp(filters["uploaded_to"])
+    return np.flatnonzero(mask).astype(np.int64)
+
+
+def _as_timestamp(value) -> float:
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+
+def _matches_filters(doc, filters: Dict) -> bool:
+    """Versão por documento dos filtros (usada apenas quando o store não tem índice de metadados)."""
+    meta = doc.metadata
+    page = int(meta.get("page", 0)) + 1
+    if filters.get("sources") is not None and (meta.get("file_name") or os.path.basename(meta.get("source", ""))) not in filters["sources"]:
+        return False
+    if filters.get("page_from") is not None and page < int(filters["page_from"]):
+        return False
+    if filters.get("page_to") is not None and page > int(filters["page_to"]):
+        return False
+    uploaded = float(meta.get("uploaded_at", 0.0))
+    if filters.get("uploaded_from") is not None and uploaded < _as_timestamp(filters["uploaded_from"]):
+        return False
+    if filters.get("uploaded_to") is not None and uploaded >= _as_timestamp(filters["uploaded_to"]):
+        return False
+    return True
+
+
+def _filtered_hybrid_search(retriever: EnsembleRetriever, index: Dict, query: str, k: int, allowed: np.ndarray):
+    """
+    Busca híbrida com os filtros aplicados DENTRO dos índices:
+    - BM25: posting lists restritas às posições permitidas;
+    - FAISS: IDSelectorBatch limita a busca vetorial ao mesmo conjunto.
+    Assim o top-k já nasce filtrado, sem perder resultados por pós-filtragem.
+    """
+    if not len(allowed):
+        return []
+    bm25_retriever, faiss_retriever = retriever.retrievers
+    vstore = faiss_retriever.vectorstore
+
+    sparse = _sparse_candidates(index, bm25_retriever.preprocess_func(query), k, allowed)
+
+    query_vector = np.array([vstore.embedding_function.embed_query(query)], dtype=np.float32)
+    params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(allowed))
+    _, positions = vstore.index.search(query_vector, min(k, len(allowed)), params=params)
+    dense = [int(p) for p in positions[0] if p >= 0]
+
+    fused = _weighted_rrf([sparse, dense], ENSEMBLE_WEIGHTS)
+    return [bm25_retriever.docs[pos] for pos in fused[:k]]
+
+
+def _sparse_candidates(index: Dict, tokens: List[str], limit: int, allowed: Optional[np.ndarray] = None) -> List[int]:
+    """
+    BM25 sobre posting lists: custo proporcional ao tamanho das listas dos termos
+    da consulta. `allowed` (posições ordenadas) restringe as listas antes da pontuação.
+    """
+    all_ids, all_scores = [], []
+    for term in tokens:
+        entry = index["postings"].get(term)
+        if entry is None:
+            continue
+        ids, tfs = entry
+        if allowed is not None:
+            mask = np.isin(ids, allowed, assume_unique=True)
+            ids, tfs = ids[mask], tfs[mask]
+            if not len(ids):
+                continue
+        norm = index["k1"] * (1 - index["b"] + index["b"] * index["doc_len"][ids] / index["avgdl"])
+        all_ids.append(ids)
+        all_scores.append(index["idf"].get(term, 0) * tfs * (index["k1"] + 1) / (tfs + norm))
+
+    if not all_ids:
+        return []
+
+    ids = np.concatenate(all_ids)
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+    top = np.argsort(-scores, kind="stable")[:limit]
+    return unique_ids[top].tolist()
+
+
+def _weighted_rrf(rankings: List[List[int]], weights: List[float], c: int = 60) -> List[int]:
+    """Reciprocal Rank Fusion ponderado (mesma fórmula do EnsembleRetriever)."""
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + weight / (rank + c)
+    return sorted(fused, key=lambda item: fused[item], reverse=True)
+
+
+def _cascade_search(retriever: EnsembleRetriever, store_key: str, query: str, k: int, allowed: Optional[np.ndarray] = None):
+    """
+    Busca em dois estágios:
+    1. Candidatos baratos via posting lists BM25, restritos às posições permitidas pelos filtros.
+    2. Similaridade densa calculada apenas sobre os vetores já armazenados dos candidatos.
+    Retorna None quando há poucos candidatos, sinalizando fallback para a busca completa.
+    """
+    index = _sparse_indexes.get(store_key)
+    if index is None:
+        return None
+
+    bm25_retriever, faiss_retriever = retriever.retrievers
+    vstore = faiss_retriever.vectorstore
+    docs = bm25_retriever.docs
+
+    tokens = bm25_retriever.preprocess_func(query)
+    candidates = _sparse_candidates(index, tokens, CASCADE_CANDIDATES, allowed)
+    if len(candidates) < max(k, CASCADE_MIN_CANDIDATES):
+        return None
+
+    # Reaproveita os vetores do FAISS: nenhuma re-embedding dos candidatos
+    query_vector = np.array(vstore.embedding_function.embed_query(query), dtype=np.float32)
+    vectors = vstore.index.reconstruct_batch(np.array(candidates, dtype=np.int64))
+    distances = ((vectors - query_vector) ** 2).sum(axis=1)
+    dense_ranking = [candidates[i] for i in np.argsort(distances, kind="stable")]
+
+    fused = _weighted_rrf([candidates, dense_ranking], ENSEMBLE_WEIGHTS)
+    logging.info(f"Busca em cascata ({store_key}): {len(candidates)} candidatos de {index['size']} chunks")
+    return [docs[pos] for pos in fused[:k]]
+
+
+def _with_k(retriever: EnsembleRetriever, k: int) -> EnsembleRetriever:
+    """
+    Cópia rasa do ensemble com o K desta chamada nos retrievers internos. Os retrievers em
+    cache são compartilhados por requisições simultâneas e não podem ser alterados; índices,
+    documentos e vectorstore continuam sendo os mesmos objetos.
+    """
+    inner = []
+    for r in retriever.retrievers:
+        update = {}
+        if hasattr(r, 'k'):
+            update['k'] = k
+        if hasattr(r, 'search_kwargs'):
+            update['search_kwargs'] = {**r.search_kwargs, 'k': k}
+        inner.append(r.model_copy(update=update))
+    return retriever.model_copy(update={'retrievers': inner})
+
+
+def _search_store(retriever: EnsembleRetriever, store_key: str, query: str, k: int, mode: str = None, filters: Optional[Dict] = None):
+    """Executa a busca em um store, em cascata ou pelo ensemble completo, com filtros no índice."""
+    mode = (mode or SEARCH_MODE).lower()
+    index = _sparse_indexes.get(store_key)
+    allowed = _allowed_positions(index, filters) if index is not None else None
+
+    if mode == "cascade":
+        docs = _cascade_search(retriever, store_key, query, k, allowed)
+        if docs is not None:
+            return docs
+        logging.info(f"Poucos candidatos na cascata ({store_key}). Usando busca híbrida completa.")
+
+    if allowed is not None:
+        return _filtered_hybrid_search(retriever, index, query, k, allowed)
+
+    docs = _with_k(retriever, k).invoke(query)
+    if filters and index is None:
+        docs = [d for d in docs if _matches_filters(d, filters)]
+    return docs
+
+
+def _to_results(docs) -> List[Dict]:
+    """
+    Ensemble retorna Docs ordenados por Rank, sem score explícito no objeto Doc padrão.
+    Como nosso sistema espera 'score' (distância), simulamos um score baixo (bom):
+    0.1 para o primeiro, 0.11 para o segundo... apenas para manter a ordem.
+    """
+    return [
+        {
+            "content": doc.page_content,
+            "score": 0.1 + (i * 0.01),
+            "source": doc.metadata.get("source", "desconhecido"),
+            "page": doc.metadata.get("page", 0),
+            "start_index": doc.metadata.get("start_index")
+        }
+        for i, doc in enumerate(docs)
+    ]
+
+
+def _resolve_scope(scope: str, tid_str: Optional[str], usr_str: Optional[str]):
+    """Garante o store do escopo inicializado e retorna (store_key, retriever)."""
+    if scope == "user":
+        if not (tid_str and usr_str):
+            return None, None
         store_key = f"{tid_str}_{usr_str}"
         # Garante que a base do usuário esteja inicializada
         init_search(tenant_id=tid_str, username=usr_str)
-        t_retriever = _tenant_retrievers.get(store_key)
-        
+        retriever = _tenant_retrievers.get(store_key)
+
         # Se não encontrou a store (ou é None), tenta forçar um recarregamento
-        if not t_retriever:
+        if not retriever:
             logging.info(f"Retriever {store_key} vazio ou não encontrado. Forçando reload na busca.")
             init_search(tenant_id=tid_str, username=usr_str, force_reload=True)
-            t_retriever = _tenant_retrievers.get(store_key)
-
-        if t_retriever:
-            try:
-                # Ajusta o K dinamicamente para os retrievers internos
-                # Nota: EnsembleRetriever não expõe fácil ajuste de K dinâmico para os filhos, 
-                # mas podemos tentar se o objeto permitir, ou apenas confiar no padrão.
-                # O invoke do Ensemble usa a config dos retrievers filhos.
-                # Para simplificar, assumimos o K configurado na init ou padrão.
-                
-                # Mas para garantir, podemos tentar setar k nos filhos se acessíveis:
-                for r in t_retriever.retrievers:
-                    if hasattr(r, 'k'): r.k = k
-                    if hasattr(r, 'search_kwargs'): r.search_kwargs['k'] = k
-                
-                docs = t_retriever.invoke(query)
-                
-                # Ensemble retorna Docs ordenados por Rank, sem score explícito no objeto Doc padrão.
-                # Como nosso sistema espera 'score' (distância), vamos simular um score baixo (bom)
-                # pois o Ensemble já garantiu a relevância.
-                for i, doc in enumerate(docs):
-                    # Simulando score: 0.1 para o primeiro, 0.11 para o segundo... 
-                    # apenas para manter ordem se algo reordenar por score
-                    dummy_score = 0.1 + (i * 0.01)
-                    
-                    final_results.append({
-                        "content": doc.page_content,
-                        "score": dummy_score,
-                        "source": doc.metadata.get("source", "desconhecido"),
-                        "page": doc.metadata.get("page", 0)
-                    })
-            except Exception as e:
-                logging.error(f"Erro na busca do usuário ({usr_str} @ {tid_str}): {e}")
-
-    # 2. Busca na base global (opcional)
-    if include_global:
-        init_search(tenant_id=None) # Garante global
-        if _global_retriever:
-            try:
-                # Ajusta K
-                for r in _global_retriever.retrievers:
-                    if hasattr(r, 'k'): r.k = k
-                    if hasattr(r, 'search_kwargs'): r.search_kwargs['k'] = k
-
-                g_docs = _global_retriever.invoke(query)
-                for i, doc in enumerate(g_docs):
-                    dummy_score = 0.1 + (i * 0.01)
-                    final_results.append({
-                        "content": doc.page_content,
-                        "score": dummy_score,
-                        "source": doc.metadata.get("source", "desconhecido"),
-                        "page": doc.metadata.get("page", 0)
-                    })
-            except Exception as e:
-                logging.error(f"Erro na busca global: {e}")
-
-    # Como o Ensemble já ordena por relevância (weighted rank), a lista `final_results` 
-    # já deve estar na ordem correta vinda do invoke().
-    # Contudo, se misturarmos Global + Local, a ordem pode bagunçar.
-    # Vamos manter a ordem de inserção (Local primeiro, depois Global).
-    
-    return final_results[:k]
+            retriever = _tenant_retrievers.get(store_key)
+        return store_key, retriever
+
+    if scope == "tenant":
+        if not tid_str:
+            return None, None
+        init_search(tenant_id=tid_str)
+        return tid_str, _tenant_retrievers.get(tid_str)
+
+    init_search(tenant_id=None) # Garante global
+    return "global", _global_retriever
+
+
+def _search_scope(scope: str, query: str, tid_str: Optional[str], usr_str: Optional[str], k: int, mode: str = None, filters: Optional[Dict] = None, resolved: Optional[tuple] = None) -> List[Dict]:
+    store_key, retriever = resolved or _resolve_scope(scope, tid_str, usr_str)
+    if not retriever:
+        return []
+    try:
+        docs = _search_store(retriever, store_key, query, k, mode, filters)
+    except Exception as e:
+        logging.error(f"Erro na busca do escopo {scope} ({store_key}): {e}")
+        return []
+    results = _to_results(docs)
+    for r in results:
+        r["scope"] = scope
+    return results
+
+
+def _result_key(result: Dict) -> str:
+    """Identifica o mesmo trecho vindo de escopos diferentes (ex.: PDF duplicado)."""
+    raw = f"{os.path.basename(result['source'])}|{result['page']}|{result['content']}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _scope_contribution(scope: str) -> float:
+    """Maior valor que um escopo soma a um item na fusão: peso / (1 + C), o do seu 1º lugar."""
+    return SCOPE_WEIGHTS.get(scope, 1.0) / (1 + RRF_C)
+
+
+def _top_k_settled(fused: Dict[str, Dict], k: int, pending_scopes: List[str]) -> bool:
+    """
+    O top-k está decidido quando nenhum escopo pendente consegue tirar o k-ésimo item de lá.
+    No pior caso os pendentes não somam nada ao top-k e dão o 1º lugar a um item de fora;
+    cada um soma a esse item no máximo `_scope_contribution`. Assim, com `reach` a soma
+    dessas contribuições:
+      - um item já visto fora do top-k precisa de mais que a diferença kth - (k+1)-ésimo;
+      - um item ainda não visto parte de zero e precisa de mais que kth.
+    O corte acontece quando os escopos concluídos concordam (o mesmo trecho em mais de uma
+    base soma pontos) ou quando os pendentes têm peso menor (SCOPE_WEIGHTS); com pesos
+    iguais e resultados sem trechos em comum, só a resposta dos pendentes decide.
+    """
+    if not pending_scopes:
+        return True
+    if len(fused) < k:
+        return False
+    reach = sum(_scope_contribution(s) for s in pending_scopes)
+    scores = sorted((item["rrf"] for item in fused.values()), reverse=True)
+    kth = scores[k - 1]
+    next_score = scores[k] if len(scores) > k else 0.0
+    return kth - next_score > reach and kth > reach
+
+
+def multi_scope_search(query: str, tenant_id: str = None, username: str = None, k: int = 4, scopes: Optional[List[str]] = None, mode: str = None, filters: Optional[Dict] = None, resolved: Optional[Dict[str, tuple]] = None) -> List[Dict]:
+    """
+    Consulta os escopos (user, tenant, global) em paralelo e funde os rankings com
+    Reciprocal Rank Fusion. Encerra antecipadamente quando o top-k não pode mais mudar
+    ou quando um escopo excede SCOPE_TIMEOUT. `resolved` ({escopo: (store_key, retriever)})
+    reaproveita stores já resolvidas pelo chamador.
+    """
+    resolved = resolved or {}
+    tid_str = str(tenant_id) if tenant_id is not None else None
+    usr_str = str(username) if username is not None else None
+    scopes = [s for s in dict.fromkeys(scopes or ["user"]) if s in SEARCH_SCOPES]
+
+    if len(scopes) == 1:
+        # Escopo único: sem fan-out, o ranking do próprio store já é o final
+        return _search_scope(scopes[0], query, tid_str, usr_str, k, mode, filters, resolved.get(scopes[0]))[:k]
+
+    futures = {
+        _scope_executor.submit(_search_scope, scope, query, tid_str, usr_str, k, mode, filters, resolved.get(scope)): scope
+        for scope in scopes
+    }
+    pending = set(futures)
+    fused: Dict[str, Dict] = {}
+    deadline = time.monotonic() + SCOPE_TIMEOUT
+
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            logging.warning(f"Escopos sem resposta em {SCOPE_TIMEOUT}s: {[futures[f] for f in pending]}")
+            break
+        for future in done:
+            scope = futures[future]
+            weight = SCOPE_WEIGHTS.get(scope, 1.0)
+            for rank, result in enumerate(future.result(), start=1):
+                item = fused.setdefault(_result_key(result), {"result": result, "rrf": 0.0})
+                item["rrf"] += weight / (rank + RRF_C)
+        if _top_k_settled(fused, k, [futures[f] for f in pending]):
+            break
+
+    for future in pending:
+        future.cancel()
+
+    ranked = sorted(fused.values(), key=lambda item: item["rrf"], reverse=True)[:k]
+    # Mantém a convenção de score-distância (menor é melhor) usada pelo /ask_prompt
+    return [{**item["result"], "score": 0.1 + (i * 0.01)} for i, item in enumerate(ranked)]
+
+
+def _scope_store_key(scope: str, tid_str: Optional[str], usr_str: Optional[str]) -> str:
+    if scope == "user":
+        return f"{tid_str}_{usr_str}"
+    if scope == "tenant":
+        return str(tid_str)
+    return "global"
+
+
+def store_versions(scopes: List[str], tenant_id: str = None, username: str = None) -> List[tuple]:
+    """
+    Versões atuais das stores consultadas por `scopes`, como (store_key, versão).
+    Mudam a cada reindexação; servem de chave para reaproveitar trabalho com segurança.
+    """
+    tid_str = str(tenant_id) if tenant_id is not None else None
+    usr_str = str(username) if username is not None else None
+    keys = [_scope_store_key(scope, tid_str, usr_str) for scope in scopes]
+    return sorted((key, _store_versions.get(key, 0)) for key in keys)
+
+
+def _cursor_signature(raw: bytes) -> str:
+    digest = hmac.new(JWT_SECRET.encode("utf-8"), b"search-cursor:" + raw, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii")
+
+
+def _encode_cursor(cache_key: str, offset: int) -> str:
+    """Cursor opaco assinado (HMAC): o cliente não consegue forjar chave nem offset."""
+    raw = json.dumps({"key": cache_key, "offset": offset}).encode("utf-8")
+    return f"{base64.urlsafe_b64encode(raw).decode('ascii')}.{_cursor_signature(raw)}"
+
+
+def _decode_cursor(cursor: str) -> Dict:
+    try:
+        payload, signature = cursor.split(".", 1)
+        raw = base64.urlsafe_b64decode(payload.encode("ascii"))
+        if not hmac.compare_digest(signature, _cursor_signature(raw)):
+            raise ValueError("assinatura")
+        data = json.loads(raw)
+        decoded = {"key": str(data["key"]), "offset": int(data["offset"])}
+    except Exception:
+        raise ValueError("Cursor inválido.")
+    # Offsets válidos estão sempre dentro da lista profunda
+    if not 0 <= decoded["offset"] < SEARCH_CURSOR_DEPTH:
+        raise ValueError("Cursor inválido.")
+    return decoded
+
+
+def paginated_search(query: str, tenant_id: str = None, username: str = None, page_size: int = 4, cursor: Optional[str] = None, scopes: Optional[List[str]] = None, mode: str = None, filters: Optional[Dict] = None):
+    """
+    Busca paginada por cursor opaco. A primeira página calcula uma lista ranqueada
+    profunda (SEARCH_CURSOR_DEPTH) e a guarda em cache por SEARCH_CURSOR_TTL segundos,
+    chaveada por usuário, consulta, filtros e versão dos stores. As páginas seguintes
+    são fatias desse cache: sem nova embedding nem nova busca.
+
+    Retorna (resultados, next_cursor). Se o cache expirou, a lista é recalculada e a
+    paginação continua no mesmo offset; se a consulta ou algum store mudou, recomeça do início.
+    """
+    tid_str = str(tenant_id) if tenant_id is not None else None
+    usr_str = str(username) if username is not None else None
+    scopes = [s for s in dict.fromkeys(scopes or ["user"]) if s in SEARCH_SCOPES]
+
+    # Resolve cada store uma vez: a versão entra na chave do cache e a busca reaproveita a store
+    resolved = {scope: _resolve_scope(scope, tid_str, usr_str) for scope in scopes}
+    versions = [(scope, _store_versions.get(_scope_store_key(scope, tid_str, usr_str), 0)) for scope in scopes]
+
+    fingerprint = json.dumps(
+        [tid_str, usr_str, query, sorted(versions), (mode or SEARCH_MODE).lower(), filters],
+        sort_keys=True, default=str
+    )
+    cache_key = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+
+    offset = 0
+    if cursor:
+        decoded = _decode_cursor(cursor)
+        if decoded["key"] == cache_key:
+            offset = decoded["offset"]
+        else:
+            logging.info("Cursor de busca desatualizado (consulta ou store mudou). Recomeçando do início.")
+
+    with _ranked_cache_lock:
+        ranked = _ranked_cache.get(cache_key)
+
+    if ranked is None:
+        ranked = multi_scope_search(query, tenant_id=tid_str, username=usr_str, k=SEARCH_CURSOR_DEPTH, scopes=scopes, mode=mode, filters=filters, resolved=resolved)
+        with _ranked_cache_lock:
+            _ranked_cache[cache_key] = ranked
+
+    page = ranked[offset:offset + page_size]
+    next_offset = offset + page_size
+    next_cursor = _encode_cursor(cache_key, next_offset) if next_offset < len(ranked) else None
+    return page, next_cursor
+
+
+def similarity_search(query: str, tenant_id: str = None, username: str = None, k: int = 4, include_global: bool = False, mode: str = None, filters: Optional[Dict] = None, scopes: Optional[List[str]] = None):
+    """
+    Busca Híbrida combinando BM25 + FAISS.
+    `mode="cascade"` usa BM25/metadados como pré-filtro e pontua densamente só os candidatos.
+    `filters` restringe arquivo, intervalo de páginas e data de upload dentro dos índices.
+    `scopes` escolhe as bases consultadas; sem ele, usa a do usuário (+ global se include_global).
+    """
+    if scopes is None:
+        scopes = ["user", "global"] if include_global else ["user"]
+    return multi_scope_search(query, tenant_id=tenant_id, username=username, k=k, scopes=scopes, mode=mode, filters=filters)
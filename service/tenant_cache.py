@@ -0,0 +1,119 @@
+import os
+import time
+import threading
+from typing import NamedTuple, Optional
+
+from cachetools import TTLCache
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.database import dialect_insert
+from db.models import Tenant, CacheVersion
+from core.utils import get_tenant_path
+from core import metrics
+
+# Tempo máximo (s) que um inquilino fica em cache; cobre alterações feitas direto no banco
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "300"))
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "1024"))
+# Intervalo (s) entre leituras do carimbo de versão: atraso máximo para ver a invalidação de outro worker
+TENANT_CACHE_VERSION_CHECK = float(os.getenv("TENANT_CACHE_VERSION_CHECK", "2"))
+
+_STAMP = "tenants"
+_VERSION_QUERY = select(CacheVersion.version).where(CacheVersion.name == _STAMP)
+
+
+class TenantInfo(NamedTuple):
+    """Cópia imutável dos dados do inquilino usados nas requisições (limites, plano, nome e pasta)."""
+    id: int
+    name: str
+    subscription_tier: str
+    max_documents: int
+    max_prompts_per_day: int
+    current_document_count: int
+    storage_path: str
+
+
+_cache = TTLCache(maxsize=TENANT_CACHE_SIZE, ttl=TENANT_CACHE_TTL)
+_lock = threading.Lock()
+_known_version = None
+_checked_at = 0.0
+
+
+def _version_check_due() -> bool:
+    global _checked_at
+    now = time.monotonic()
+    with _lock:
+        if now - _checked_at < TENANT_CACHE_VERSION_CHECK:
+            return False
+        _checked_at = now
+        return True
+
+
+def _apply_version(version: Optional[int]) -> None:
+    """Descarta o cache quando outro worker (ou este) incrementou o carimbo."""
+    global _known_version
+    version = version or 0
+    with _lock:
+        if _known_version is not None and version != _known_version:
+            _cache.clear()
+            metrics.incr("tenant_cache.invalidated")
+        _known_version = version
+
+
+def _lookup(tenant_id: int) -> Optional[TenantInfo]:
+    with _lock:
+        info = _cache.get(tenant_id)
+    metrics.incr("tenant_cache.hits" if info is not None else "tenant_cache.misses")
+    return info
+
+
+def _store(tenant: Optional[Tenant]) -> Optional[TenantInfo]:
+    if tenant is None:
+        return None
+    info = TenantInfo(
+        id=tenant.id,
+        name=tenant.name,
+        subscription_tier=tenant.subscription_tier,
+        max_documents=tenant.max_documents,
+        max_prompts_per_day=tenant.max_prompts_per_day,
+        current_document_count=tenant.current_document_count,
+        storage_path=get_tenant_path(tenant.id, tenant.name),
+    )
+    with _lock:
+        _cache[tenant.id] = info
+    return info
+
+
+def get(db: Session, tenant_id: int) -> Optional[TenantInfo]:
+    """Inquilino pelo id, do cache quando possível (None se não existir)."""
+    if _version_check_due():
+        _apply_version(db.scalar(_VERSION_QUERY))
+    return _lookup(tenant_id) or _store(db.get(Tenant, tenant_id))
+
+
+async def aget(db: AsyncSession, tenant_id: int) -> Optional[TenantInfo]:
+    """Versão assíncrona de `get`."""
+    if _version_check_due():
+        _apply_version(await db.scalar(_VERSION_QUERY))
+    return _lookup(tenant_id) or _store(await db.get(Tenant, tenant_id))
+
+
+def invalidate(db: Session, tenant_id: int) -> None:
+    """
+    Chamar ao alterar um inquilino (plano, limites, contagem de documentos), na mesma
+    transação da alteração: incrementa o carimbo no banco para que os outros workers
+    descartem o cache e remove a entrada local após o commit. Quem chama faz o commit.
+    """
+    stmt = dialect_insert(CacheVersion).values(name=_STAMP, version=1)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[CacheVersion.name],
+        set_={"version": CacheVersion.version + 1}
+    ))
+
+    # Antes do commit, uma requisição concorrente ainda lê e guarda os valores antigos
+    def _discard(session):
+        with _lock:
+            _cache.pop(tenant_id, None)
+
+    event.listen(db, "after_commit", _discard, once=True)
@@ -0,0 +1,198 @@
+import os
+import asyncio
+import logging
+import threading
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, func
+from db.database import AsyncSessionLocal, dialect_insert
+from db.models import TokenUsage, TIER_LIMITS
+from service import quota_service
+
+logger = logging.getLogger(__name__)
+
+# Intervalo (s) entre gravações do consumo agregado no banco
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "10"))
+
+# Consumo ainda não gravado: {(tenant_id, dia, modelo): [chamadas, tokens_prompt, tokens_resposta, latência_ms]}
+_pending: Dict[Tuple[int, date, str], List[float]] = {}
+# Tokens consumidos no dia por inquilino (banco + pendentes); base da checagem de quota
+_day_totals: Dict[Tuple[int, date], int] = {}
+_lock = threading.Lock()
+_flush_lock = None
+_flusher_task = None
+
+
+def _get_flush_lock() -> asyncio.Lock:
+    global _flush_lock
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+    return _flush_lock
+
+
+def record(tenant_id, model: str, prompt_tokens: int, completion_tokens: int, latency_ms: float) -> None:
+    """
+    Contabiliza uma chamada ao LLM em memória (custo O(1), seguro entre threads).
+    A gravação no banco é feita em lote por `flush`.
+    """
+    if tenant_id is None:
+        return
+    key = (int(tenant_id), quota_service.today(), model)
+    with _lock:
+        entry = _pending.setdefault(key, [0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += prompt_tokens
+        entry[2] += completion_tokens
+        entry[3] += latency_ms
+        day_key = key[:2]
+        if day_key in _day_totals:
+            _day_totals[day_key] += prompt_tokens + completion_tokens
+
+
+def _pending_tokens(tenant_id: int, day: date) -> int:
+    return sum(
+        int(entry[1] + entry[2])
+        for (t, d, _), entry in _pending.items()
+        if t == tenant_id and d == day
+    )
+
+
+async def tokens_used_today(tenant_id) -> int:
+    """Tokens consumidos hoje pelo inquilino. Só consulta o banco na primeira vez do dia."""
+    tenant_id = int(tenant_id)
+    today = quota_service.today()
+    total = _day_totals.get((tenant_id, today))
+    if total is not None:
+        return total
+
+    # Sob o lock do flush: nada migra de _pending para o banco durante a leitura
+    async with _get_flush_lock():
+        async with AsyncSessionLocal() as db:
+            stored = await db.scalar(
+                select(func.coalesce(func.sum(TokenUsage.prompt_tokens + TokenUsage.completion_tokens), 0))
+                .where(TokenUsage.tenant_id == tenant_id, TokenUsage.day == today)
+            )
+        with _lock:
+            return _day_totals.setdefault((tenant_id, today), int(stored) + _pending_tokens(tenant_id, today))
+
+
+def token_limit(subscription_tier: Optional[str]) -> Optional[int]:
+    """Limite diário de tokens do plano (None = ilimitado)."""
+    return TIER_LIMITS.get(subscription_tier or "free", {}).get("max_tokens_per_day")
+
+
+async def remaining_tokens(tenant_id, subscription_tier: Optional[str]) -> Optional[int]:
+    """Tokens ainda disponíveis hoje para o inquilino; None quando o plano não limita tokens."""
+    limit = token_limit(subscription_tier)
+    if limit is None:
+        return None
+    return limit - await tokens_used_today(tenant_id)
+
+
+async def flush() -> None:
+    """Grava o consumo pendente (upsert por inquilino/dia/modelo) e ressincroniza os totais do dia."""
+    global _pending
+    async with _get_flush_lock():
+        with _lock:
+            batch, _pending = _pending, {}
+        if not batch:
+            return
+
+        today = quota_service.today()
+        try:
+            async with AsyncSessionLocal() as db:
+                for (tenant_id, day, model), (calls, prompt_tokens, completion_tokens, latency_ms) in batch.items():
+                    stmt = dialect_insert(TokenUsage).values(
+                        tenant_id=tenant_id, day=day, model=model, calls=calls,
+                        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                        latency_ms_total=latency_ms
+                    )
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[TokenUsage.tenant_id, TokenUsage.day, TokenUsage.model],
+                        set_={
+                            "calls": TokenUsage.calls + stmt.excluded.calls,
+                            "prompt_tokens": TokenUsage.prompt_tokens + stmt.excluded.prompt_tokens,
+                            "completion_tokens": TokenUsage.completion_tokens + stmt.excluded.completion_tokens,
+                            "latency_ms_total": TokenUsage.latency_ms_total + stmt.excluded.latency_ms_total,
+                        }
+                    )
+                    await db.execute(stmt)
+                await db.commit()
+
+                # Recarrega os totais do dia: inclui o consumo gravado por outros workers
+                tenants = {tenant_id for (tenant_id, day, _) in batch if day == today}
+                rows = (await db.execute(
+                    select(TokenUsage.tenant_id, func.sum(TokenUsage.prompt_tokens + TokenUsage.completion_tokens))
+                    .where(TokenUsage.day == today, TokenUsage.tenant_id.in_(tenants))
+                    .group_by(TokenUsage.tenant_id)
+                )).all() if tenants else []
+        except Exception as e:
+            logger.error(f"Erro ao gravar consumo de tokens: {e}")
+            # Devolve o lote para a próxima tentativa
+            with _lock:
+                for key, values in batch.items():
+                    entry = _pending.setdefault(key, [0, 0, 0, 0.0])
+                    for i, value in enumerate(values):
+                        entry[i] += value
+            return
+
+        with _lock:
+            for day_key in [k for k in _day_totals if k[1] != today]:
+                del _day_totals[day_key]
+            for tenant_id, total in rows:
+                _day_totals[(tenant_id, today)] = int(total) + _pending_tokens(tenant_id, today)
+
+
+async def _flush_forever():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"Erro no flush periódico de consumo: {e}")
+
+
+def start_flusher() -> None:
+    """Inicia a gravação periódica (chamado no startup da API, dentro do event loop)."""
+    global _flusher_task
+    if _flusher_task is None:
+        _flusher_task = asyncio.get_running_loop().create_task(_flush_forever())
+
+
+async def stop_flusher() -> None:
+    """Para a gravação periódica e grava o que estiver pendente (shutdown)."""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        _flusher_task = None
+    await flush()
+
+
+async def usage_report(tenant_id: Optional[int] = None, day_from: Optional[date] = None, day_to: Optional[date] = None) -> List[Dict]:
+    """Agregados por inquilino/dia/modelo, já incluindo o consumo pendente."""
+    await flush()
+    query = select(TokenUsage)
+    if tenant_id is not None:
+        query = query.where(TokenUsage.tenant_id == tenant_id)
+    if day_from:
+        query = query.where(TokenUsage.day >= day_from)
+    if day_to:
+        query = query.where(TokenUsage.day <= day_to)
+    query = query.order_by(TokenUsage.day.desc(), TokenUsage.tenant_id, TokenUsage.model)
+
+    async with AsyncSessionLocal() as db:
+        rows = (await db.scalars(query)).all()
+    return [
+        {
+            "tenant_id": r.tenant_id,
+            "day": r.day.isoformat(),
+            "model": r.model,
+            "calls": r.calls,
+            "prompt_tokens": r.prompt_tokens,
+            "completion_tokens": r.completion_tokens,
+            "total_tokens": r.prompt_tokens + r.completion_tokens,
+            "avg_latency_ms": round(r.latency_ms_total / r.calls, 1) if r.calls else 0.0,
+        }
+        for r in rows
+    ]
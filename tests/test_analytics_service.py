@@ -0,0 +1,38 @@
+import sys
+import os
+from datetime import datetime
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from db.models import Base, Prompt, ActivityRollup
+from service import analytics_service, quota_service
+
+
+def test_concurrent_feedback_moves_the_rollup_from_the_current_value(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'analytics.db'}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    kind = quota_service.PROMPTS
+    with Session() as db:
+        prompt = Prompt(id=1, usuario="bob", tenant_id=1, tema="férias", feedback=0, created_at=datetime(2026, 1, 5, 10))
+        db.add(prompt)
+        db.execute(analytics_service.increment_stmt(analytics_service.bucket(1, "bob", kind, prompt.created_at, 0), 1))
+        db.commit()
+
+    with Session() as first, Session() as second:
+        stale = first.get(Prompt, 1)
+        # Outra requisição troca o feedback depois que `first` leu a linha
+        assert analytics_service.change_feedback(second, kind, second.get(Prompt, 1), 1)
+        second.commit()
+        assert analytics_service.change_feedback(first, kind, stale, -1)
+        first.commit()
+
+    with Session() as db:
+        assert db.get(Prompt, 1).feedback == -1
+        rollup = {r.feedback: r.count for r in db.scalars(select(ActivityRollup))}
+        assert rollup == {0: 0, 1: 0, -1: 1}
+    engine.dispose()
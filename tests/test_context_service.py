@@ -0,0 +1,72 @@
+import sys
+import os
+
+import pytest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from service import context_service
+from service.context_service import build_context, CONTEXT_SEPARATOR
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # Contagem estimada (~4 caracteres por token): determinística e sem baixar o encoding
+    monkeypatch.setattr(context_service, "_get_encoding", lambda: None)
+
+
+def _doc(content, score, source="/x/rh.pdf", page=0, start_index=None):
+    return {"content": content, "score": score, "source": source, "page": page, "start_index": start_index}
+
+
+def test_overlapping_chunks_of_a_page_are_merged_once():
+    first = "A política de férias prevê trinta dias corridos por ano, divididos em até três períodos. "
+    second = first[-40:] + "O pedido deve ser feito com antecedência."
+    context, used = build_context([
+        _doc(first, 0.1, start_index=0),
+        _doc(second, 0.2, start_index=len(first) - 40),
+    ], max_tokens=1000)
+
+    assert context.count("[[FONTE: rh.pdf, PÁGINA: 1]]") == 1
+    assert context.count(first[-40:].strip()) == 1
+    assert "antecedência" in context
+    assert len(used) == 2
+
+
+def test_blocks_are_packed_by_score_within_the_budget():
+    best = _doc("Reembolso de despesas em até 30 dias. " * 5, 0.1, source="/x/financeiro.pdf")
+    large = _doc("Texto longo sem relevância. " * 200, 0.2, source="/x/manual.pdf")
+    small = _doc("Vale-refeição creditado no dia 5.", 0.3, source="/x/beneficios.pdf")
+    context, used = build_context([large, small, best], max_tokens=120)
+
+    blocks = context.split(CONTEXT_SEPARATOR)
+    # O bloco grande não cabe e é pulado; o menor, de score pior, ainda entra
+    assert [b.split(",")[0] for b in blocks] == ["[[FONTE: financeiro.pdf", "[[FONTE: beneficios.pdf"]
+    assert context_service.count_tokens(context) <= 120
+    assert {d["source"] for d in used} == {"/x/financeiro.pdf", "/x/beneficios.pdf"}
+
+
+def test_near_duplicate_blocks_keep_only_the_best():
+    text = "O plano de saúde cobre consultas, exames e internações para titulares e dependentes."
+    context, used = build_context([
+        _doc(text, 0.1, source="/x/rh.pdf"),
+        _doc(text + " ", 0.2, source="/x/rh_copia.pdf"),
+    ], max_tokens=1000)
+
+    assert "rh_copia.pdf" not in context
+    assert [d["source"] for d in used] == ["/x/rh.pdf"]
+
+
+def test_single_block_over_budget_is_cut_at_a_sentence():
+    text = "Primeira frase sobre férias. Segunda frase sobre férias. " * 50
+    context, used = build_context([_doc(text, 0.1)], max_tokens=40)
+
+    body = context.split("\n", 1)[1]
+    assert body.endswith(".")
+    assert len(body) < len(text)
+    assert len(used) == 1
+
+
+def test_empty_input():
+    assert build_context([]) == ("", [])
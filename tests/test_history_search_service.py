@@ -0,0 +1,78 @@
+import sys
+import os
+import asyncio
+
+import pytest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from db.migrations import run_migrations
+from service import history_search_service, quota_service
+
+
+ROWS = [
+    # (id, tenant_id, usuario, tema, resposta)
+    (1, 1, "bob", "Política de férias", "Trinta dias de férias por ano."),
+    (2, 1, "ana", "Férias coletivas", "Em dezembro."),
+    (3, 2, "bob", "Férias na filial", "Regras de férias da outra empresa."),
+    (4, 12, "bob", "Férias", "Inquilino com id parecido."),
+    (5, 1, "bob.silva", "Reembolso", "Não fala de férias? Fala: férias."),
+]
+
+
+@pytest.fixture
+def history_db(tmp_path):
+    path = tmp_path / "historico.db"
+    engine = create_engine(f"sqlite:///{path}")
+    run_migrations(engine)
+    with engine.begin() as conn:
+        for row in ROWS:
+            conn.execute(text(
+                "INSERT INTO prompts (id, tenant_id, usuario, tema, resposta, feedback, created_at) "
+                "VALUES (:id, :tenant_id, :usuario, :tema, :resposta, 0, '2026-01-05 10:00:00')"
+            ), dict(zip(("id", "tenant_id", "usuario", "tema", "resposta"), row)))
+    yield engine
+    engine.dispose()
+
+
+def _search(engine, tenant_id, query, usuario=None):
+    async def run():
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{engine.url.database}")
+        try:
+            async with async_sessionmaker(bind=async_engine)() as db:
+                items, _ = await history_search_service.search(
+                    db, tenant_id, query, usuario=usuario, kinds=[quota_service.PROMPTS]
+                )
+        finally:
+            await async_engine.dispose()
+        return sorted(item["id"] for item in items)
+
+    return asyncio.run(run())
+
+
+def test_search_only_returns_rows_of_the_tenant(history_db):
+    assert _search(history_db, 1, "ferias") == [1, 2, 5]
+    assert _search(history_db, 2, "ferias") == [3]
+    assert _search(history_db, 1, "ferias", usuario="bob") == [1]
+    assert _search(history_db, 1, "fér") == [1, 2, 5]
+    assert _search(history_db, 3, "ferias") == []
+
+
+def test_fts_match_is_restricted_to_the_tenant_by_the_index(history_db):
+    columns = history_search_service.SEARCH_TABLES[quota_service.PROMPTS][1]
+    match = "SELECT rowid FROM prompts_fts WHERE prompts_fts MATCH :q ORDER BY rowid"
+    with history_db.connect() as conn:
+        # Sem JOIN com a tabela: o próprio índice já separa inquilinos e usuários
+        q = history_search_service.fts5_query("férias", columns, 1)
+        assert conn.execute(text(match), {"q": q}).scalars().all() == [1, 2, 5]
+        q = history_search_service.fts5_query("férias", columns, 1, "bob")
+        assert conn.execute(text(match), {"q": q}).scalars().all() == [1]
+        # Palavra igual ao termo de escopo não casa com a coluna de escopo
+        q = history_search_service.fts5_query("t2", columns, 1)
+        assert conn.execute(text(match), {"q": q}).scalars().all() == []
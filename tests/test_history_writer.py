@@ -0,0 +1,139 @@
+import sys
+import os
+import asyncio
+
+import pytest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip("aiosqlite")
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from db.models import Base, Prompt, ActivityRollup, IdBlock, PendingFeedback
+from service import history_writer, quota_service
+
+
+@pytest.fixture
+def writer_db(tmp_path, monkeypatch):
+    """history_writer sobre um banco SQLite temporário, com a fila vazia."""
+    path = tmp_path / "history.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    monkeypatch.setattr(history_writer, "AsyncSessionLocal", async_sessionmaker(bind=async_engine, expire_on_commit=False))
+    for name in ("_pending", "_flushing", "_late_feedback", "_id_blocks"):
+        monkeypatch.setattr(history_writer, name, {})
+    monkeypatch.setattr(history_writer, "_id_lock", None)
+    monkeypatch.setattr(history_writer, "_flush_lock", None)
+    monkeypatch.setattr(history_writer, "_last_cleanup", 0.0)
+    monkeypatch.setattr(quota_service, "_pending", {})
+    yield sessionmaker(bind=engine)
+    asyncio.run(async_engine.dispose())
+    engine.dispose()
+
+
+def _prompt(tema):
+    return Prompt(usuario="bob", tenant_id=1, tema=tema, resposta="conteúdo")
+
+
+def test_feedback_for_a_row_queued_on_another_worker_is_applied_at_flush(writer_db):
+    prompt_id = asyncio.run(history_writer.add(_prompt("férias"), quota_service.PROMPTS))
+
+    # Outro worker recebe o feedback: a linha não está no banco nem na fila dele
+    with writer_db() as db:
+        assert history_writer.defer_feedback(db, Prompt, prompt_id, 1, 1)
+        assert not history_writer.defer_feedback(db, Prompt, prompt_id + 10_000, 1, 1)
+
+    asyncio.run(history_writer.flush())
+
+    with writer_db() as db:
+        assert db.get(Prompt, prompt_id).feedback == 1
+        assert db.scalars(select(PendingFeedback)).all() == []
+        rollup = {r.feedback: r.count for r in db.scalars(select(ActivityRollup))}
+        assert rollup == {0: 0, 1: 1}
+
+
+def test_feedback_is_deferred_only_inside_a_live_id_block(writer_db):
+    prompt_id = asyncio.run(history_writer.add(_prompt("férias"), quota_service.PROMPTS))
+
+    with writer_db() as db:
+        # Id abaixo do próximo livre, mas fora de qualquer bloco reservado
+        assert not history_writer.defer_feedback(db, Prompt, prompt_id - 1, 1, 1)
+        db.execute(update(IdBlock).values(touched_at=datetime.utcnow() - timedelta(seconds=history_writer.HISTORY_PENDING_FEEDBACK_TTL + 1)))
+        db.commit()
+        assert not history_writer.defer_feedback(db, Prompt, prompt_id, 1, 1)
+
+
+def test_unresolved_stored_feedback_does_not_starve_the_rest(writer_db, monkeypatch):
+    monkeypatch.setattr(history_writer, "HISTORY_FLUSH_MAX_ROWS", 2)
+    monkeypatch.setattr(history_writer, "HISTORY_CLEANUP_INTERVAL", 3600)
+    prompt_id = asyncio.run(history_writer.add(_prompt("férias"), quota_service.PROMPTS))
+
+    with writer_db() as db:
+        # Ids reservados cujas linhas nunca chegam (ex.: worker derrubado), guardados antes
+        for row_id in range(prompt_id + 1, prompt_id + 6):
+            assert history_writer.defer_feedback(db, Prompt, row_id, 1, -1)
+        assert history_writer.defer_feedback(db, Prompt, prompt_id, 1, 1)
+
+    asyncio.run(history_writer.flush())
+
+    with writer_db() as db:
+        assert db.get(Prompt, prompt_id).feedback == 1
+        assert len(db.scalars(select(PendingFeedback)).all()) == 5
+        # Expiradas, saem na limpeza seguinte
+        db.execute(update(PendingFeedback).values(created_at=datetime.utcnow() - timedelta(seconds=history_writer.HISTORY_PENDING_FEEDBACK_TTL + 1)))
+        db.commit()
+    monkeypatch.setattr(history_writer, "HISTORY_CLEANUP_INTERVAL", 0)
+    asyncio.run(history_writer.flush())
+    with writer_db() as db:
+        assert db.scalars(select(PendingFeedback)).all() == []
+
+
+def test_flush_drops_only_the_row_that_cannot_be_written(writer_db):
+    good, bad = _prompt("bom"), _prompt("ruim")
+    good_id, bad_id = asyncio.run(history_writer.add_all([good, bad], quota_service.PROMPTS))
+    # Id já ocupado no banco: a linha nunca vai entrar
+    with writer_db() as db:
+        db.add(Prompt(id=bad_id, usuario="alice", tenant_id=1, tema="outro"))
+        db.commit()
+
+    asyncio.run(history_writer.flush())
+
+    assert history_writer._pending == {}
+    assert quota_service._pending == {}
+    with writer_db() as db:
+        assert db.get(Prompt, good_id).tema == "bom"
+        assert db.get(Prompt, bad_id).tema == "outro"
+
+
+def test_batch_reservation_holds_quota_until_items_are_written(writer_db):
+    async def reserve():
+        async with history_writer.AsyncSessionLocal() as db:
+            return await quota_service.reserve(db, 1, quota_service.PROMPTS, 3, limit=5)
+
+    async def run():
+        first, second = await asyncio.gather(reserve(), reserve())
+        async with history_writer.AsyncSessionLocal() as db:
+            assert (first is None) != (second is None)
+            reserva = first or second
+            assert await quota_service.used_today(db, 1, quota_service.PROMPTS) == 3
+
+            # Um item gravado passa da reserva para o pendente do writer; os outros falham
+            await history_writer.add(_prompt("um"), quota_service.PROMPTS)
+            reserva.release()
+            reserva.release_all()
+            reserva.release_all()
+            assert await quota_service.used_today(db, 1, quota_service.PROMPTS) == 1
+
+        await history_writer.flush()
+        async with history_writer.AsyncSessionLocal() as db:
+            assert await quota_service.used_today(db, 1, quota_service.PROMPTS) == 1
+
+    asyncio.run(run())
+    assert quota_service._pending == {}
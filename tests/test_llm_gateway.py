@@ -0,0 +1,207 @@
+import sys
+import os
+import json
+import asyncio
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip("langchain_groq")
+
+
+class FakeGroqHandler(BaseHTTPRequestHandler):
+    """Servidor mínimo compatível com /openai/v1/chat/completions."""
+    calls = 0
+    fail_first = 0
+    delay = 0
+    chunk_delay = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        FakeGroqHandler.calls += 1
+        time.sleep(FakeGroqHandler.delay)
+        if FakeGroqHandler.calls <= FakeGroqHandler.fail_first:
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b'{"error": {"message": "overloaded"}}')
+            return
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for i, piece in enumerate(["eco", ": ", body["messages"][-1]["content"]]):
+                if i:
+                    time.sleep(FakeGroqHandler.chunk_delay)
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        payload = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"eco: {body['messages'][-1]['content']}"},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8}
+        }
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGroqHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    FakeGroqHandler.calls = 0
+    FakeGroqHandler.fail_first = 0
+    FakeGroqHandler.delay = 0
+    FakeGroqHandler.chunk_delay = 0
+
+    monkeypatch.setenv("GROQ_API_KEY", "fake")
+    monkeypatch.setenv("GROQ_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    from service import llm_gateway
+    llm_gateway.close()
+    yield llm_gateway
+    llm_gateway.close()
+    server.shutdown()
+
+
+def test_reuses_pooled_client(gateway):
+    first = gateway.get_chat_model(temperature=0.1)
+    assert gateway.get_chat_model(temperature=0.1) is first
+    assert gateway.get_chat_model(temperature=0.3) is not first
+
+
+def test_invoke_against_fake_server(gateway):
+    response = gateway.invoke("olá", temperature=0.1)
+    assert response.content == "eco: olá"
+    assert FakeGroqHandler.calls == 1
+
+
+def test_retries_transient_errors(gateway):
+    FakeGroqHandler.fail_first = 1
+    response = gateway.invoke("de novo")
+    assert response.content == "eco: de novo"
+    assert FakeGroqHandler.calls == 2
+
+
+def test_stream_yields_tokens(gateway):
+    assert list(gateway.stream("aos poucos")) == ["eco", ": ", "aos poucos"]
+
+
+def test_async_invoke_and_stream(gateway):
+    async def run():
+        FakeGroqHandler.fail_first = 1
+        response = await gateway.ainvoke("assíncrono")
+        tokens = [t async for t in gateway.astream("em partes")]
+        await gateway.aclose()
+        return response.content, tokens
+
+    content, tokens = asyncio.run(run())
+    assert content == "eco: assíncrono"
+    assert tokens == ["eco", ": ", "em partes"]
+
+
+class FakeLocalModel:
+    """Substitui o ChatOllama nos testes de hedge."""
+    calls = 0
+
+    async def astream(self, prompt):
+        from langchain_core.messages import AIMessageChunk
+        FakeLocalModel.calls += 1
+        yield AIMessageChunk(content="local")
+
+
+@pytest.fixture
+def with_fallback(gateway, monkeypatch):
+    from core.circuit_breaker import CircuitBreaker
+    monkeypatch.setattr(gateway, "OLLAMA_CHAT_MODEL", "local")
+    monkeypatch.setattr(gateway, "LLM_HEDGE_DELAY", 1)
+    monkeypatch.setattr(gateway, "LLM_MAX_RETRIES", 1)
+    monkeypatch.setattr(gateway, "get_fallback_model", lambda temperature=0.3: FakeLocalModel())
+    FakeLocalModel.calls = 0
+    monkeypatch.setattr(gateway, "_breakers", {
+        "groq": CircuitBreaker("groq", failure_threshold=1, cooldown=60),
+        "ollama": CircuitBreaker("ollama", failure_threshold=1, cooldown=60),
+    })
+    return gateway
+
+
+def test_hedges_to_fallback_when_primary_is_slow(with_fallback, monkeypatch):
+    monkeypatch.setattr(with_fallback, "LLM_HEDGE_DELAY", 0.05)
+    FakeGroqHandler.delay = 1
+    response = asyncio.run(with_fallback.ainvoke("rápido"))
+    assert response.content == "local"
+    assert with_fallback.provider_of(response) == "ollama"
+
+
+def test_fast_primary_wins(with_fallback):
+    response = asyncio.run(with_fallback.ainvoke("olá"))
+    assert response.content == "eco: olá"
+    assert with_fallback.provider_of(response) == "groq"
+
+
+def test_long_primary_generation_does_not_hedge(with_fallback, monkeypatch):
+    # Primeiro token rápido, resposta completa depois do atraso do hedge
+    monkeypatch.setattr(with_fallback, "LLM_HEDGE_DELAY", 0.5)
+    FakeGroqHandler.chunk_delay = 0.4
+    response = asyncio.run(with_fallback.ainvoke("longo"))
+    assert response.content == "eco: longo"
+    assert with_fallback.provider_of(response) == "groq"
+    assert FakeLocalModel.calls == 0
+
+
+def test_breaker_routes_around_failing_primary(with_fallback):
+    FakeGroqHandler.fail_first = 100
+    first = asyncio.run(with_fallback.ainvoke("um"))
+    assert with_fallback.provider_of(first) == "ollama"
+    assert with_fallback._breakers["groq"].state == "open"
+
+    second = asyncio.run(with_fallback.ainvoke("dois"))
+    assert with_fallback.provider_of(second) == "ollama"
+    assert FakeGroqHandler.calls == 1
+
+
+def test_abandoned_streams_are_still_metered(gateway, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(gateway.usage_service, "record", lambda tenant_id, model, pt, ct, ms: recorded.append((tenant_id, ct)))
+
+    tokens = gateway.stream("aos poucos", tenant_id=1)
+    assert next(tokens) == "eco"
+    tokens.close()
+
+    async def run():
+        tokens = gateway.astream("em partes", tenant_id=2)
+        assert await tokens.__anext__() == "eco"
+        await tokens.aclose()
+        await gateway.aclose()
+
+    asyncio.run(run())
+    assert [tenant for tenant, _ in recorded] == [1, 2]
+    assert all(completion > 0 for _, completion in recorded)
@@ -0,0 +1,150 @@
+import sys
+import os
+
+import pytest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy import create_engine, inspect, text
+
+from db.migrations import run_migrations, MIGRATIONS
+
+
+def test_migrates_existing_database_and_is_idempotent(tmp_path):
+    path = tmp_path / "legado.db"
+    engine = create_engine(f"sqlite:///{path}")
+    # Banco anterior às migrações: tabela de prompts sem índices
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE prompts (id INTEGER PRIMARY KEY, usuario VARCHAR, tenant_id INTEGER, tema VARCHAR, "
+            "prompt TEXT, resposta TEXT, feedback INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text("INSERT INTO prompts (usuario, tenant_id, tema) VALUES ('bob', 1, 'IA')"))
+
+    assert run_migrations(engine) == MIGRATIONS[-1][0]
+    assert (tmp_path / "legado.db.bak-v0").exists()
+    indexes = {ix["name"] for ix in inspect(engine).get_indexes("prompts")}
+    assert {"ix_prompts_tenant_created", "ix_prompts_tenant_usuario_created"} <= indexes
+
+    # Segunda execução (reinício da API) não faz nada
+    assert run_migrations(engine) == MIGRATIONS[-1][0]
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM prompts")).scalar() == 1
+        plan = conn.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM prompts WHERE tenant_id = 1 AND usuario = 'bob' ORDER BY created_at DESC"
+        )).fetchall()
+    assert "ix_prompts_tenant_usuario_created" in str(plan)
+    engine.dispose()
+
+
+def test_quota_ledger_is_backfilled_from_history(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legado.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE prompts (id INTEGER PRIMARY KEY, usuario VARCHAR, tenant_id INTEGER, tema VARCHAR, "
+            "prompt TEXT, resposta TEXT, feedback INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text(
+            "INSERT INTO prompts (usuario, tenant_id, tema, created_at) VALUES "
+            "('bob', 1, 'a', '2026-01-02 10:00:00'), ('ana', 1, 'b', '2026-01-02 18:00:00'), ('bob', 1, 'c', '2026-01-03 09:00:00')"
+        ))
+
+    run_migrations(engine)
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT day, kind, count FROM quota_usage_daily ORDER BY day")).fetchall()
+    assert [tuple(r) for r in rows] == [("2026-01-02", "prompt", 2), ("2026-01-03", "prompt", 1)]
+    engine.dispose()
+
+
+def test_chat_sources_are_normalized_into_shared_chunks(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legado.db'}")
+    repeated = '[{"content": "Férias: 30 dias.", "source": "rh.pdf", "page": 2}]'
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE chat_messages (id INTEGER PRIMARY KEY, usuario VARCHAR, tenant_id INTEGER, pergunta TEXT, "
+            "resposta TEXT, sources TEXT, feedback INTEGER, created_at DATETIME)"
+        ))
+        for _ in range(3):
+            conn.execute(text("INSERT INTO chat_messages (tenant_id, pergunta, sources) VALUES (1, 'férias?', :s)"), {"s": repeated})
+
+    run_migrations(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM document_chunks")).scalar() == 1
+        assert conn.execute(text("SELECT count(*) FROM chat_message_sources")).scalar() == 3
+        assert conn.execute(text("SELECT count(*) FROM chat_messages WHERE sources IS NOT NULL")).scalar() == 0
+        row = conn.execute(text("SELECT source, page, content FROM document_chunks")).one()
+    assert tuple(row) == ("rh.pdf", 2, "Férias: 30 dias.")
+    engine.dispose()
+
+
+def test_prompts_reference_template_instead_of_rendered_text(tmp_path):
+    pytest.importorskip("langchain_core")
+    from service import prompt_template_service
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'legado.db'}")
+    rendered = str(prompt_template_service.format_prompt(tema="IA", usuario="bob"))
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE prompts (id INTEGER PRIMARY KEY, usuario VARCHAR, tenant_id INTEGER, tema VARCHAR, "
+            "prompt TEXT, resposta TEXT, feedback INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text("INSERT INTO prompts (usuario, tenant_id, tema, prompt) VALUES ('bob', 1, 'IA', :p)"), {"p": rendered})
+        conn.execute(text("INSERT INTO prompts (usuario, tenant_id, tema, prompt) VALUES ('bob', 1, 'IA', 'outro template')"))
+
+    run_migrations(engine)
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT template_id IS NOT NULL, prompt FROM prompts ORDER BY id")).fetchall()
+        system, human = conn.execute(text("SELECT system, human FROM prompt_templates WHERE version = 1")).one()
+    assert [tuple(r) for r in rows] == [(1, None), (0, "outro template")]
+    assert prompt_template_service.render(system, human, tema="IA", usuario="bob") == rendered
+    engine.dispose()
+
+
+def test_activity_rollup_is_backfilled_from_history(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legado.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE prompts (id INTEGER PRIMARY KEY, usuario VARCHAR, tenant_id INTEGER, tema VARCHAR, "
+            "prompt TEXT, resposta TEXT, feedback INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text(
+            "INSERT INTO prompts (usuario, tenant_id, tema, feedback, created_at) VALUES "
+            "('bob', 1, 'a', 1, '2026-01-02 10:05:00'), ('bob', 1, 'b', 1, '2026-01-02 10:40:00'), "
+            "('ana', 1, 'c', NULL, '2026-01-02 18:00:00')"
+        ))
+
+    run_migrations(engine)
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT usuario, kind, day, hour, feedback, count FROM activity_rollup ORDER BY usuario"
+        )).fetchall()
+    assert [tuple(r) for r in rows] == [
+        ("ana", "prompt", "2026-01-02", 18, 0, 1),
+        ("bob", "prompt", "2026-01-02", 10, 1, 2),
+    ]
+    engine.dispose()
+
+
+def test_history_search_index_follows_inserts_and_updates(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legado.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE prompts (id INTEGER PRIMARY KEY, usuario VARCHAR, tenant_id INTEGER, tema VARCHAR, "
+            "prompt TEXT, resposta TEXT, feedback INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text("INSERT INTO prompts (usuario, tenant_id, tema, resposta) VALUES ('bob', 1, 'Política de férias', 'texto')"))
+
+    run_migrations(engine)
+    match = "SELECT rowid FROM prompts_fts WHERE prompts_fts MATCH :q"
+    with engine.begin() as conn:
+        # Linhas antigas indexadas pela migração, sem diferenciar acentos
+        assert conn.execute(text(match), {"q": "ferias"}).scalars().all() == [1]
+        conn.execute(text("INSERT INTO prompts (usuario, tenant_id, tema, resposta) VALUES ('ana', 1, 'Orçamento', 'anual')"))
+        conn.execute(text("UPDATE prompts SET tema = 'Reembolso' WHERE id = 1"))
+        assert conn.execute(text(match), {"q": "orcamento"}).scalars().all() == [2]
+        assert conn.execute(text(match), {"q": "ferias"}).scalars().all() == []
+        assert conn.execute(text(match), {"q": "reembolso"}).scalars().all() == [1]
+    engine.dispose()
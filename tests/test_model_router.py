@@ -0,0 +1,60 @@
+import sys
+import os
+
+import pytest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip("sqlalchemy")
+
+from service import model_router
+
+
+def test_simple_lookup_goes_to_small_model():
+    route = model_router.route("rag", "Em que página está a política de férias?", "[[FONTE: rh.pdf, PÁGINA: 3]]\nFérias: 30 dias.")
+    assert route.tier == "small"
+
+
+def test_generation_and_complex_questions_go_to_large_model():
+    assert model_router.route("generation", "Post sobre IA").tier == "large"
+    assert model_router.route("rag", "Compare a política de férias com a de licenças").reason == "complex_question"
+    assert model_router.route("rag", "Quantos dias?", "texto " * 5000).reason == "large_context"
+
+
+def test_tenant_and_plan_overrides(monkeypatch):
+    monkeypatch.setitem(model_router.MODEL_ROUTING_OVERRIDES, "7", "large")
+    assert model_router.route("rag", "Quantos dias?", tenant_id=7).reason == "override"
+    monkeypatch.setitem(model_router.TIER_LIMITS["free"], "model_routing", "small")
+    assert model_router.route("generation", "Post sobre IA", subscription_tier="free").tier == "small"
+
+
+def test_rag_context_uses_the_budget_of_the_routed_model(monkeypatch):
+    pytest.importorskip("fastapi")
+    os.environ.setdefault("GROQ_API_KEY", "test")
+    from api import rag_router_API
+    from service import context_service
+    from service.ai_config import get_context_budget
+
+    monkeypatch.setattr(context_service, "_get_encoding", lambda: None)
+    docs = [
+        {"content": f"Trecho {i} sobre a política de férias. " + f"palavra{i} " * 300, "score": 0.1 * i,
+         "source": f"/x/doc{i}.pdf", "page": 0}
+        for i in range(12)
+    ]
+    monkeypatch.setattr(rag_router_API, "similarity_search", lambda **kw: docs)
+    payload = rag_router_API.AskRequest(question="Quantos dias de férias?")
+    tenant = rag_router_API.tenant_cache.TenantInfo(7, "acme", "free", 5, 100, 0, "/tmp")
+    user_data = {"tenant_id": 7, "username": "bob"}
+
+    # Modelo pequeno imposto ao inquilino: o contexto cabe no orçamento dele
+    monkeypatch.setitem(model_router.MODEL_ROUTING_OVERRIDES, "7", "small")
+    _, context, _, route = rag_router_API._retrieve_for_question(payload, user_data, tenant)
+    assert route.tier == "small"
+    assert context_service.count_tokens(context) <= get_context_budget(route.model)
+
+    # Roteamento automático: o contexto grande leva ao modelo grande, com o orçamento dele
+    monkeypatch.setitem(model_router.MODEL_ROUTING_OVERRIDES, "7", "auto")
+    _, context, _, route = rag_router_API._retrieve_for_question(payload, user_data, tenant)
+    assert route.reason == "large_context"
+    assert get_context_budget(model_router.SMALL_MODEL) < context_service.count_tokens(context) <= get_context_budget(route.model)
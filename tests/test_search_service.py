@@ -0,0 +1,210 @@
+import sys
+import os
+
+import pytest
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip("rank_bm25")
+pytest.importorskip("faiss")
+
+from langchain_core.documents import Document
+from langchain_community.retrievers import BM25Retriever
+
+from service import search_service
+
+
+def _bm25(texts):
+    return BM25Retriever.from_documents([
+        Document(page_content=text, metadata={"file_name": f"doc{i % 2}.pdf", "page": i, "uploaded_at": 1000.0 * i})
+        for i, text in enumerate(texts)
+    ])
+
+
+CORPUS = [
+    "política de férias trinta dias",
+    "reembolso de despesas de viagem",
+    "férias coletivas em dezembro",
+    "plano de saúde e odontológico",
+    "férias férias férias vendidas",
+]
+
+
+def test_weighted_rrf_combines_rankings_by_weight():
+    # Ambos em 1º lugar numa lista; o peso maior decide
+    assert search_service._weighted_rrf([[1, 2], [2, 1]], [0.4, 0.6]) == [2, 1]
+    # Item presente nas duas listas supera o 1º de uma lista só
+    assert search_service._weighted_rrf([[1, 3], [2, 3]], [0.5, 0.5])[0] == 3
+    assert search_service._weighted_rrf([[], [7]], [0.4, 0.6]) == [7]
+
+
+def test_sparse_candidates_match_bm25_scores():
+    retriever = _bm25(CORPUS)
+    index = search_service._build_sparse_index(retriever)
+    tokens = retriever.preprocess_func("férias")
+
+    candidates = search_service._sparse_candidates(index, tokens, limit=10)
+    scores = retriever.vectorizer.get_scores(tokens)
+    expected = [i for i in sorted(range(len(CORPUS)), key=lambda i: -scores[i]) if scores[i] > 0]
+    assert candidates == expected
+    # Só documentos com o termo são pontuados
+    assert set(candidates) == {0, 2, 4}
+
+
+def test_sparse_candidates_respect_allowed_positions_and_limit():
+    retriever = _bm25(CORPUS)
+    index = search_service._build_sparse_index(retriever)
+    tokens = retriever.preprocess_func("férias")
+
+    assert search_service._sparse_candidates(index, tokens, limit=1) == [4]
+    allowed = search_service.np.array([0, 2], dtype=search_service.np.int64)
+    assert set(search_service._sparse_candidates(index, tokens, limit=10, allowed=allowed)) == {0, 2}
+    assert search_service._sparse_candidates(index, retriever.preprocess_func("inexistente"), limit=10) == []
+
+
+def _result(name):
+    return {"content": name, "score": 0.1, "source": f"/x/{name}.pdf", "page": 0}
+
+
+def test_top_k_settled_bounds_pending_scopes():
+    c = search_service.RRF_C
+    # Um escopo concluído, pesos iguais: o pendente ainda pode pôr um item novo acima do 2º
+    fused = {n: {"rrf": 1 / (r + c)} for r, n in enumerate("ab", start=1)}
+    assert not search_service._top_k_settled(fused, 2, ["global"])
+    # Dois escopos concordaram nos mesmos trechos: o pendente não alcança o 2º
+    fused = {n: {"rrf": 2 / (r + c)} for r, n in enumerate("ab", start=1)}
+    assert search_service._top_k_settled(fused, 2, ["global"])
+    # ... mas um item já visto logo abaixo ainda pode passar
+    fused["c"] = {"rrf": 2 / (3 + c)}
+    assert not search_service._top_k_settled(fused, 2, ["global"])
+    assert search_service._top_k_settled(fused, 2, [])
+
+
+def test_multi_scope_search_stops_once_finished_scopes_settle_the_top_k(monkeypatch):
+    import threading
+    released = threading.Event()
+
+    def fake_scope(scope, query, tid, usr, k, mode=None, filters=None, resolved=None):
+        if scope == "global":
+            released.wait(5)
+            return [_result("global-doc")]
+        return [{**_result(name), "scope": scope} for name in ("ferias", "reembolso")]
+
+    # user e tenant devolvem os mesmos trechos (ex.: PDF enviado nas duas bases)
+    monkeypatch.setattr(search_service, "_search_scope", fake_scope)
+    try:
+        results = search_service.multi_scope_search("férias", tenant_id=1, username="bob", k=2, scopes=["user", "tenant", "global"])
+        assert not released.is_set()
+        assert [os.path.basename(r["source"]) for r in results] == ["ferias.pdf", "reembolso.pdf"]
+    finally:
+        released.set()
+
+
+def test_allowed_positions_combines_filters():
+    index = search_service._build_sparse_index(_bm25(CORPUS))
+    allowed = search_service._allowed_positions
+
+    assert allowed(index, None) is None
+    assert allowed(index, {"sources": None, "page_from": None}) is None
+    # Arquivos pares são doc0.pdf; páginas exibidas começam em 1
+    assert allowed(index, {"sources": ["doc0.pdf"]}).tolist() == [0, 2, 4]
+    assert allowed(index, {"sources": ["doc0_ocr.pdf"]}).tolist() == [0, 2, 4]
+    assert allowed(index, {"page_from": 2, "page_to": 4}).tolist() == [1, 2, 3]
+    assert allowed(index, {"sources": ["doc1.pdf"], "page_to": 2}).tolist() == [1]
+    # Intervalo de upload [from, to)
+    assert allowed(index, {"uploaded_from": 1000.0, "uploaded_to": 3000.0}).tolist() == [1, 2]
+    assert allowed(index, {"sources": ["outro.pdf"]}).tolist() == []
+
+
+def test_cursor_round_trip_and_invalid_cursor():
+    cursor = search_service._encode_cursor("abc", 8)
+    assert search_service._decode_cursor(cursor) == {"key": "abc", "offset": 8}
+    with pytest.raises(ValueError):
+        search_service._decode_cursor("não-é-cursor")
+
+
+def test_forged_or_out_of_range_cursors_are_rejected():
+    import base64
+    import json
+
+    forged = base64.urlsafe_b64encode(json.dumps({"key": "abc", "offset": 10**9}).encode()).decode()
+    for cursor in (forged, forged + "." + search_service._encode_cursor("abc", 8).split(".")[1]):
+        with pytest.raises(ValueError):
+            search_service._decode_cursor(cursor)
+    # Assinado, mas além da lista profunda (o servidor nunca emite um desses)
+    with pytest.raises(ValueError):
+        search_service._decode_cursor(search_service._encode_cursor("abc", search_service.SEARCH_CURSOR_DEPTH))
+
+
+@pytest.fixture
+def empty_stores(tmp_path, monkeypatch):
+    monkeypatch.setattr(search_service, "get_tenant_path", lambda tenant_id, name=None: str(tmp_path))
+    for name in ("_tenant_retrievers", "_store_versions", "_store_fingerprints", "_sparse_indexes"):
+        monkeypatch.setattr(search_service, name, {})
+    monkeypatch.setattr(search_service, "_ranked_cache", {})
+    # Base global (data/docs) relativa ao diretório atual
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+class _UnreadablePdf:
+    def __init__(self, path):
+        pass
+
+    def load(self):
+        return []
+
+
+def test_reloading_an_unchanged_empty_store_keeps_its_version(empty_stores, monkeypatch):
+    for _ in range(3):
+        assert search_service._resolve_scope("user", "1", "bob") == ("1_bob", None)
+    assert search_service._store_versions["1_bob"] == 1
+
+    # Arquivo novo na pasta: a recarga refaz o índice e invalida cursores
+    (empty_stores / "bob").mkdir()
+    (empty_stores / "bob" / "novo.pdf").write_bytes(b"nao e um pdf")
+    monkeypatch.setattr(search_service, "garantir_pdf_textual", lambda path: path)
+    # PDF ilegível: a store segue vazia, mas com os arquivos novos registrados
+    monkeypatch.setattr(search_service, "PyPDFLoader", _UnreadablePdf)
+    search_service._resolve_scope("user", "1", "bob")
+    assert search_service._store_versions["1_bob"] == 2
+
+
+def test_paginated_search_resolves_each_scope_once(empty_stores, monkeypatch):
+    calls = []
+    resolve = search_service._resolve_scope
+    monkeypatch.setattr(search_service, "_resolve_scope", lambda *a: calls.append(a[0]) or resolve(*a))
+
+    assert search_service.paginated_search("férias", tenant_id=1, username="bob", scopes=["user", "global"]) == ([], None)
+    assert sorted(calls) == ["global", "user"]
+
+
+def test_stale_cursor_restarts_and_depth_is_capped(empty_stores, monkeypatch):
+    depths = []
+
+    def fake_search(query, k, **kwargs):
+        depths.append(k)
+        return [_result(f"doc{i}") for i in range(k)]
+
+    monkeypatch.setattr(search_service, "multi_scope_search", fake_search)
+    page, cursor = search_service.paginated_search("férias", tenant_id=1, username="bob", page_size=4)
+    page, _ = search_service.paginated_search("férias", tenant_id=1, username="bob", page_size=4, cursor=cursor)
+    assert page[0]["content"] == "doc4"
+    # Cursor de outra consulta: recomeça do início em vez de reaproveitar o offset
+    page, _ = search_service.paginated_search("reembolso", tenant_id=1, username="bob", page_size=4, cursor=cursor)
+    assert page[0]["content"] == "doc0"
+    assert set(depths) == {search_service.SEARCH_CURSOR_DEPTH}
+
+
+def test_per_call_k_does_not_touch_the_shared_retrievers():
+    from langchain_classic.retrievers.ensemble import EnsembleRetriever
+
+    bm25 = _bm25(CORPUS)
+    ensemble = EnsembleRetriever(retrievers=[bm25, _bm25(CORPUS)], weights=[0.5, 0.5])
+    deep = search_service._with_k(ensemble, 5)
+
+    assert [r.k for r in deep.retrievers] == [5, 5]
+    assert [r.k for r in ensemble.retrievers] == [4, 4]
+    assert deep.retrievers[0].vectorizer is bm25.vectorizer
+    assert len(search_service._with_k(ensemble, 2).invoke("férias")) <= 2
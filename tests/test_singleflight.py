@@ -0,0 +1,91 @@
+import sys
+import os
+import asyncio
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from core.singleflight import SingleFlight
+
+
+class FakeLLM:
+    """Chamada lenta ao LLM que registra se foi cancelada."""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.cancelled = False
+
+    async def call(self):
+        self.started.set()
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return "resposta"
+
+    async def stream(self):
+        self.started.set()
+        yield "primeiro"
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        yield "segundo"
+
+
+async def _disconnect(client: asyncio.Task):
+    # A admissão cancela o handler quando o cliente desconecta
+    client.cancel()
+    await asyncio.gather(client, return_exceptions=True)
+    await asyncio.sleep(0)
+
+
+def test_sole_client_disconnect_cancels_the_llm_call():
+    async def run():
+        flight, llm = SingleFlight("test"), FakeLLM()
+        client = asyncio.ensure_future(flight.do("k", llm.call))
+        await llm.started.wait()
+        await _disconnect(client)
+        return llm.cancelled, flight._inflight
+
+    cancelled, inflight = asyncio.run(run())
+    assert cancelled
+    assert not inflight
+
+
+def test_remaining_client_keeps_the_shared_call():
+    async def run():
+        flight, llm = SingleFlight("test"), FakeLLM()
+        leader = asyncio.ensure_future(flight.do("k", llm.call))
+        await llm.started.wait()
+        follower = asyncio.ensure_future(flight.do("k", llm.call))
+        await asyncio.sleep(0)
+        await _disconnect(leader)
+        llm.release.set()
+        return llm.cancelled, await follower
+
+    cancelled, result = asyncio.run(run())
+    assert not cancelled
+    assert result == ("resposta", True)
+
+
+def test_sole_stream_client_disconnect_cancels_the_llm_stream():
+    async def run():
+        flight, llm = SingleFlight("test"), FakeLLM()
+
+        async def client():
+            chunks, _ = flight.stream("k", llm.stream)
+            return [chunk async for chunk in chunks]
+
+        task = asyncio.ensure_future(client())
+        await llm.started.wait()
+        await asyncio.sleep(0)
+        await _disconnect(task)
+        return llm.cancelled, flight._streams
+
+    cancelled, streams = asyncio.run(run())
+    assert cancelled
+    assert not streams
@@ -0,0 +1,33 @@
+import sys
+import os
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+from db.models import Base, Tenant
+from service import tenant_cache
+
+
+def test_invalidate_drops_the_local_entry_only_after_commit(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'tenants.db'}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(tenant_cache, "_cache", {})
+    monkeypatch.setattr(tenant_cache, "get_tenant_path", lambda tenant_id, name=None: str(tmp_path))
+    with Session() as db:
+        db.add(Tenant(id=1, name="acme", subscription_tier="free", max_documents=5, max_prompts_per_day=100, current_document_count=0))
+        db.commit()
+
+    with Session() as db:
+        assert tenant_cache.get(db, 1).current_document_count == 0
+        db.execute(update(Tenant).where(Tenant.id == 1).values(current_document_count=1))
+        tenant_cache.invalidate(db, 1)
+        # Sem commit, a entrada local segue válida
+        assert tenant_cache._cache[1].current_document_count == 0
+        db.commit()
+        assert 1 not in tenant_cache._cache
+        assert tenant_cache.get(db, 1).current_document_count == 1
+    engine.dispose()